@@ -55,6 +55,7 @@ from PyQt5.QtWinExtras import QtWin
 # -----------
 import restore_utils
 import backup_utils
+import manifest_utils
 import network_utils
 
 from client_db_utils import get_or_create_hash_db
@@ -6311,19 +6312,11 @@ class FileExplorerPanel(QWidget):
         logging.info(f"Old model id: {id(self.remote_model)}")
         
         try:
-            # Debug: Check metadata file before reset
+            # Debug: Check manifest before reset
             if hasattr(self, 'metadata_dir'):
-                metadata_files = sorted(
-                    [f for f in os.listdir(self.metadata_dir) 
-                     if f.startswith('file_metadata_') and f.endswith('.json')],
-                    reverse=True
-                )
-                if metadata_files:
-                    json_path = os.path.join(self.metadata_dir, metadata_files[0])
-                    with open(json_path, 'r') as f:
-                        data = json.load(f)
-                        logging.info(f"Current metadata file: {json_path}")
-                        logging.info(f"Number of items in metadata: {len(data)}")
+                with manifest_utils.ManifestStore(self.metadata_dir) as store:
+                    logging.info(f"Current manifest: {store.path}")
+                    logging.info(f"Number of items in metadata: {store.count()}")
             
             # Explicitly delete old model
             if hasattr(self, 'remote_model'):
@@ -6347,17 +6340,9 @@ class FileExplorerPanel(QWidget):
                 self.remote_model.load_data(self.metadata_dir)
                 
                 # Debug: Check metadata after load
-                metadata_files = sorted(
-                    [f for f in os.listdir(self.metadata_dir) 
-                     if f.startswith('file_metadata_') and f.endswith('.json')],
-                    reverse=True
-                )
-                if metadata_files:
-                    json_path = os.path.join(self.metadata_dir, metadata_files[0])
-                    with open(json_path, 'r') as f:
-                        data = json.load(f)
-                        logging.info(f"After load - Number of items in metadata: {len(data)}")
-                        logging.info(f"Model root item children count: {self.remote_model.invisibleRootItem().rowCount()}")
+                with manifest_utils.ManifestStore(self.metadata_dir) as store:
+                    logging.info(f"After load - Number of items in metadata: {store.count()}")
+                    logging.info(f"Model root item children count: {self.remote_model.invisibleRootItem().rowCount()}")
                 
                 logging.info("Remote tree reset complete")
                 
@@ -7086,36 +7071,6 @@ class FileExplorerPanel(QWidget):
             logging.error(f"Failed to get installation path: {e}")
             return None
 
-    def get_metadata_files(self):
-        """Get list of metadata files sorted by timestamp (newest first)"""
-        try:
-            files = [f for f in os.listdir(self.metadata_dir) 
-                    if f.startswith('file_metadata_') and f.endswith('.json')]
-            
-            # Sort files by timestamp in filename
-            files.sort(key=lambda x: datetime.strptime(
-                x, 'file_metadata_%Y%m%d_%H%M%S.json'), reverse=True)
-            
-            return files
-        except Exception as e:
-            logging.error(f"Error getting metadata files: {e}")
-            return []
-
-    def cleanup_old_metadata(self, max_files=10):
-        """Remove old metadata files keeping only the most recent ones"""
-        try:
-            files = self.get_metadata_files()
-            if len(files) > max_files:
-                for old_file in files[max_files:]:
-                    file_path = os.path.join(self.metadata_dir, old_file)
-                    try:
-                        os.remove(file_path)
-                        logging.info(f"Removed old metadata file: {old_file}")
-                    except Exception as e:
-                        logging.error(f"Failed to remove old metadata file {old_file}: {e}")
-        except Exception as e:
-            logging.error(f"Error during metadata cleanup: {e}")
-
     def resolve_path(self, relative_path):
         """Resolve a path relative to the installation directory"""
         if not self.install_path:
@@ -7984,7 +7939,7 @@ class RemoteFileSystemModel(QStandardItemModel):
 
     Implementation Details:
     - Qt model/view framework
-    - JSON metadata parsing
+    - Manifest store (manifest_utils) queries
     - Custom icon system
     - Hierarchical data organization
 
@@ -8009,48 +7964,31 @@ class RemoteFileSystemModel(QStandardItemModel):
             logging.info("=== Starting metadata load ===")
             self.beginResetModel()
             
-            metadata_files = sorted(
-                [f for f in os.listdir(metadata_dir) 
-                 if f.startswith('file_metadata_') and f.endswith('.json')],
-                reverse=True
-            )
-            
-            if not metadata_files:
-                logging.info("No metadata files found")
-                return
+            with manifest_utils.ManifestStore(metadata_dir) as store:
+                count = store.count()
+                if not count:
+                    logging.info("No file metadata in manifest")
+                    return
 
-            json_path = os.path.join(metadata_dir, metadata_files[0])
-            with open(json_path, 'r') as file:
-                data = json.load(file)
-                logging.info(f"Loading {len(data)} items from {json_path}")
-                
-                # Track unique paths
-                paths_added = set()
-                
-                # Create directories first
+                logging.info(f"Loading {count} items from {store.path}")
+
+                # Create directories first; paths are unique in the manifest
                 directories = set()
-                for item in data:
-                    path = item['ClientFullNameAndPathAsPosix']
-                    if path in paths_added:
-                        logging.info(f"Duplicate path detected during load: {path}")
-                    paths_added.add(path)
-                    
-                    parts = path.strip('/').split('/')
+                for directory in store.directories():
+                    parts = directory.strip('/').split('/')
                     current = ""
-                    for part in parts[:-1]:
+                    for part in parts:
                         current = f"{current}/{part}" if current else part
                         directories.add(current)
-                
-                logging.info(f"=== Metadata load complete: {len(paths_added)} unique paths ===")
-                
+
                 for directory in sorted(directories):
                     self._create_directory_path(directory)
-                
-                # Add files
-                for item in data:
+
+                # Add files, read from the store as they are added
+                for item in store.records():
                     self._add_file(item['ClientFullNameAndPathAsPosix'], item)
-                    
-            logging.info(f"Loaded metadata from {json_path}")
+
+                logging.info(f"=== Metadata load complete: {count} unique paths ===")
 
         except Exception as e:
             logging.error(f"Error loading metadata: {str(e)}")
@@ -8421,154 +8359,103 @@ class BackgroundOperation:
             fail_count = 0
             
             metadata_dir = os.path.join(os.getenv('APPDATA'), 'Stormcloud', 'file_explorer', 'manifest')
-            metadata_files = sorted([f for f in os.listdir(metadata_dir) 
-                                   if f.startswith('file_metadata_') and f.endswith('.json')],
-                                  reverse=True)
-            
-            if not metadata_files:
-                raise Exception("No metadata files found")
-                
-            # Load the most recent metadata file
-            json_path = os.path.join(metadata_dir, metadata_files[0])
-            with open(json_path, 'r') as f:
-                metadata = json.load(f)
             
             restore_files = []
             
-            for item in metadata:
-                file_path = item['ClientFullNameAndPathAsPosix']
-                file_size = item.get('FileSize', 0)  # Get size from metadata
-                
+            # Only the files under the restore paths are read from the manifest
+            with manifest_utils.ManifestStore(metadata_dir) as store:
+                if not store.count():
+                    raise Exception("No metadata files found")
+
                 for restore_path in paths:
-                    if file_path.startswith(restore_path):
-                        restore_files.append((file_path, file_size))
+                    for item in store.records_under(restore_path):
+                        file_size = item.get('FileSize', 0)  # Get size from metadata
+                        restore_files.append((item['ClientFullNameAndPathAsPosix'], file_size))
             
-                total_files = len(restore_files)
+            total_files = len(restore_files)
             
             logging.info(f"Found {total_files} backed up files to restore")
             queue.put({'type': 'total_files', 'value': total_files})
             
             processed = 0
-            for path, file_size in restore_files:
+
+            def report(path, success, error=None):
+                nonlocal success_count, fail_count, processed
+                success_count += 1 if success else 0
+                fail_count += 0 if success else 1
+                processed += 1
+
+                result_msg = "successfully" if success else "failed to"
+                logging.info(f"{result_msg.capitalize()} restored file: {path}")
+
+                message = {
+                    'type': 'file_progress',
+                    'filepath': path,
+                    'success': success,
+                    'total_files': total_files,
+                    'processed_files': processed,
+                    'operation_id': operation_id,
+                    'record_file': True,
+                    'parent_folder': os.path.dirname(path),
+                    'user_email': settings.get('user_email')
+                }
+                if error:
+                    message['error'] = error
+                queue.put(message)
+
+            # Large files are restored one at a time with ranged downloads,
+            # everything else in bulk as streamed archives
+            large_files = [path for path, file_size in restore_files if file_size > 300 * 1024 * 1024]  # 300MB
+            small_files = [path for path, file_size in restore_files if file_size <= 300 * 1024 * 1024]
+
+            results = restore_utils.restore_files(
+                small_files,
+                settings['API_KEY'],
+                settings['AGENT_ID'],
+                progress_callback=report,
+                should_stop=should_stop
+            ) if small_files else {}
+
+            one_at_a_time = large_files
+            if results is None:
+                logging.info("Server has no archive restore endpoint, restoring files one at a time")
+                one_at_a_time = [path for path, _ in restore_files]
+
+            large_paths = set(large_files)
+            for path in one_at_a_time:
                 if should_stop.value:
                     logging.info("Restore operation cancelled by user")
                     break
-                    
-                if os.path.isfile(path):
-                    try:
-                        logging.info(f"Attempting to restore file: {path}")
-                        
-                        # Use chunked restore for large files
-                        if file_size > 300 * 1024 * 1024:  # 300MB
-                            success = restore_utils.restore_large_file(
-                                path,
-                                settings['API_KEY'],
-                                settings['AGENT_ID'],
-                                lambda p: queue.put({
-                                    'type': 'chunk_progress',
-                                    'filepath': path,
-                                    'progress': p
-                                }),
-                                should_stop
-                            )
-                        else:
-                            success = restore_utils.restore_file(
-                                path,
-                                settings['API_KEY'],
-                                settings['AGENT_ID']
-                            )
-                        
-                        success_count += 1 if success else 0
-                        fail_count += 0 if success else 1
-                        processed += 1
-                        
-                        result_msg = "successfully" if success else "failed to"
-                        logging.info(f"{result_msg.capitalize()} restored file: {path}")
-                        
-                        queue.put({
-                            'type': 'file_progress',
-                            'filepath': path,
-                            'success': success,
-                            'total_files': total_files,
-                            'processed_files': processed,
-                            'operation_id': operation_id,
-                            'record_file': True,
-                            'parent_folder': os.path.dirname(path),
-                            'user_email': settings.get('user_email')
-                        })
-                        
-                    except Exception as e:
-                        error_msg = str(e)
-                        logging.error(f"Failed to restore file {path}: {error_msg}")
-                        fail_count += 1
-                        queue.put({
-                            'type': 'file_progress',
-                            'filepath': path,
-                            'success': False,
-                            'error': error_msg,
-                            'total_files': total_files,
-                            'processed_files': processed,
-                            'operation_id': operation_id,
-                            'record_file': True,
-                            'parent_folder': os.path.dirname(path),
-                            'user_email': settings.get('user_email')
-                        })
-                        
-                else:  # Directory
-                    logging.info(f"Processing directory: {path}")
-                    for root, _, files in os.walk(path):
-                        if should_stop.value:
-                            break
-                        for file in files:
-                            if should_stop.value:
-                                break
-                                
-                            file_path = os.path.join(root, file)
-                            try:
-                                normalized_path = file_path.replace('\\', '/')
-                                logging.info(f"Attempting to restore file: {normalized_path}")
-                                
-                                success = restore_utils.restore_file(
-                                    normalized_path,
-                                    settings['API_KEY'],
-                                    settings['AGENT_ID']
-                                )
-                                success_count += 1 if success else 0
-                                fail_count += 0 if success else 1
-                                processed += 1
-                                
-                                result_msg = "successfully" if success else "failed to"
-                                logging.info(f"{result_msg.capitalize()} restored file: {normalized_path}")
-                                
-                                queue.put({
-                                    'type': 'file_progress',
-                                    'filepath': normalized_path,
-                                    'success': success,
-                                    'total_files': total_files,
-                                    'processed_files': processed,
-                                    'operation_id': operation_id,
-                                    'record_file': True,
-                                    'parent_folder': path,
-                                    'user_email': settings.get('user_email')
-                                })
-                                
-                            except Exception as e:
-                                error_msg = str(e)
-                                logging.error(f"Failed to restore file {file_path}: {error_msg}")
-                                fail_count += 1
-                                queue.put({
-                                    'type': 'file_progress',
-                                    'filepath': normalized_path,
-                                    'success': False,
-                                    'error': error_msg,
-                                    'total_files': total_files,
-                                    'processed_files': processed,
-                                    'operation_id': operation_id,
-                                    'record_file': True,
-                                    'parent_folder': path,
-                                    'user_email': settings.get('user_email')
-                                })
-            
+
+                try:
+                    logging.info(f"Attempting to restore file: {path}")
+
+                    if path not in large_paths:
+                        success = restore_utils.restore_file(
+                            path,
+                            settings['API_KEY'],
+                            settings['AGENT_ID']
+                        )
+                    else:
+                        success = restore_utils.restore_large_file(
+                            path,
+                            settings['API_KEY'],
+                            settings['AGENT_ID'],
+                            lambda p: queue.put({
+                                'type': 'chunk_progress',
+                                'filepath': path,
+                                'progress': p
+                            }),
+                            should_stop
+                        )
+
+                    report(path, success)
+
+                except Exception as e:
+                    error_msg = str(e)
+                    logging.error(f"Failed to restore file {path}: {error_msg}")
+                    report(path, False, error_msg)
+
             # Send final completion status
             if not should_stop.value:
                 successful = fail_count == 0 and success_count > 0
@@ -49,6 +49,7 @@ from PyQt5.QtWinExtras import QtWin
 #   Core imports
 import restore_utils
 import backup_utils
+import manifest_utils
 import network_utils
 
 from client_db_utils import get_or_create_hash_db
@@ -5776,36 +5777,6 @@ class FileExplorerPanel(QWidget):
             logging.error(f"Failed to get installation path: {e}")
             return None
 
-    def get_metadata_files(self):
-        """Get list of metadata files sorted by timestamp (newest first)"""
-        try:
-            files = [f for f in os.listdir(self.metadata_dir) 
-                    if f.startswith('file_metadata_') and f.endswith('.json')]
-            
-            # Sort files by timestamp in filename
-            files.sort(key=lambda x: datetime.strptime(
-                x, 'file_metadata_%Y%m%d_%H%M%S.json'), reverse=True)
-            
-            return files
-        except Exception as e:
-            logging.error(f"Error getting metadata files: {e}")
-            return []
-
-    def cleanup_old_metadata(self, max_files=10):
-        """Remove old metadata files keeping only the most recent ones"""
-        try:
-            files = self.get_metadata_files()
-            if len(files) > max_files:
-                for old_file in files[max_files:]:
-                    file_path = os.path.join(self.metadata_dir, old_file)
-                    try:
-                        os.remove(file_path)
-                        logging.info(f"Removed old metadata file: {old_file}")
-                    except Exception as e:
-                        logging.error(f"Failed to remove old metadata file {old_file}: {e}")
-        except Exception as e:
-            logging.error(f"Error during metadata cleanup: {e}")
-
     def resolve_path(self, relative_path):
         """Resolve a path relative to the installation directory"""
         if not self.install_path:
@@ -6001,27 +5972,17 @@ class FileExplorerPanel(QWidget):
                     parent = new_dir
 
     def load_data(self):
-        """Load file metadata from most recent JSON file"""
-        metadata_files = self.get_metadata_files()
-        
-        if not metadata_files:
-            logging.warning("No metadata files found")
-            return
-
-        # Use most recent file
-        latest_file = metadata_files[0]
-        json_path = os.path.join(self.metadata_dir, latest_file)
-        
+        """Load file metadata from the manifest store"""
         try:
-            with open(json_path, 'r') as file:
-                data = json.load(file)
-                for item in data:
+            with manifest_utils.ManifestStore(self.metadata_dir) as store:
+                if not store.count():
+                    logging.warning("No file metadata in manifest")
+                    return
+
+                for item in store.records():
                     self.model.add_file(item['ClientFullNameAndPathAsPosix'], item)
-            
-            logging.info(f"Loaded metadata from {latest_file}")
-            
-            # Cleanup old files
-            self.cleanup_old_metadata()
+
+                logging.info(f"Loaded metadata from {store.path}")
             
         except Exception as e:
             logging.error(f"Error loading metadata: {str(e)}", exc_info=True)
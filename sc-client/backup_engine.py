@@ -0,0 +1,369 @@
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import backup_utils
+import network_utils
+
+# Same values as stormcloud.BackupResult
+BACKED_UP = "backed_up"
+UNCHANGED = "unchanged"
+FAILED    = "failed"
+
+DEFAULT_HASH_WORKERS   = 4
+DEFAULT_UPLOAD_WORKERS = 4
+
+# Changed files up to BATCH_FILE_MAX_KB are packed into /api/backup-files-batch
+# requests of up to BATCH_MAX_FILES files / BATCH_MAX_MB. BATCH_MAX_FILES: 0
+# sends every file on its own.
+DEFAULT_BATCH_MAX_FILES   = 200
+DEFAULT_BATCH_MAX_MB      = 16
+DEFAULT_BATCH_FILE_MAX_KB = 1024
+
+ONE_MB = 1024*1024
+
+@dataclass
+class FileBackupResult:
+    path: str
+    status: str
+    error_message: Optional[str] = None
+
+class StageStats:
+    """Thread-safe counters for one stage of the pipeline"""
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.calls = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, num_bytes, seconds, files=1):
+        with self._lock:
+            self.files += files
+            self.calls += 1
+            self.bytes += num_bytes
+            self.busy_seconds += seconds
+
+    def summary(self, wall_seconds):
+        return {
+            "files": self.files,
+            "calls": self.calls,
+            "mb": self.bytes / ONE_MB,
+            "busy_seconds": self.busy_seconds,
+            # Busy MB/s is per worker; wall MB/s is what the stage achieved overall.
+            "busy_mb_per_second": self.bytes / ONE_MB / self.busy_seconds if self.busy_seconds else 0.0,
+            "wall_mb_per_second": self.bytes / ONE_MB / wall_seconds if wall_seconds else 0.0,
+            "wall_files_per_second": self.files / wall_seconds if wall_seconds else 0.0
+        }
+
+class BatchPacker:
+    """
+    Packs small changed files into batch upload requests. Each file gets its
+    own Future, resolved with (status_code, digest, file_stat) once the batch
+    it went out in has been answered.
+    """
+
+    def __init__(self, submit_batch, max_files, max_bytes):
+        self.submit_batch = submit_batch
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._pending = []   # (file_path, digest, file_stat, future)
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, file_path, digest, file_stat):
+        future = Future()
+
+        with self._lock:
+            self._pending.append((file_path, digest, file_stat, future))
+            self._pending_bytes += file_stat.st_size
+
+            full = len(self._pending) >= self.max_files or self._pending_bytes >= self.max_bytes
+            batch = self._take() if full else None
+
+        if batch:
+            self.submit_batch(batch)
+
+        return future
+
+    def flush(self, future=None):
+        """Send the partly filled batch now. If future is given, only if it is waiting in that batch."""
+        with self._lock:
+            if future is not None and not any(entry[3] is future for entry in self._pending):
+                return
+            batch = self._take()
+
+        if batch:
+            self.submit_batch(batch)
+
+    def _take(self):
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        return batch
+
+class BackupEngine:
+    """
+    Backs up files through a bounded pipeline:
+
+      walk + hash db lookup  (calling thread)
+        -> stat / hash       (hash_workers threads)
+        -> upload            (upload_workers threads, small files packed into batches)
+        -> hash db + result  (calling thread, in walk order)
+
+    Everything that touches SQLite stays on the calling thread, and a file's
+    hash db row is only written after the server has acknowledged it. At most
+    max_in_flight files are queued or being worked on at any time, so a large
+    tree never builds up an unbounded backlog in memory.
+    """
+
+    def __init__(self, api_key, agent_id, dbconn, ignore_hash, hash_writer=None,
+                 hash_workers=DEFAULT_HASH_WORKERS, upload_workers=DEFAULT_UPLOAD_WORKERS,
+                 should_stop=None, batch_max_files=DEFAULT_BATCH_MAX_FILES,
+                 batch_max_bytes=DEFAULT_BATCH_MAX_MB*ONE_MB, batch_file_max_bytes=DEFAULT_BATCH_FILE_MAX_KB*1024):
+        self.api_key = api_key
+        self.agent_id = agent_id
+        self.dbconn = dbconn
+        self.ignore_hash = ignore_hash
+        self.hash_writer = hash_writer
+        self.hash_workers = max(1, hash_workers)
+        self.upload_workers = max(1, upload_workers)
+        self.batch_max_files = batch_max_files
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_file_max_bytes = batch_file_max_bytes
+        self._packer = None
+
+        # Batches can only fill up if enough files are in flight to fill them.
+        self.max_in_flight = max(2 * (self.hash_workers + self.upload_workers), 2 * self.batch_max_files)
+        self.should_stop = should_stop or (lambda: False)
+        self.stopped = False
+        self.wall_seconds = 0.0
+
+        self.stats = {
+            "hash": StageStats("hash"),
+            "upload": StageStats("upload"),
+            "commit": StageStats("commit")
+        }
+
+    @classmethod
+    def from_settings(cls, settings, dbconn, ignore_hash, hash_writer=None, should_stop=None):
+        return cls(
+            settings['API_KEY'],
+            settings['AGENT_ID'],
+            dbconn,
+            ignore_hash,
+            hash_writer,
+            hash_workers=int(settings.get('BACKUP_HASH_WORKERS', DEFAULT_HASH_WORKERS)),
+            upload_workers=int(settings.get('BACKUP_UPLOAD_WORKERS', DEFAULT_UPLOAD_WORKERS)),
+            should_stop=should_stop,
+            batch_max_files=int(settings.get('BATCH_MAX_FILES', DEFAULT_BATCH_MAX_FILES)),
+            batch_max_bytes=int(float(settings.get('BATCH_MAX_MB', DEFAULT_BATCH_MAX_MB)) * ONE_MB),
+            batch_file_max_bytes=int(settings.get('BATCH_FILE_MAX_KB', DEFAULT_BATCH_FILE_MAX_KB)) * 1024
+        )
+
+    def run(self, file_paths, on_result):
+        """
+        Back up every path from the file_paths iterable, calling on_result with a
+        FileBackupResult for each one on the calling thread, in iteration order.
+        """
+        start = time.perf_counter()
+        in_flight = deque()
+        seen = set()
+
+        with ThreadPoolExecutor(self.hash_workers, thread_name_prefix="sc-hash") as hash_pool, \
+             ThreadPoolExecutor(self.upload_workers, thread_name_prefix="sc-upload") as upload_pool:
+
+            if self.batch_max_files > 0:
+                self._packer = BatchPacker(
+                    lambda batch: upload_pool.submit(self._upload_batch, batch),
+                    self.batch_max_files,
+                    self.batch_max_bytes
+                )
+
+            for file_path in file_paths:
+                if self.should_stop():
+                    logging.warning("Backup stop requested, finishing files already in progress")
+                    self.stopped = True
+                    break
+
+                if file_path in seen:
+                    continue
+                seen.add(file_path)
+
+                hash_row = self._lookup_hash_row(file_path)
+                future = hash_pool.submit(self._check_file, file_path, hash_row, upload_pool)
+                in_flight.append((file_path, future))
+
+                if len(in_flight) >= self.max_in_flight:
+                    self._complete(*in_flight.popleft(), on_result)
+
+            while in_flight:
+                self._complete(*in_flight.popleft(), on_result)
+
+        self.wall_seconds = time.perf_counter() - start
+        self._log_stats()
+
+    def _lookup_hash_row(self, file_path):
+        if self.ignore_hash or not self.dbconn:
+            return None
+
+        results = backup_utils.is_file_in_db(file_path, self.dbconn.cursor())
+        return results[0] if results else None
+
+    def _check_file(self, file_path, hash_row, upload_pool):
+        """Hash worker: decide whether the file changed and hand it to the upload pool if so"""
+        started = time.perf_counter()
+
+        if self.ignore_hash:
+            status, digest, file_stat, refresh_row = backup_utils.BACKUP_STATUS_CHANGE, None, None, False
+        else:
+            status, digest, file_stat, refresh_row = backup_utils.compare_with_hash_row(file_path, hash_row)
+
+        hashed_bytes = file_stat.st_size if digest and file_stat else 0
+        self.stats["hash"].add(hashed_bytes, time.perf_counter() - started)
+
+        if status == backup_utils.BACKUP_STATUS_NO_CHANGE:
+            return status, digest, file_stat, refresh_row, None
+
+        if self._packer:
+            file_stat = file_stat or os.stat(file_path)
+
+            if file_stat.st_size <= self.batch_file_max_bytes:
+                upload_future = self._packer.add(file_path, digest, file_stat)
+                return status, digest, file_stat, refresh_row, upload_future
+
+        upload_future = upload_pool.submit(self._upload_file, file_path, digest, file_stat)
+        return status, digest, file_stat, refresh_row, upload_future
+
+    def _upload_file(self, file_path, digest, file_stat):
+        """Upload worker"""
+        started = time.perf_counter()
+        logging.info(f"Backing up file: {file_path}")
+
+        ret, digest, file_stat = backup_utils.upload_changed_file(
+            pathlib.Path(file_path), self.api_key, self.agent_id, digest, file_stat
+        )
+
+        self.stats["upload"].add(file_stat.st_size if ret == 200 else 0, time.perf_counter() - started)
+        return ret, digest, file_stat
+
+    def _upload_batch(self, batch):
+        """Upload worker: send a batch from the packer and resolve each file's Future"""
+        started = time.perf_counter()
+        logging.info(f"Backing up batch of {len(batch)} files")
+
+        try:
+            results = backup_utils.upload_changed_files_batch(
+                [(pathlib.Path(file_path), digest, file_stat) for file_path, digest, file_stat, _ in batch],
+                self.api_key,
+                self.agent_id
+            )
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        uploaded_bytes = sum(file_stat.st_size for ret, _, file_stat in results if ret == 200)
+        self.stats["upload"].add(uploaded_bytes, time.perf_counter() - started, files=len(batch))
+
+        for (_, _, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _complete(self, file_path, future, on_result):
+        """Wait for one file and record its outcome. Runs on the calling thread."""
+        try:
+            status, digest, file_stat, refresh_row, upload_future = future.result()
+
+            if upload_future is None:
+                if refresh_row:
+                    self._write_hash_row(file_path, digest, file_stat)
+                result = FileBackupResult(file_path, UNCHANGED)
+
+            else:
+                if self._packer and not upload_future.done():
+                    # Don't wait for a batch that is still filling up
+                    self._packer.flush(upload_future)
+
+                ret, digest, file_stat = upload_future.result()
+
+                if ret == 200:
+                    self._write_hash_row(file_path, digest, file_stat)
+                    logging.info(f"Successfully backed up file: {file_path}")
+                    result = FileBackupResult(file_path, BACKED_UP)
+                else:
+                    logging.error(f"Server returned non-200 status code for {file_path}: {ret}")
+                    result = FileBackupResult(file_path, FAILED, "File backup failed")
+
+        except Exception as e:
+            logging.error(f"Error backing up file {file_path}: {str(e)}")
+            result = FileBackupResult(file_path, FAILED, str(e))
+
+        on_result(result)
+
+    def _write_hash_row(self, file_path, digest, file_stat):
+        if not self.dbconn:
+            return
+
+        started = time.perf_counter()
+        backup_utils.write_hash_row(file_path, digest, file_stat, self.dbconn, self.hash_writer)
+        self.stats["commit"].add(0, time.perf_counter() - started)
+
+    def get_stats(self):
+        """Per-stage throughput of the last run"""
+        return {name: stage.summary(self.wall_seconds) for name, stage in self.stats.items()}
+
+    def _log_stats(self):
+        logging.info("Backup engine finished in %.1f seconds (%d hash workers, %d upload workers)%s" % (
+            self.wall_seconds, self.hash_workers, self.upload_workers, ", stopped early" if self.stopped else ""))
+
+        for name, summary in self.get_stats().items():
+            logging.info("  %-6s %6d files %6d calls %10.1f MB  busy %7.1fs  %8.1f MB/s  %8.1f files/s" % (
+                name, summary["files"], summary["calls"], summary["mb"], summary["busy_seconds"],
+                summary["wall_mb_per_second"], summary["wall_files_per_second"]))
+
+        connection_stats = network_utils.get_connection_stats()
+        logging.info("  HTTP: %d requests, %d connections opened, %.0f%% reused" % (
+            connection_stats["requests"], connection_stats["connections_opened"],
+            100 * connection_stats["reuse_ratio"]))
+
+def iter_backup_files(backup_paths, recursive_paths, on_error=None):
+    """
+    Walk the configured paths, yielding each file path (forward slashes) as it
+    is found so the engine can start on the first files before the walk is done.
+    Paths that cannot be read are reported to on_error(path, message).
+    """
+    for path, is_recursive in [(p, False) for p in backup_paths] + [(p, True) for p in recursive_paths]:
+        path = normalize_path(path)
+
+        try:
+            if os.path.isfile(path):
+                yield path
+
+            elif is_recursive:
+                for root, _, files in os.walk(path):
+                    for file in files:
+                        yield normalize_path(os.path.join(root, file))
+
+            elif os.path.isdir(path):
+                # Only the files in the immediate directory
+                for entry in os.scandir(path):
+                    if entry.is_file():
+                        yield normalize_path(entry.path)
+
+        except Exception as e:
+            error_msg = f"Error processing path {path}: {str(e)}"
+            logging.error(error_msg)
+            if on_error:
+                on_error(path, error_msg)
+
+def normalize_path(path):
+    """Normalize path to use forward slashes"""
+    return str(path).replace('\\', '/')
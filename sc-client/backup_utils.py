@@ -1,17 +1,47 @@
 from datetime import datetime
 
 import pathlib
-import hashlib
 import os
+import threading
+import time
 
 import logging
 import network_utils
+import client_db_utils
+import hash_utils
+import resumable_upload_utils
+import chunked_upload_utils
 
 import traceback
 
 BACKUP_STATUS_NO_CHANGE = 0
 BACKUP_STATUS_CHANGE    = 1
 
+# 'metadata' only hashes a file when its size, mtime or file id differ from the hash db.
+# 'hash' re-hashes every file on every pass (the original behavior).
+CHANGE_DETECTION_METADATA = 'metadata'
+CHANGE_DETECTION_HASH     = 'hash'
+
+# A file whose mtime is this close to the moment it was last verified may have been
+# written again within the same timestamp tick (2s on FAT), so its stat is not trusted.
+RACY_MTIME_WINDOW_SECONDS = 2
+
+change_detection_mode    = CHANGE_DETECTION_METADATA
+paranoid_verify_interval = None   # seconds between full-verify hashes of each file, None to disable
+
+# Changed files at least this large are first offered to the server by SHA-256,
+# and only uploaded if it does not already have the content. 0 disables this.
+# Only files change detection had to hash are offered: it computes the SHA-256
+# in the same read as the HASH_ALGORITHM digest and leaves it for
+# upload_changed_file. Hashing a file just to offer it would read it twice
+# whenever the server does not have it, the usual case.
+DEFAULT_KNOWN_FILE_CHECK_KB = 256
+
+known_file_check_size = DEFAULT_KNOWN_FILE_CHECK_KB * 1024
+
+_known_sha256_lock = threading.Lock()
+_known_sha256s = {}   # file path -> (size, mtime_ns, sha256) of changed files awaiting upload
+
 class AuthContext:
     _instance = None
     
@@ -49,6 +79,26 @@ def get_auth_context():
     """Get the current authentication context"""
     return AuthContext.get_instance()
 
+def configure_change_detection(settings):
+    """Apply CHANGE_DETECTION and PARANOID_VERIFY_HOURS from settings.cfg"""
+    global change_detection_mode, paranoid_verify_interval
+
+    mode = str(settings.get('CHANGE_DETECTION', CHANGE_DETECTION_METADATA)).lower()
+    if mode not in (CHANGE_DETECTION_METADATA, CHANGE_DETECTION_HASH):
+        logging.warning(f"Unknown CHANGE_DETECTION mode '{mode}', using '{CHANGE_DETECTION_METADATA}'")
+        mode = CHANGE_DETECTION_METADATA
+
+    paranoid_hours = settings.get('PARANOID_VERIFY_HOURS')
+
+    change_detection_mode    = mode
+    paranoid_verify_interval = float(paranoid_hours) * 3600 if paranoid_hours else None
+
+def configure_uploads(settings):
+    """Apply KNOWN_FILE_CHECK_KB from settings.cfg"""
+    global known_file_check_size
+
+    known_file_check_size = int(settings.get('KNOWN_FILE_CHECK_KB', DEFAULT_KNOWN_FILE_CHECK_KB)) * 1024
+
 def perform_backup(paths, paths_recursive, api_key, agent_id, dbconn, ignore_hash, systray):
     """Enhanced backup function with better error handling"""
     logging.info("Beginning backup!")
@@ -143,15 +193,20 @@ def process_one_path_recursive(target_path,api_key,agent_id,dbconn,ignore_hash):
         else:
             process_file(file,api_key,agent_id,dbconn,ignore_hash)
 
-def process_file(file_path_obj, api_key, agent_id, dbconn, ignore_hash):
-    """Enhanced process_file with better error handling"""
+def process_file(file_path_obj, api_key, agent_id, dbconn, ignore_hash, hash_writer=None):
+    """
+    Enhanced process_file with better error handling
+
+    If a client_db_utils.HashDBWriter is given, hash db updates are queued on it
+    instead of being committed one file at a time.
+    """
     try:
         logging.info(f"Processing file: {file_path_obj}")
         
         if not ignore_hash:
-            status = check_hash_db(file_path_obj, dbconn)
+            status, digest, file_stat = detect_change(file_path_obj, dbconn, hash_writer)
         else:
-            status = BACKUP_STATUS_CHANGE
+            status, digest, file_stat = BACKUP_STATUS_CHANGE, None, None
 
         if status == BACKUP_STATUS_NO_CHANGE:
             logging.info("No change to file, continuing")
@@ -160,10 +215,11 @@ def process_file(file_path_obj, api_key, agent_id, dbconn, ignore_hash):
         elif status == BACKUP_STATUS_CHANGE:
             logging.info(f"Backing up file: {file_path_obj.name}")
 
-            ret = network_utils.ship_file_to_server(api_key, agent_id, file_path_obj.resolve())
+            ret, digest, file_stat = upload_changed_file(file_path_obj, api_key, agent_id, digest, file_stat)
             if ret == 200:
                 if dbconn:  # Only update hash if we have a db connection
-                    update_hash_db(file_path_obj, dbconn)
+                    write_hash_row(str(file_path_obj), digest, file_stat, dbconn, hash_writer)
+                    logging.log(logging.INFO, "Updated file hash in database.")
                 logging.info(f"Successfully backed up file: {file_path_obj.name}")
                 return True
             else:
@@ -174,61 +230,242 @@ def process_file(file_path_obj, api_key, agent_id, dbconn, ignore_hash):
         logging.error(f"Error processing file {file_path_obj}: {str(e)}", exc_info=True)
         raise
 
-def check_hash_db(file_path_obj,conn):
-    cursor = conn.cursor()
+def upload_changed_file(file_path_obj, api_key, agent_id, digest=None, file_stat=None):
+    """
+    Ship a changed file to the server. Does not touch the hash db, so it is
+    safe to call from worker threads.
+
+    Returns (status_code, digest, file_stat) where digest and file_stat are what
+    should be stored in the hash db once the server has acknowledged the file.
+    """
+    # The stat is taken before the file is read, so a write that lands
+    # during the upload leaves a mismatched mtime behind for next pass.
+    file_stat = file_stat or os.stat(file_path_obj)
+
+    sha256 = take_known_sha256(file_path_obj, file_stat)
+    if hash_utils.hash_algorithm == 'sha256':
+        sha256 = sha256 or digest
+
+    if digest and sha256 and offers_known_file(file_stat.st_size):
+        if offer_known_file(file_path_obj, api_key, agent_id, sha256, file_stat) == 200:
+            return 200, digest, file_stat
+
+    # When change detection did not already hash the file, hash it
+    # while it is being uploaded instead of reading it a second time.
+    file_hash = hash_utils.new_hash() if digest is None else None
+
+    ret = 404
+    if chunked_upload_utils.use_chunked_upload(file_stat.st_size):
+        upload = chunked_upload_utils.ChunkedUpload(file_path_obj.resolve(), api_key, agent_id)
+        ret = upload.upload(file_hash)
+
+        if ret == 404:
+            logging.warning("Server does not support chunked uploads, uploading the whole file")
+            file_hash = hash_utils.new_hash() if digest is None else None
+
+    if ret == 404 and resumable_upload_utils.use_resumable_upload(file_stat.st_size):
+        upload = resumable_upload_utils.ResumableUpload(file_path_obj.resolve(), api_key, agent_id)
+        ret = upload.upload(file_hash)
+
+        if ret == 404:
+            logging.warning("Server does not support upload sessions, streaming the whole file")
+            file_hash = hash_utils.new_hash() if digest is None else None
+
+    if ret == 404:
+        ret = network_utils.ship_file_to_server(api_key, agent_id, file_path_obj.resolve(), file_hash=file_hash)
+
+    if ret == 200:
+        digest = digest or file_hash.hexdigest()
+
+    return ret, digest, file_stat
+
+def offers_known_file(file_size):
+    """True if a changed file of this size is offered to the server by SHA-256 before it is uploaded"""
+    return 0 < known_file_check_size <= file_size and not chunked_upload_utils.use_chunked_upload(file_size)
+
+def remember_known_sha256(file_path, file_stat, sha256):
+    """Keep the SHA-256 change detection computed for upload_changed_file"""
+    with _known_sha256_lock:
+        _known_sha256s[str(file_path)] = (file_stat.st_size, file_stat.st_mtime_ns, sha256)
+
+def take_known_sha256(file_path, file_stat):
+    """Returns (and forgets) the SHA-256 remembered for the file, or None if there is none or the file changed since"""
+    with _known_sha256_lock:
+        known = _known_sha256s.pop(str(file_path), None)
+
+    if known and known[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+        return known[2]
+
+    return None
+
+def offer_known_file(file_path_obj, api_key, agent_id, sha256, file_stat):
+    """
+    Back up a file by its SHA-256 alone if the server already has the same
+    content (a copy, a renamed file, a reverted change). The file is not read.
+
+    Returns the status code: 200 if nothing needs to be uploaded.
+    """
+    ret = network_utils.backup_known_file(api_key, agent_id, file_path_obj.resolve(), file_stat.st_size, sha256)
+    if ret == 200:
+        logging.info(f"Server already had the content of {file_path_obj}, nothing uploaded")
+
+    return ret
+
+def upload_changed_files_batch(entries, api_key, agent_id):
+    """
+    Batched upload_changed_file: entries is a list of (file_path_obj, digest,
+    file_stat). Returns a (status_code, digest, file_stat) per entry, in order.
+    Falls back to one request per file if the server has no batch endpoint.
+    """
+    entries = [(path, digest, file_stat or os.stat(path)) for path, digest, file_stat in entries]
+    for path, _, file_stat in entries:
+        take_known_sha256(path, file_stat)
+
+    file_hashes = [hash_utils.new_hash() if digest is None else None for _, digest, _ in entries]
+
+    statuses = network_utils.upload_file_batch(
+        api_key,
+        agent_id,
+        [(path.resolve(), file_hash) for (path, _, _), file_hash in zip(entries, file_hashes)]
+    )
+
+    if statuses and all(status == 404 for status in statuses):
+        logging.warning("Server does not support batch uploads, sending files one at a time")
+        return [upload_changed_file(path, api_key, agent_id, digest, file_stat) for path, digest, file_stat in entries]
+
+    results = []
+    for (path, digest, file_stat), file_hash, status in zip(entries, file_hashes, statuses):
+        if status == 200:
+            digest = digest or file_hash.hexdigest()
+        results.append((status, digest, file_stat))
+
+    return results
+
+def check_hash_db(file_path_obj,conn,hash_writer=None):
+    status, _, _ = detect_change(file_path_obj, conn, hash_writer)
+    return status
+
+def detect_change(file_path_obj,conn,hash_writer=None):
+    """
+    Compare a file against the hash db.
+
+    Returns (status, digest, file_stat). digest is only set when the file had to
+    be hashed to reach a decision, and is always made with the configured
+    hash_utils algorithm, so callers can store it instead of reading the file
+    again. file_stat is the stat taken before any read, or None if the file is
+    not in the db.
+    """
     file_path = str(file_path_obj)
 
-    results = is_file_in_db(file_path, cursor)
-    
-    if not results:
+    results = is_file_in_db(file_path, conn.cursor())
+    hash_row = results[0] if results else None
+
+    status, digest, file_stat, refresh_row = compare_with_hash_row(file_path, hash_row)
+
+    if refresh_row:
+        write_hash_row(file_path, digest, file_stat, conn, hash_writer)
+
+    return status, digest, file_stat
+
+def compare_with_hash_row(file_path, hash_row):
+    """
+    The part of detect_change that works on the file only: given the row from
+    is_file_in_db (or None), stat and if necessary hash the file. Does not touch
+    the hash db, so it is safe to call from worker threads.
+
+    Returns (status, digest, file_stat, refresh_row). refresh_row is True when the
+    file was hashed and found unchanged; the caller should then store digest and
+    file_stat so the fast path applies on the next pass.
+    """
+    if not hash_row:
         logging.log(logging.INFO,"Could not find file in hash database.")
-        return BACKUP_STATUS_CHANGE
+        return BACKUP_STATUS_CHANGE, None, None, False
+
+    file_name, digest_from_db, size, mtime_ns, inode, verified_at, db_algorithm = hash_row
+    db_algorithm = db_algorithm or hash_utils.LEGACY_HASH_ALGORITHM
+    logging.log(logging.INFO,"== %s == " % file_name)
+
+    current_stat = os.stat(file_path)
+
+    if stat_matches_db(current_stat, size, mtime_ns, inode, verified_at):
+        logging.log(logging.INFO,"Size, mtime and file id unchanged, skipping hash.")
+        return BACKUP_STATUS_NO_CHANGE, None, current_stat, False
+
+    if size is not None and current_stat.st_size != size:
+        logging.log(logging.INFO,"File size changed (%d -> %d), skipping hash." % (size, current_stat.st_size))
+        return BACKUP_STATUS_CHANGE, None, current_stat, False
 
+    if not hash_utils.is_available(db_algorithm):
+        logging.log(logging.WARNING,"Hash algorithm %s from database is not available, treating file as changed." % db_algorithm)
+        return BACKUP_STATUS_CHANGE, None, current_stat, False
+
+    logging.log(logging.INFO,"Got %s from database: %s" % (db_algorithm, digest_from_db))
+
+    # If the row was made with another algorithm (e.g. legacy MD5), hash with
+    # both in the same read: the old digest answers "did it change?", the new
+    # one replaces it, so rows migrate lazily as files are re-verified.
+    algorithms = list(dict.fromkeys([db_algorithm, hash_utils.hash_algorithm]))
+    if offers_known_file(current_stat.st_size):
+        # For offer_known_file, should the file turn out to have changed
+        algorithms = list(dict.fromkeys(algorithms + ['sha256']))
+
+    current_digests = hash_utils.hash_file(file_path, algorithms)
+    current_digest = current_digests[hash_utils.hash_algorithm]
+    logging.log(logging.INFO,"Got %s hash from file: %s" % (db_algorithm, current_digests[db_algorithm]))
+
+    if digest_from_db == current_digests[db_algorithm]:
+        # Content is the same (e.g. the file was only touched)
+        return BACKUP_STATUS_NO_CHANGE, current_digest, current_stat, True
     else:
-        file_name, md5_from_db = results[0]
-        logging.log(logging.INFO,"== %s == " % file_name)
-        logging.log(logging.INFO,"Got md5 from database: %s" % md5_from_db)
+        if 'sha256' in current_digests:
+            remember_known_sha256(file_path, current_stat, current_digests['sha256'])
+        return BACKUP_STATUS_CHANGE, current_digest, current_stat, False
 
-        current_md5 = get_md5_hash(file_path)
-        logging.log(logging.INFO,"Got md5 hash from file: %s" % current_md5)
+def stat_matches_db(current_stat, size, mtime_ns, inode, verified_at):
+    """
+    Returns True when the hash db entry can be trusted without re-hashing the file.
+    """
+    if change_detection_mode != CHANGE_DETECTION_METADATA:
+        return False
 
-        if md5_from_db == current_md5:
-            return BACKUP_STATUS_NO_CHANGE
-        else:
-            return BACKUP_STATUS_CHANGE
+    # Rows written before the stat columns existed have nothing to compare against.
+    if size is None or mtime_ns is None or verified_at is None:
+        return False
+
+    if paranoid_verify_interval and time.time() - verified_at >= paranoid_verify_interval:
+        logging.log(logging.INFO,"Periodic full verify due, hashing file.")
+        return False
+
+    if mtime_ns / 1e9 >= verified_at - RACY_MTIME_WINDOW_SECONDS:
+        return False
+
+    return (current_stat.st_size == size
+            and current_stat.st_mtime_ns == mtime_ns
+            and current_stat.st_ino == inode)
 
-def update_hash_db(file_path_obj,conn):
-    cursor      = conn.cursor()
+def update_hash_db(file_path_obj,conn,file_stat=None,hash_writer=None,digest=None):
     file_path   = str(file_path_obj)
-    results     = is_file_in_db(file_path, cursor)
-    md5         = get_md5_hash(file_path)
+    file_stat   = file_stat or os.stat(file_path)
+    digest      = digest or hash_utils.hash_file(file_path)[hash_utils.hash_algorithm]
 
-    if not results:
-        insert_into_hash_db(md5, file_path, conn, cursor)
-    else:
-        update_hash_in_db(md5, file_path, conn, cursor)
+    write_hash_row(file_path, digest, file_stat, conn, hash_writer)
 
     logging.log(logging.INFO, "Updated file hash in database.")
 
-def insert_into_hash_db(md5, file_path, conn, cursor):
-    cursor.execute('''INSERT INTO files (file_name, md5) VALUES (?,?)''',(file_path,md5)) 
-    conn.commit()
-
-def update_hash_in_db(md5, file_path, conn, cursor):
-    cursor.execute('''UPDATE files SET md5 = ? WHERE file_name = ?''',(md5,file_path))
-    conn.commit()
+def write_hash_row(file_path, digest, file_stat, conn, hash_writer=None):
+    """Store a digest made with the configured hash_utils algorithm"""
+    if hash_writer:
+        hash_writer.record(file_path, digest, file_stat, hash_utils.hash_algorithm)
+    else:
+        row = client_db_utils.make_hash_row(file_path, digest, file_stat, hash_utils.hash_algorithm)
+        client_db_utils.upsert_hash_rows(conn, [row])
 
 def is_file_in_db(file_path, cursor):
-    cursor.execute('''SELECT file_name,md5 FROM files WHERE file_name = ?;''', (file_path,))
+    cursor.execute('''SELECT file_name,md5,size,mtime_ns,inode,verified_at,hash_algorithm FROM files WHERE file_name = ?;''', (file_path,))
     return cursor.fetchall()
 
 def get_md5_hash(path_to_file):
-    with open(path_to_file, "rb") as f:
-        file_hash = hashlib.md5()
-        while chunk := f.read(8192):
-            file_hash.update(chunk)
-
-    return file_hash.hexdigest()
+    return hash_utils.hash_file(path_to_file, ['md5'])['md5']
     
 def get_server_path(customer_id, device_id, decrypted_path):
     """
@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import os
+
+import network_utils
+
+# C implementation of FastCDC (fastcdc in requirements.txt). The pure Python
+# chunker below holds the GIL and manages only a few MB/s, slower than sending
+# the whole file, so without the extension files are not chunked at all and
+# take the resumable or streamed upload instead. The fastcdc package's own
+# pure Python fallback is no faster, so only the compiled module is used.
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy as fastcdc_ext
+except ImportError:
+    fastcdc_ext = None
+
+ONE_MB = 1024*1024
+
+DEFAULT_CHUNKED_UPLOAD_MB = 32
+
+# FastCDC parameters: chunks average about 1 MB and are never smaller than
+# 256 KB or larger than 4 MB (the server accepts up to 16 MB).
+MIN_CHUNK_SIZE = 256*1024
+AVG_CHUNK_SIZE = 1024*1024
+MAX_CHUNK_SIZE = 4*1024*1024
+
+# Digests per /api/chunks/missing request
+QUERY_BATCH_SIZE = 5000
+
+CHUNK_ATTEMPTS = 3
+
+chunked_upload_threshold = DEFAULT_CHUNKED_UPLOAD_MB * ONE_MB
+
+def configure_chunked_uploads(settings):
+    """Apply CHUNKED_UPLOAD_MB from settings.cfg (0 turns chunked uploads off)"""
+    global chunked_upload_threshold
+
+    chunked_upload_threshold = int(float(settings.get('CHUNKED_UPLOAD_MB', DEFAULT_CHUNKED_UPLOAD_MB)) * ONE_MB)
+
+    if chunked_upload_threshold > 0 and fastcdc_ext is None:
+        logging.warning("fastcdc is not installed, large files are uploaded whole instead of in chunks")
+
+def use_chunked_upload(file_size):
+    return fastcdc_ext is not None and chunked_upload_threshold > 0 and file_size >= chunked_upload_threshold
+
+def _make_gear_table():
+    # Any fixed table of random 64-bit values works, as long as it never
+    # changes: the cut points, and so the chunk digests, depend on it.
+    return [int.from_bytes(hashlib.sha256(b"stormcloud-gear-%d" % i).digest()[:8], "big") for i in range(256)]
+
+GEAR = _make_gear_table()
+
+def _make_mask(bits):
+    # Gear hash bits near the top depend on the last ~64 bytes, the low bits
+    # only on the last few, so the mask is taken from the top of the word.
+    return ((1 << bits) - 1) << (64 - bits)
+
+_AVG_BITS = AVG_CHUNK_SIZE.bit_length() - 1
+
+# Normalized chunking: a harder mask before the average size and an easier
+# one after it pulls chunk sizes in towards the average.
+MASK_S = _make_mask(_AVG_BITS + 2)
+MASK_L = _make_mask(_AVG_BITS - 2)
+
+def find_cut_point(data, start, end):
+    """
+    Returns the offset in data where the chunk starting at start should end
+    (FastCDC). end is the end of the data available; a chunk never runs past it.
+    Its cut points differ from the fastcdc extension's; it is only used when
+    iter_chunks is called without the extension installed.
+    """
+    length = end - start
+    if length <= MIN_CHUNK_SIZE:
+        return end
+
+    if length > MAX_CHUNK_SIZE:
+        end = start + MAX_CHUNK_SIZE
+
+    normal = min(start + AVG_CHUNK_SIZE, end)
+    gear, mask_s, mask_l = GEAR, MASK_S, MASK_L
+    view = memoryview(data)
+    h = 0
+
+    # The first MIN_CHUNK_SIZE bytes can never hold a cut point, so they are skipped
+    for i, byte in enumerate(view[start + MIN_CHUNK_SIZE:normal], start + MIN_CHUNK_SIZE):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        if not h & mask_s:
+            return i + 1
+
+    for i, byte in enumerate(view[normal:end], normal):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        if not h & mask_l:
+            return i + 1
+
+    return end
+
+def iter_chunks(file_path):
+    """
+    Split a file into content-defined chunks, yielding (offset, data) for each.
+    An insert or delete in the middle of a file only changes the chunks around
+    it; every other chunk keeps its data and so its digest.
+    """
+    if fastcdc_ext:
+        with open(file_path, 'rb') as f:
+            for chunk in fastcdc_ext(str(file_path), min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+                f.seek(chunk.offset)
+                yield chunk.offset, f.read(chunk.length)
+        return
+
+    with open(file_path, 'rb') as f:
+        buffer = b""
+        position = 0
+        offset = 0
+        eof = False
+
+        while True:
+            # Keep at least one maximum-size chunk buffered so every cut point is
+            # found the same way no matter where the reads happened to end.
+            if not eof and len(buffer) - position < MAX_CHUNK_SIZE:
+                data = f.read(4 * MAX_CHUNK_SIZE)
+                eof = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            if position >= len(buffer):
+                return
+
+            cut = find_cut_point(buffer, position, len(buffer))
+            yield offset, buffer[position:cut]
+
+            offset += cut - position
+            position = cut
+
+class ChunkedUpload:
+    """
+    Uploads a file as content-defined chunks to the server's chunk store.
+
+    The file is chunked and each chunk hashed (SHA-256), the server is asked
+    which of those chunks it does not have, and only those are sent. Then the
+    file is committed as its list of chunks, which the server rebuilds it from.
+    A changed 10 GB mailbox usually only sends the few chunks around the change,
+    and an interrupted upload picks up where it stopped since chunks that
+    arrived are not asked for again.
+    """
+
+    def __init__(self, file_path, api_key, agent_id):
+        self.file_path = str(file_path)
+        self.api_key = api_key
+        self.agent_id = agent_id
+        self.bytes_sent = 0
+
+    def upload(self, file_hash=None):
+        """
+        Upload the file. file_hash (a hashlib object) is updated with the whole file.
+        Returns an HTTP-style status code: 200 once the server has stored the
+        file, 404 if the server has no chunk store.
+        """
+        file_stat = os.stat(self.file_path)
+
+        chunks = []   # (offset, length, sha256)
+        for offset, data in iter_chunks(self.file_path):
+            if file_hash:
+                file_hash.update(data)
+            chunks.append((offset, len(data), hashlib.sha256(data).hexdigest()))
+
+        status, missing = self._find_missing([digest for _, _, digest in chunks])
+        if status != 200:
+            return status
+
+        logging.info("Uploading %s: %d of %d chunks are new" % (self.file_path, len(missing), len(chunks)))
+
+        for attempt in range(2):
+            status = self._send_chunks([chunk for chunk in chunks if chunk[2] in missing])
+            if status != 200:
+                return status
+
+            current_stat = os.stat(self.file_path)
+            if (current_stat.st_size, current_stat.st_mtime_ns) != (file_stat.st_size, file_stat.st_mtime_ns):
+                logging.warning("%s changed during upload, will back it up again next pass" % self.file_path)
+                return 409
+
+            status, response = network_utils.commit_chunked_file(
+                self.api_key, self.agent_id, self.file_path, file_stat.st_size,
+                ",".join("%s:%d" % (digest, length) for _, length, digest in chunks)
+            )
+
+            # 409: chunks were removed from the store since they were asked about
+            if status != 409 or not response:
+                return status
+
+            missing = set(response.get('missing', []))
+
+        return status
+
+    def _find_missing(self, digests):
+        unique_digests = list(dict.fromkeys(digests))
+        missing = set()
+
+        for start in range(0, len(unique_digests), QUERY_BATCH_SIZE):
+            status, response = network_utils.find_missing_chunks(
+                self.api_key, self.agent_id, unique_digests[start:start + QUERY_BATCH_SIZE]
+            )
+            if status != 200:
+                return status, None
+
+            missing.update(response['missing'])
+
+        return 200, missing
+
+    def _send_chunks(self, chunks):
+        sent = set()
+
+        with open(self.file_path, 'rb') as f:
+            for offset, length, digest in chunks:
+                if digest in sent:
+                    continue
+
+                f.seek(offset)
+                data = f.read(length)
+
+                if hashlib.sha256(data).hexdigest() != digest:
+                    logging.warning("%s changed during upload, will back it up again next pass" % self.file_path)
+                    return 409
+
+                status = self._put_chunk(digest, data)
+                if status != 200:
+                    logging.error("Giving up on %s (chunk status %d), sent chunks are kept for next time" % (self.file_path, status))
+                    return status
+
+                sent.add(digest)
+                self.bytes_sent += length
+
+        return 200
+
+    def _put_chunk(self, digest, data):
+        for attempt in range(CHUNK_ATTEMPTS):
+            status = network_utils.upload_content_chunk(self.api_key, self.agent_id, digest, data)
+            if status in (200, 401, 404):
+                return status
+
+            logging.warning("Chunk %s of %s failed with status %d (attempt %d)" % (digest, self.file_path, status, attempt + 1))
+
+        return status
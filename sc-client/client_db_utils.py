@@ -1,6 +1,96 @@
 import logging
 import os
 import sqlite3
+import threading
+import time
+
+# Columns added to the files table after the original (file_id, file_name, md5) layout.
+# Existing hash databases are brought up to date by _migrate_hash_db when opened.
+# The md5 column keeps its name but holds a digest made with hash_algorithm;
+# NULL means MD5 (rows written before the algorithm was recorded).
+HASH_DB_ADDED_COLUMNS = [
+    ('size', 'INTEGER'),
+    ('mtime_ns', 'INTEGER'),
+    ('inode', 'INTEGER'),
+    ('verified_at', 'REAL'),
+    ('hash_algorithm', 'TEXT')
+]
+
+UPSERT_HASH_ROW_SQL = '''
+    INSERT INTO files (file_name, md5, size, mtime_ns, inode, verified_at, hash_algorithm) VALUES (?,?,?,?,?,?,?)
+    ON CONFLICT(file_name) DO UPDATE SET
+        md5 = excluded.md5,
+        size = excluded.size,
+        mtime_ns = excluded.mtime_ns,
+        inode = excluded.inode,
+        verified_at = excluded.verified_at,
+        hash_algorithm = excluded.hash_algorithm
+'''
+
+class HashDBWriter:
+    """
+    Collects hash db updates and writes them in bulk transactions.
+
+    Rows are queued only after the server has acknowledged a file, so anything
+    still pending when the process dies is simply seen as changed on the next
+    pass and backed up again. The database never claims a file that the server
+    does not have.
+    """
+
+    def __init__(self, conn, flush_count=500, flush_interval=5.0):
+        self.conn = conn
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self._pending = {}   # file_name -> row, so repeated updates to one file collapse
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+        return False
+
+    def record(self, file_path, digest, file_stat, hash_algorithm='md5'):
+        """Queue the hash and stat of a file, flushing if a threshold was reached"""
+        row = make_hash_row(file_path, digest, file_stat, hash_algorithm)
+
+        with self._lock:
+            self._pending[row[0]] = row
+            due = (len(self._pending) >= self.flush_count or
+                   time.monotonic() - self._last_flush >= self.flush_interval)
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write every pending row in a single transaction. Returns the number of rows written."""
+        with self._lock:
+            rows = list(self._pending.values())
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+
+            if not rows:
+                return 0
+
+            try:
+                upsert_hash_rows(self.conn, rows)
+            except sqlite3.Error:
+                # Put the rows back (without clobbering anything newer) so a later flush can retry.
+                for row in rows:
+                    self._pending.setdefault(row[0], row)
+                raise
+
+        logging.log(logging.INFO,"Flushed %d hash db updates." % len(rows))
+        return len(rows)
+
+def make_hash_row(file_path, digest, file_stat, hash_algorithm='md5'):
+    return (str(file_path), digest, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, time.time(), hash_algorithm)
+
+def upsert_hash_rows(conn, rows):
+    with conn:
+        conn.executemany(UPSERT_HASH_ROW_SQL, rows)
 
 def get_or_create_hash_db(hash_db_file_path):
     if not _hash_db_exists(hash_db_file_path):
@@ -15,16 +105,50 @@ def _hash_db_exists(path_to_file):
 def _create_hash_db(path_to_file):
     logging.log(logging.INFO,"creating new hash db")
 
-    conn = sqlite3.connect(path_to_file) 
+    conn = sqlite3.connect(path_to_file)
+    _configure_hash_db(conn)
     c = conn.cursor()
 
     c.execute('''
           CREATE TABLE IF NOT EXISTS files
-          ([file_id] INTEGER PRIMARY KEY, [file_name] TEXT, [md5] TEXT)
+          ([file_id] INTEGER PRIMARY KEY, [file_name] TEXT, [md5] TEXT,
+           [size] INTEGER, [mtime_ns] INTEGER, [inode] INTEGER, [verified_at] REAL,
+           [hash_algorithm] TEXT)
           ''')
 
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_files_file_name ON files (file_name)''')
+
     conn.commit()
     return conn
 
 def _get_hash_db(path_to_file):
-    return sqlite3.connect(path_to_file)
\ No newline at end of file
+    conn = sqlite3.connect(path_to_file)
+    _configure_hash_db(conn)
+    _migrate_hash_db(conn)
+    return conn
+
+def _configure_hash_db(conn):
+    # WAL lets a bulk flush commit with a single fsync of the log instead of
+    # rewriting pages in place; NORMAL sync is safe (never corrupt) in WAL mode.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+def _migrate_hash_db(conn):
+    existing_columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+
+    for column_name, column_type in HASH_DB_ADDED_COLUMNS:
+        if column_name not in existing_columns:
+            logging.log(logging.INFO,"adding column %s to hash db" % column_name)
+            conn.execute("ALTER TABLE files ADD COLUMN [%s] %s" % (column_name, column_type))
+
+    existing_indexes = [row[1] for row in conn.execute("PRAGMA index_list(files)")]
+
+    if 'idx_files_file_name' not in existing_indexes:
+        logging.log(logging.INFO,"adding unique file_name index to hash db")
+
+        # Older databases could hold more than one row per file; keep the newest.
+        conn.execute('''DELETE FROM files WHERE file_id NOT IN
+                        (SELECT MAX(file_id) FROM files GROUP BY file_name)''')
+        conn.execute('''CREATE UNIQUE INDEX idx_files_file_name ON files (file_name)''')
+
+    conn.commit()
@@ -7,8 +7,37 @@ import restore_utils
 
 from win10toast import ToastNotifier
 
+# How long each /api/keepalive-wait request asks the server to hold on to it
+LONG_POLL_SECONDS = 50
+
 def execute_ping_loop(interval,api_key,agent_id):
+    """
+    Keep the server informed that this agent is alive and run restores it
+    queues. Uses a long-poll, so restores start as soon as they are queued;
+    against a server without /api/keepalive-wait it falls back to sending a
+    keepalive every interval seconds.
+    """
+    long_poll = True
+
     while True:
+        if long_poll:
+            logging.log(logging.INFO,"Waiting on keepalive from server")
+            status_code, response_data = scnet.wait_for_keepalive(api_key, agent_id, LONG_POLL_SECONDS)
+
+            if status_code in (404, 405):
+                logging.log(logging.INFO,"Server has no long-poll keepalive, polling every %d seconds" % interval)
+                long_poll = False
+                continue
+
+            # Wait again at once, unless the server is unreachable or a restore
+            # failed or was not confirmed: the server would answer at once with
+            # the same restore queue.
+            if status_code == 200 and process_keepalive_response(response_data, api_key, agent_id):
+                continue
+
+            sleep(interval)
+            continue
+
         logging.log(logging.INFO,"Sending keepalive to server")
         keepalive_request_data = json.dumps({
             'request_type': 'keepalive',
@@ -23,26 +52,38 @@ def execute_ping_loop(interval,api_key,agent_id):
         )
 
         if response_data:
-            if 'restore_queue' in response_data:
-                restore_queue = response_data['restore_queue']
-                if restore_queue:
-                    for file_name in restore_queue:
-                        if restore_utils.restore_file(file_name, api_key, agent_id):
-                            logging.log(logging.INFO, "Successfully restored file! Wrote to: %s" % file_name)
-                        else:
-                            logging.log(logging.WARNING, "Failed to restore file: Attempted: %s" % file_name)
-                    
-                    try:
-                        toaster = ToastNotifier()
-                        toaster.show_toast("Stormcloud restore complete",
-                            "Finished restoring %d files!" % len(restore_queue),
-                            duration=10,
-                            icon_path=""
-                        )
-                    except:
-                        logging.log(logging.INFO, "Failed to display toast notification to user upon successful restore.")
-
-            else:
-                logging.log(logging.WARNING, "Got keepalive response from server that appeared to be malformed.")
-
-        sleep(interval)
\ No newline at end of file
+            process_keepalive_response(response_data, api_key, agent_id)
+
+        sleep(interval)
+
+def process_keepalive_response(response_data, api_key, agent_id):
+    """Restore the files in a keepalive response's restore_queue. Returns False if any restore failed or was not confirmed."""
+    if not response_data or 'restore_queue' not in response_data:
+        logging.log(logging.WARNING, "Got keepalive response from server that appeared to be malformed.")
+        return False
+
+    restore_queue = response_data['restore_queue']
+    if not restore_queue:
+        return True
+
+    all_restored = True
+    for file_name in restore_queue:
+        restored, confirmed = restore_utils.restore_queued_file(file_name, api_key, agent_id)
+        if restored:
+            logging.log(logging.INFO, "Successfully restored file! Wrote to: %s" % file_name)
+        else:
+            logging.log(logging.WARNING, "Failed to restore file: Attempted: %s" % file_name)
+
+        all_restored = all_restored and confirmed
+
+    try:
+        toaster = ToastNotifier()
+        toaster.show_toast("Stormcloud restore complete",
+            "Finished restoring %d files!" % len(restore_queue),
+            duration=10,
+            icon_path=""
+        )
+    except:
+        logging.log(logging.INFO, "Failed to display toast notification to user upon successful restore.")
+
+    return all_restored
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import posixpath
+import sqlite3
+
+import network_utils
+
+# Local copy of the server's list of this device's backed up files, kept in
+# sync with /api/file-metadata-changes: the first sync downloads every record,
+# later ones only the records changed since the cursor the server handed out
+# last time, so a backup pass that changed nothing costs a few bytes. The
+# records arrive as a stream of JSON lines and are written as they are read,
+# WRITE_BATCH at a time, all in one transaction that only commits once the
+# server's end line arrives; an interrupted sync changes nothing.
+#
+#   files  one row per file, keyed by its posix path on this device, with the
+#          directory it is in (indexed) and the record as the server sent it
+#   meta   the sync cursor and the device's fields, which the server sends
+#          once rather than on every record
+#
+# This is the client's only copy of the manifest: the file explorer and the
+# restore worker read a directory, or every file under a path, from it
+# rather than loading every record. It replaced timestamped JSON snapshots
+# (file_metadata_<timestamp>.json), which remove_legacy_snapshots deletes.
+MANIFEST_DB_NAME = "manifest.db"
+
+# Bumped when the files table changes; an older table is dropped and the
+# next sync downloads a full snapshot into the new one
+SCHEMA_VERSION = 2
+
+WRITE_BATCH = 1000
+
+LEGACY_SNAPSHOT_PREFIX = "file_metadata_"
+
+# Sorts after any path that starts with a given prefix
+_PREFIX_END = "\U0010ffff"
+
+class ManifestStore:
+    def __init__(self, manifest_dir):
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.path = os.path.join(manifest_dir, MANIFEST_DB_NAME)
+
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)''')
+
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self.conn.execute('''DROP TABLE IF EXISTS files''')
+                self.conn.execute('''DELETE FROM meta WHERE key = 'cursor' ''')
+                self.conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, record TEXT NOT NULL)''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS idx_files_directory ON files (directory, path)''')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute('''SELECT value FROM meta WHERE key = ?''', (key,)).fetchone()
+        return row[0] if row else default
+
+    def get_cursor(self):
+        return self._get_meta('cursor', '')
+
+    def count(self):
+        return self.conn.execute('''SELECT COUNT(*) FROM files''').fetchone()[0]
+
+    def apply_stream(self, lines):
+        """
+        Apply a /api/file-metadata-changes stream, an iterable of JSON lines.
+        A full snapshot replaces every record. Returns the number of records
+        written, or None (having changed nothing) if the stream ended early
+        or was an empty snapshot for a manifest that has records.
+        """
+        lines = (line for line in lines if line)
+        header = json.loads(next(lines, b'{}'))
+        if 'cursor' not in header:
+            return None
+
+        had_records = self.count() > 0
+        count = 0
+        batch = []
+
+        try:
+            if header['full']:
+                self.conn.execute('''DELETE FROM files''')
+                self.conn.execute('''INSERT OR REPLACE INTO meta (key, value) VALUES ('device', ?)''',
+                                  (json.dumps(header.get('device', {})),))
+
+            for line in lines:
+                record = json.loads(line)
+
+                if record.get('end'):
+                    # An empty snapshot is what a failed query on the server
+                    # looks like too; keep what we have rather than wiping it
+                    if header['full'] and count == 0 and had_records:
+                        logging.warning("Server sent an empty file metadata snapshot, keeping the local manifest")
+                        break
+
+                    self._write_records(batch)
+                    self.conn.execute('''INSERT OR REPLACE INTO meta (key, value) VALUES ('cursor', ?)''', (header['cursor'],))
+                    self.conn.commit()
+                    return count
+
+                batch.append(record)
+                count += 1
+
+                if len(batch) >= WRITE_BATCH:
+                    self._write_records(batch)
+                    batch = []
+
+            else:
+                logging.warning(f"File metadata stream ended after {count} records without its end line")
+
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        self.conn.rollback()
+        return None
+
+    def replace_records(self, records):
+        """
+        Replace every record with records, a full list as /api/file-metadata
+        returns it; for servers without /api/file-metadata-changes
+        """
+        with self.conn:
+            self.conn.execute('''DELETE FROM files''')
+            self._write_records(records)
+
+    def _write_records(self, records):
+        self.conn.executemany('''INSERT OR REPLACE INTO files (path, directory, record) VALUES (?, ?, ?)''', [
+            (record['ClientFullNameAndPathAsPosix'], posixpath.dirname(record['ClientFullNameAndPathAsPosix']), json.dumps(record))
+            for record in records
+        ])
+
+    def _read_records(self, cursor):
+        device = json.loads(self._get_meta('device', '{}'))
+
+        for (record,) in cursor:
+            record = json.loads(record)
+            record.update(device)
+            yield record
+
+    def records(self):
+        """Every record, in path order, with the device's fields filled in as /api/file-metadata has them"""
+        return self._read_records(self.conn.execute('''SELECT record FROM files ORDER BY path'''))
+
+    def get(self, path):
+        """The record of the file at posix path, or None"""
+        return next(self._read_records(self.conn.execute('''SELECT record FROM files WHERE path = ?''', (path,))), None)
+
+    def directories(self):
+        """Every directory that directly holds a file, in order"""
+        return [directory for (directory,) in self.conn.execute('''SELECT DISTINCT directory FROM files ORDER BY directory''')]
+
+    def list_directory(self, directory):
+        """Records of the files directly in directory (a posix path without a trailing slash), in path order"""
+        return self._read_records(self.conn.execute(
+            '''SELECT record FROM files WHERE directory = ? ORDER BY path''', (directory.rstrip('/'),)))
+
+    def records_under(self, prefix):
+        """Records of the files whose path starts with prefix, in path order"""
+        return self._read_records(self.conn.execute(
+            '''SELECT record FROM files WHERE path >= ? AND path < ? ORDER BY path''', (prefix, prefix + _PREFIX_END)))
+
+def remove_legacy_snapshots(manifest_dir):
+    """Delete the file_metadata_<timestamp>.json snapshots older clients kept in manifest_dir"""
+    for name in os.listdir(manifest_dir):
+        if name.startswith(LEGACY_SNAPSHOT_PREFIX) and name.endswith('.json'):
+            try:
+                os.remove(os.path.join(manifest_dir, name))
+                logging.info(f"Removed old metadata file: {name}")
+            except OSError as e:
+                logging.error(f"Failed to remove old metadata file {name}: {e}")
+
+def sync_manifest(api_key, agent_id, manifest_dir):
+    """
+    Bring the manifest in manifest_dir up to date with the server.
+
+    Returns the number of records that changed, or None if the sync failed
+    or the server has no /api/file-metadata-changes.
+    """
+    with ManifestStore(manifest_dir) as store:
+        response = network_utils.open_file_metadata_changes(api_key, agent_id, store.get_cursor())
+        if response is None:
+            return None
+
+        with response:
+            if response.status_code != 200 or 'application/x-ndjson' not in response.headers.get('Content-Type', ''):
+                logging.error(f"File metadata sync failed with status {response.status_code}")
+                return None
+
+            try:
+                changed = store.apply_stream(response.iter_lines(chunk_size=64*1024))
+            except Exception as e:
+                logging.error(f"File metadata sync failed: {e}")
+                return None
+
+        if changed is not None:
+            logging.info(f"Manifest synced: {changed} changed records, {store.count()} total")
+
+        return changed
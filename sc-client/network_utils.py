@@ -1,26 +1,196 @@
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.poolmanager import PoolKey
+from urllib3.util.retry import Retry
 
 import os
 import logging
 import base64
+import contextlib
+import threading
 
 SERVER_NAME="www2.darkage.io"
 SERVER_PORT=8443
 
 API_ENDPOINT_BACKUP_FILE             = 'https://%s:%d/api/backup-file'             % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_BACKUP_FILE_STREAM      = 'https://%s:%d/api/backup-file-stream'      % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_BACKUP_FILES_BATCH      = 'https://%s:%d/api/backup-files-batch'      % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_BACKUP_KNOWN_FILE       = 'https://%s:%d/api/backup-known-file'       % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_UPLOAD_SESSION_CREATE   = 'https://%s:%d/api/upload-session/create'   % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_UPLOAD_SESSION_CHUNK    = 'https://%s:%d/api/upload-session/chunk'    % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_UPLOAD_SESSION_STATUS   = 'https://%s:%d/api/upload-session/status'   % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_UPLOAD_SESSION_COMMIT   = 'https://%s:%d/api/upload-session/commit'   % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_CHUNKS_MISSING          = 'https://%s:%d/api/chunks/missing'          % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_CHUNKS_UPLOAD           = 'https://%s:%d/api/chunks/upload'           % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_CHUNKS_COMMIT_FILE      = 'https://%s:%d/api/chunks/commit-file'      % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_KEEPALIVE               = 'https://%s:%d/api/keepalive'               % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_KEEPALIVE_WAIT          = 'https://%s:%d/api/keepalive-wait'          % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_RESTORE_FILE            = 'https://%s:%d/api/restore-file'            % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_FILE_VERSIONS           = 'https://%s:%d/api/file-versions'           % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_RESTORE_FILE_STREAM     = 'https://%s:%d/api/restore-file-stream'     % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_RESTORE_FILES_ARCHIVE   = 'https://%s:%d/api/restore-files-archive'   % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_RESTORE_COMPLETE        = 'https://%s:%d/api/restore-complete'        % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_REGISTER_BACKUP_FOLDERS = 'https://%s:%d/api/register-backup-folders' % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_FILE_METADATA           = 'https://%s:%d/api/file-metadata'           % (SERVER_NAME,SERVER_PORT)
+API_ENDPOINT_FILE_METADATA_CHANGES   = 'https://%s:%d/api/file-metadata-changes'   % (SERVER_NAME,SERVER_PORT)
 # API_ENDPOINT_AUTHENTICATE            = 'https://%s:%d/api/validate-api-key'        % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_LOGIN                   = 'https://%s:%d/api/login'                   % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_SUMMARIZE_FILE          = 'https://%s:%d/api/summarize-file'          % (SERVER_NAME,SERVER_PORT)
 API_ENDPOINT_SUBMIT_ERROR_LOG        = 'https://%s:%d/api/submit-error-log'        % (SERVER_NAME,SERVER_PORT)
 
+# Shared HTTP session. Every call in this module goes through get_session() so
+# that connections (and their TLS sessions) are kept alive and reused instead
+# of paying a fresh TCP + TLS handshake per request.
+DEFAULT_HTTP_POOL_SIZE       = 10    # keep >= BACKUP_UPLOAD_WORKERS
+DEFAULT_HTTP_MAX_RETRIES     = 3
+DEFAULT_HTTP_BACKOFF_SECONDS = 0.5
+DEFAULT_HTTP_CONNECT_TIMEOUT = 10
+DEFAULT_HTTP_READ_TIMEOUT    = 300
+
+# Request bodies are read from disk and written to the socket this many bytes
+# at a time (urllib3 2.x otherwise uses 16 KiB; urllib3 < 2 has no blocksize and
+# always sends http.client's 8 KiB blocks). Peak memory per upload is about one
+# buffer, so a parallel backup needs roughly upload workers x this size.
+UPLOAD_BUFFER_SIZE = 1024*1024
+
+# Idempotent requests are also retried on these; POSTs only on connection errors.
+RETRY_STATUS_CODES = [502, 503, 504]
+
+_session = None
+_session_lock = threading.Lock()
+_session_config = {
+    'pool_size': DEFAULT_HTTP_POOL_SIZE,
+    'max_retries': DEFAULT_HTTP_MAX_RETRIES,
+    'backoff_seconds': DEFAULT_HTTP_BACKOFF_SECONDS,
+    'connect_timeout': DEFAULT_HTTP_CONNECT_TIMEOUT,
+    'read_timeout': DEFAULT_HTTP_READ_TIMEOUT
+}
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts requests so connection reuse can be measured"""
+
+    def __init__(self, *args, **kwargs):
+        self.requests_sent = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if _urllib3_supports_blocksize():
+            kwargs.setdefault('blocksize', UPLOAD_BUFFER_SIZE)
+        super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        with self._count_lock:
+            self.requests_sent += 1
+        return super().send(request, **kwargs)
+
+    def connections_opened(self):
+        # Each urllib3 pool counts the connections it had to open; everything
+        # else was served from a kept-alive connection.
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()))
+
+def _urllib3_supports_blocksize():
+    # urllib3 < 2 has no blocksize setting and always sends in 8 KiB blocks.
+    return 'key_blocksize' in PoolKey._fields
+
+def configure_session(settings):
+    """
+    Apply HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_SECONDS,
+    HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT from settings.cfg. The session
+    is only rebuilt if something changed, so idle connections survive.
+    """
+    global _session
+
+    new_config = {
+        'pool_size': int(settings.get('HTTP_POOL_SIZE', DEFAULT_HTTP_POOL_SIZE)),
+        'max_retries': int(settings.get('HTTP_MAX_RETRIES', DEFAULT_HTTP_MAX_RETRIES)),
+        'backoff_seconds': float(settings.get('HTTP_BACKOFF_SECONDS', DEFAULT_HTTP_BACKOFF_SECONDS)),
+        'connect_timeout': float(settings.get('HTTP_CONNECT_TIMEOUT', DEFAULT_HTTP_CONNECT_TIMEOUT)),
+        'read_timeout': float(settings.get('HTTP_READ_TIMEOUT', DEFAULT_HTTP_READ_TIMEOUT))
+    }
+
+    with _session_lock:
+        if new_config == _session_config:
+            return
+
+        _session_config.update(new_config)
+        if _session:
+            _session.close()
+            _session = None
+
+    logging.info("HTTP session configuration updated: %s" % new_config)
+
+def get_session():
+    """Returns the shared requests.Session, creating it on first use"""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = _create_session(_session_config)
+        return _session
+
+def _create_session(config):
+    retry = Retry(
+        total=config['max_retries'],
+        connect=config['max_retries'],
+        read=config['max_retries'],
+        status=config['max_retries'],
+        backoff_factor=config['backoff_seconds'],
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False
+    )
+
+    adapter = CountingHTTPAdapter(
+        pool_connections=config['pool_size'],
+        pool_maxsize=config['pool_size'],
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    logging.info("Created HTTP session (pool size %d, %d retries)" % (config['pool_size'], config['max_retries']))
+    return session
+
+def get_timeout():
+    """(connect, read) timeout to pass to every request"""
+    return (_session_config['connect_timeout'], _session_config['read_timeout'])
+
+def get_connection_stats():
+    """
+    Requests sent and connections opened by the shared session since it was
+    created. reused = requests that did not need a new TCP/TLS connection.
+    """
+    with _session_lock:
+        session = _session
+
+    adapter = session.get_adapter('https://') if session else None
+    if not isinstance(adapter, CountingHTTPAdapter):
+        return {'requests': 0, 'connections_opened': 0, 'reused': 0, 'reuse_ratio': 0.0}
+
+    requests_sent = adapter.requests_sent
+    connections_opened = adapter.connections_opened()
+    reused = max(0, requests_sent - connections_opened)
+
+    return {
+        'requests': requests_sent,
+        'connections_opened': connections_opened,
+        'reused': reused,
+        'reuse_ratio': reused / requests_sent if requests_sent else 0.0
+    }
+
 def fetch_file_metadata(api_key, agent_id):
+    """
+    Every file record of the device, as one list; None if the request failed.
+    Only used when manifest_utils.sync_manifest cannot be: mostly servers
+    without /api/file-metadata-changes, which build the whole document in
+    memory and send it in one piece, so parsing it incrementally would save
+    little. Kept simple for that reason.
+    """
     url = API_ENDPOINT_FILE_METADATA
     headers = {'Content-Type': 'application/json'}
     data = {
@@ -29,16 +199,58 @@ def fetch_file_metadata(api_key, agent_id):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = get_session().post(url, headers=headers, json=data, timeout=get_timeout())
         response.raise_for_status()
-        logging.info("Received %d records from fetch_file_metadata" % len(response.json()['data']))
-        return response.json()['data']
+        metadata = response.json()['data']
+        logging.info("Received %d records from fetch_file_metadata" % len(metadata))
+        return metadata
     except requests.RequestException as e:
         logging.error(f"Error fetching file metadata: {e}")
         return None
 
+def open_file_metadata_changes(api_key, agent_id, cursor):
+    """
+    Request the device's file records changed since cursor (all of them for
+    an empty cursor), see manifest_utils. The server streams them as
+    newline delimited JSON, gzip compressed on the wire.
+
+    Returns the streaming response (the caller reads it, e.g. with
+    iter_lines, and closes it), or None if there was no response.
+    """
+    data = {
+        'request_type': "file_metadata_changes",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'cursor': cursor
+    }
+
+    try:
+        return get_session().post(API_ENDPOINT_FILE_METADATA_CHANGES, headers={'Content-Type': 'application/json'},
+                                  json=data, stream=True, timeout=get_timeout())
+    except Exception as e:
+        logging.log(logging.ERROR, "File metadata changes request failed: %s" % e)
+        return None
+
+def fetch_file_versions(api_key, agent_id, path):
+    """
+    Returns the stored versions of a backed up file, newest first, as dicts
+    with version_id, sha256, file_size and created; None if the request failed.
+    A version_id can be passed to restore_utils.restore_file.
+    """
+    status, response = _post_json(API_ENDPOINT_FILE_VERSIONS, {
+        'request_type': "file_versions",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'file_path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8')
+    })
+
+    if status != 200 or not response:
+        logging.error("Failed to fetch file versions for %s: %s" % (path, status))
+        return None
+
+    return response['versions']
+
 ONE_MB = 1024*1024
-THRESHOLD_MB = 200
 CHUNK_SIZE = ONE_MB
 
 def authenticate_user(email: str, password: str, settings_path: str) -> dict:
@@ -58,7 +270,7 @@ def authenticate_user(email: str, password: str, settings_path: str) -> dict:
         
         logging.info(f"Making authentication request to: {url}")
         
-        response = requests.post(url, headers=headers, json=data)
+        response = get_session().post(url, headers=headers, json=data, timeout=get_timeout())
         logging.info(f"Response status code: {response.status_code}")
         
         if response.status_code == 200:
@@ -85,56 +297,83 @@ def authenticate_user(email: str, password: str, settings_path: str) -> dict:
         logging.error(f"Exception details: {traceback.format_exc()}")
         raise
 
-def ship_file_to_server(api_key,agent_id,path):
-    size = os.path.getsize(path)
+class HashingFileReader:
+    """
+    Read-through wrapper around an open file that feeds every byte handed to
+    the uploader into a hashlib object, so the digest of exactly what was sent
+    is known without reading the file again.
+    """
 
-    logging.log(logging.INFO,dump_file_info(path,size))
+    def __init__(self, file_obj, file_hash):
+        self._file = file_obj
+        self._file_hash = file_hash
 
-    if size > THRESHOLD_MB * ONE_MB:
-        logging.log(logging.INFO, "File size over %dMB, using MultipartEncoder" % THRESHOLD_MB)
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._file_hash.update(data)
+        return data
 
-        ret = stream_upload_file(
-            api_key,
-            agent_id,
-            path
-        )
+    def fileno(self):
+        return self._file.fileno()
 
-    else:
-        ret = upload_file(
-            api_key,
-            agent_id,
-            path
-        )
+    def tell(self):
+        return self._file.tell()
+
+def ship_file_to_server(api_key,agent_id,path,file_hash=None):
+    """
+    Upload a file to the server. If file_hash (a hashlib object) is given,
+    it is updated with the file content as it is sent.
+
+    Every file is streamed from disk, whatever its size, so memory use per
+    upload is bounded by UPLOAD_BUFFER_SIZE rather than by the file.
+    """
+    size = os.path.getsize(path)
+
+    logging.log(logging.INFO,dump_file_info(path,size))
+
+    ret = stream_upload_file(
+        api_key,
+        agent_id,
+        path,
+        file_hash
+    )
 
     #crypto_utils.remove_temp_file(unencrypted_path_to_encrypted_file)
     return ret
 
-def stream_upload_file(api_key,agent_id,local_file_path):
+def stream_upload_file(api_key,agent_id,local_file_path,file_hash=None):
     url = API_ENDPOINT_BACKUP_FILE_STREAM
     response = None
 
-    fields_dict = {
-        'request_type': "backup_file",
-        'api_key': api_key,
-        'agent_id': agent_id,
+    with open(local_file_path, 'rb') as file_obj:
+        file_content = HashingFileReader(file_obj, file_hash) if file_hash else file_obj
 
-        # WindowsPath obj -> str -> encode UTF-8 to convert to bytes -> base64 encode -> utf-8 decode -> serialize as JSON
-        'file_path': base64.b64encode(str(local_file_path).encode("utf-8")).decode('utf-8'),
+        fields_dict = {
+            'request_type': "backup_file",
+            'api_key': api_key,
+            'agent_id': agent_id,
 
-        # must provide 'filename' parameter in order for flask to properly interpret this as a file
-        'file_content': ('filename', open(local_file_path, 'rb'), 'application/octet-stream')
-    }
+            # WindowsPath obj -> str -> encode UTF-8 to convert to bytes -> base64 encode -> utf-8 decode -> serialize as JSON
+            'file_path': base64.b64encode(str(local_file_path).encode("utf-8")).decode('utf-8'),
 
-    enc = MultipartEncoder(fields=fields_dict)
-    
-    try:
-        response = requests.post(url, data=enc, headers={'Content-Type': enc.content_type})
-    except Exception as e:
-        logging.log(logging.ERROR, "Got exception when trying to post MultipartEncoded file: %s" % e)
-    finally:
-        return response.status_code if response else 500
+            # must provide 'filename' parameter in order for flask to properly interpret this as a file
+            'file_content': ('filename', file_content, 'application/octet-stream')
+        }
 
-def upload_file(api_key,agent_id,local_file_path):
+        enc = MultipartEncoder(fields=fields_dict)
+        
+        try:
+            response = get_session().post(url, data=enc, headers={'Content-Type': enc.content_type}, timeout=get_timeout())
+        except Exception as e:
+            logging.log(logging.ERROR, "Got exception when trying to post MultipartEncoded file: %s" % e)
+
+    return response.status_code if response is not None else 500
+
+def upload_file(api_key,agent_id,local_file_path,file_hash=None):
+    """
+    Upload to /api/backup-file, with the request fields as a JSON part. Like
+    stream_upload_file, the file is streamed rather than read into memory.
+    """
     url = API_ENDPOINT_BACKUP_FILE
     response = None
 
@@ -147,23 +386,180 @@ def upload_file(api_key,agent_id,local_file_path):
         'file_path': base64.b64encode(str(local_file_path).encode("utf-8")).decode('utf-8')
     })
 
-    # Since we're not streaming here, read the whole file into memory before sending.
-    content = open(local_file_path, 'rb').read()
+    with open(local_file_path, 'rb') as file_obj:
+        file_content = HashingFileReader(file_obj, file_hash) if file_hash else file_obj
+
+        # Including JSON object as a separate part of the multipart body
+        # Because I cannot include both separately in a single multipart/form-data request.
+        # See https://stackoverflow.com/questions/35939761/how-to-send-json-as-part-of-multipart-post-request
+        enc = MultipartEncoder(fields={
+            'file_content': ('filename', file_content, 'application/octet-stream'),
+            'json': (None, json_data, 'application/json')
+        })
+
+        try:
+            response = get_session().post(url, data=enc, headers={'Content-Type': enc.content_type}, timeout=get_timeout())
+        except Exception as e:
+            logging.log(logging.ERROR, "Got exception when trying to post file: %s" % e)
+
+    return response.status_code if response is not None else 500
+
+def upload_file_batch(api_key,agent_id,entries):
+    """
+    Upload many small files in one streamed multipart request.
+
+    entries is a list of (path, file_hash) where file_hash is a hashlib object
+    to update with the file content as it is sent, or None. Returns a status
+    code per entry, in order. If the whole request fails, every entry gets the
+    request's status code (500 if no response at all).
+    """
+    url = API_ENDPOINT_BACKUP_FILES_BATCH
+    response = None
+
+    fields = [
+        ('request_type', "backup_files_batch"),
+        ('api_key', api_key),
+        ('agent_id', agent_id),
+        ('file_count', str(len(entries)))
+    ]
+
+    with contextlib.ExitStack() as stack:
+        for index, (path, file_hash) in enumerate(entries):
+            file_obj = stack.enter_context(open(path, 'rb'))
+            file_content = HashingFileReader(file_obj, file_hash) if file_hash else file_obj
+
+            fields.append(('file_path_%d' % index, base64.b64encode(str(path).encode("utf-8")).decode('utf-8')))
+            fields.append(('file_content_%d' % index, ('filename', file_content, 'application/octet-stream')))
+
+        enc = MultipartEncoder(fields=fields)
+
+        try:
+            response = get_session().post(url, data=enc, headers={'Content-Type': enc.content_type}, timeout=get_timeout())
+        except Exception as e:
+            logging.log(logging.ERROR, "Got exception when trying to post file batch: %s" % e)
+
+    if response is None:
+        return [500] * len(entries)
+
+    if response.status_code != 200:
+        logging.log(logging.ERROR, "Server returned %d for batch of %d files" % (response.status_code, len(entries)))
+        return [response.status_code] * len(entries)
+
+    statuses = [500] * len(entries)
+    for result in response.json().get('results', []):
+        if 0 <= result['index'] < len(entries):
+            statuses[result['index']] = result['status']
+
+    return statuses
+
+def backup_known_file(api_key,agent_id,path,file_size,sha256):
+    """
+    Ask the server to back up path from content it already has, without sending it.
+    Returns the status code: 200 if it did, 404 if the content is unknown.
+    """
+    status, _ = _post_json(API_ENDPOINT_BACKUP_KNOWN_FILE, {
+        'request_type': "backup_known_file",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'file_path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8'),
+        'file_size': file_size,
+        'sha256': sha256
+    })
+    return status
+
+def create_upload_session(api_key,agent_id,path,file_size,chunk_size):
+    """Returns (status_code, response json). See resumable_upload_utils."""
+    return _post_json(API_ENDPOINT_UPLOAD_SESSION_CREATE, {
+        'request_type': "create_upload_session",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'file_path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8'),
+        'file_size': file_size,
+        'chunk_size': chunk_size
+    })
 
-    # Including JSON object as part of "files" field
-    # Because I cannot include both separately in a single multipart/form-data request.
-    # See https://stackoverflow.com/questions/35939761/how-to-send-json-as-part-of-multipart-post-request
-    files = {
-        'file_content': content,
-        'json': (None, json_data, 'application/json')
+def upload_session_chunk(api_key,agent_id,session_id,index,chunk,chunk_sha256):
+    """PUT one chunk of an upload session. Returns the status code."""
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'X-API-Key': api_key,
+        'X-Agent-ID': agent_id,
+        'X-Session-ID': session_id,
+        'X-Chunk-Index': str(index),
+        'X-Chunk-SHA256': chunk_sha256
     }
 
     try:
-        response = requests.post(url, files=files)
+        response = get_session().put(API_ENDPOINT_UPLOAD_SESSION_CHUNK, data=chunk, headers=headers, timeout=get_timeout())
+        return response.status_code
     except Exception as e:
-        logging.log(logging.ERROR, "Got exception when trying to post file: %s" % e)
-    finally:
-        return response.status_code if response else 500
+        logging.log(logging.ERROR, "Got exception when trying to put chunk %d: %s" % (index, e))
+        return 500
+
+def get_upload_session_status(api_key,agent_id,session_id):
+    return _post_json(API_ENDPOINT_UPLOAD_SESSION_STATUS, {
+        'request_type': "upload_session_status",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'session_id': session_id
+    })
+
+def commit_upload_session(api_key,agent_id,session_id):
+    return _post_json(API_ENDPOINT_UPLOAD_SESSION_COMMIT, {
+        'request_type': "commit_upload_session",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'session_id': session_id
+    })
+
+def find_missing_chunks(api_key,agent_id,digests):
+    """Returns (status_code, response json); response['missing'] lists the digests the server needs. See chunked_upload_utils."""
+    return _post_json(API_ENDPOINT_CHUNKS_MISSING, {
+        'request_type': "missing_chunks",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'digests': ",".join(digests)
+    })
+
+def upload_content_chunk(api_key,agent_id,digest,chunk):
+    """PUT one chunk into the server's chunk store. Returns the status code."""
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'X-API-Key': api_key,
+        'X-Agent-ID': agent_id,
+        'X-Chunk-SHA256': digest
+    }
+
+    try:
+        response = get_session().put(API_ENDPOINT_CHUNKS_UPLOAD, data=chunk, headers=headers, timeout=get_timeout())
+        return response.status_code
+    except Exception as e:
+        logging.log(logging.ERROR, "Got exception when trying to put chunk %s: %s" % (digest, e))
+        return 500
+
+def commit_chunked_file(api_key,agent_id,path,file_size,chunk_list):
+    """chunk_list is the file's recipe, "<sha256>:<length>,..." in file order"""
+    return _post_json(API_ENDPOINT_CHUNKS_COMMIT_FILE, {
+        'request_type': "commit_chunked_file",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'file_path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8'),
+        'file_size': file_size,
+        'chunks': chunk_list
+    })
+
+def _post_json(url, data):
+    """POST a JSON request. Returns (status_code, response json or None); 500 if there was no response."""
+    try:
+        response = get_session().post(url, headers={'Content-Type': 'application/json'}, json=data, timeout=get_timeout())
+    except Exception as e:
+        logging.log(logging.ERROR, "Request to %s failed: %s" % (url, e))
+        return 500, None
+
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return response.status_code, None
 
 def tls_send_json_data(json_data_as_string, expected_response_code, show_json=False):
     response = None
@@ -174,7 +570,7 @@ def tls_send_json_data(json_data_as_string, expected_response_code, show_json=Fa
         url = API_ENDPOINT_KEEPALIVE
 
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(json_data))
+        response = get_session().post(url, headers=headers, data=json.dumps(json_data), timeout=get_timeout())
 
     except Exception as e:
         logging.log(logging.ERROR, "Send data failed: %s" % (e))
@@ -189,6 +585,33 @@ def tls_send_json_data(json_data_as_string, expected_response_code, show_json=Fa
         else:
             return (1, None)
 
+def wait_for_keepalive(api_key,agent_id,wait_seconds):
+    """
+    Long-poll keepalive: the server holds the request until files are queued
+    for restore or wait_seconds pass.
+
+    Returns (status_code, response_json). status_code is 404 or 405 when the
+    server has no /api/keepalive-wait, and 0 if there was no response.
+    """
+    data = {
+        'request_type': "keepalive_wait",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'wait_seconds': wait_seconds
+    }
+
+    try:
+        response = get_session().post(API_ENDPOINT_KEEPALIVE_WAIT, headers={'Content-Type': 'application/json'},
+                                      json=data, timeout=(get_timeout()[0], wait_seconds + 30))
+    except Exception as e:
+        logging.log(logging.ERROR, "Keepalive wait failed: %s" % e)
+        return 0, None
+
+    if response.status_code != 200 or 'application/json' not in response.headers.get('Content-Type', ''):
+        return response.status_code, None
+
+    return response.status_code, response.json()
+
 def tls_send_json_data_get(json_data_as_string, expected_response_code, show_json=False):
     response = None
     headers = {'Content-type': 'application/json'}
@@ -201,7 +624,7 @@ def tls_send_json_data_get(json_data_as_string, expected_response_code, show_jso
         logging.info("Sending headers for restore: {}".format(headers))
         logging.info("Sending json data for restore: {}".format(json.dumps(json_data)))
     
-        response = requests.get(url, headers=headers, data=json.dumps(json_data))
+        response = get_session().get(url, headers=headers, data=json.dumps(json_data), timeout=get_timeout())
 
     except Exception as e:
         logging.log(logging.ERROR, "Send data failed: %s" % (e))
@@ -218,6 +641,114 @@ def tls_send_json_data_get(json_data_as_string, expected_response_code, show_jso
         else:
             return (1, None)
 
+def _download_headers(api_key,agent_id,path,version_id):
+    headers = {
+        'X-API-Key': api_key,
+        'X-Agent-ID': agent_id,
+        'X-File-Path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8')
+    }
+
+    if version_id is not None:
+        headers['X-Version-ID'] = str(version_id)
+
+    return headers
+
+def get_download_info(api_key,agent_id,path,version_id=None):
+    """
+    HEAD /api/restore-file-stream: returns (status_code, response headers),
+    which carry Content-Length, ETag and, if known, X-Content-SHA256.
+    """
+    try:
+        response = get_session().head(API_ENDPOINT_RESTORE_FILE_STREAM, headers=_download_headers(api_key, agent_id, path, version_id),
+                                      timeout=get_timeout())
+        return response.status_code, response.headers
+    except Exception as e:
+        logging.log(logging.ERROR, "Could not get download info for %s: %s" % (path, e))
+        return 500, {}
+
+def download_file(api_key,agent_id,path,target_file,version_id=None,offset=0,length=None,progress_callback=None,etag=None):
+    """
+    Stream a backed up file (or the byte range offset..offset+length of it)
+    from /api/restore-file-stream into the open binary file target_file.
+    progress_callback(bytes_written, bytes_expected) is called after each block.
+
+    With etag, a range is only sent if the file still has that ETag; if the
+    file changed the server answers 200 and nothing is written.
+
+    Returns (status_code, response headers): 200 or 206 on success, 500 if
+    there was no response.
+    """
+    headers = _download_headers(api_key, agent_id, path, version_id)
+    ranged = offset or length is not None
+
+    if ranged:
+        headers['Range'] = 'bytes=%d-%s' % (offset, offset + length - 1 if length is not None else '')
+        if etag:
+            headers['If-Range'] = etag
+
+    try:
+        with get_session().get(API_ENDPOINT_RESTORE_FILE_STREAM, headers=headers, stream=True, timeout=get_timeout()) as response:
+            # A range answered with the whole file would land in the wrong place
+            if response.status_code not in (200, 206) or (ranged and response.status_code != 206):
+                return response.status_code, response.headers
+
+            expected = int(response.headers.get('Content-Length', 0))
+            written = 0
+
+            for block in response.iter_content(chunk_size=UPLOAD_BUFFER_SIZE):
+                target_file.write(block)
+                written += len(block)
+
+                if progress_callback:
+                    progress_callback(written, expected)
+
+            return response.status_code, response.headers
+
+    except Exception as e:
+        logging.log(logging.ERROR, "Download of %s failed: %s" % (path, e))
+        return 500, {}
+
+def confirm_restore(api_key,agent_id,path):
+    """
+    Tell the server a file from /api/restore-file-stream is fully restored,
+    so it leaves the restore queue. Returns the status code.
+    """
+    status, _ = _post_json(API_ENDPOINT_RESTORE_COMPLETE, {
+        'request_type': "restore_complete",
+        'api_key': api_key,
+        'agent_id': agent_id,
+        'file_path': base64.b64encode(str(path).encode("utf-8")).decode('utf-8')
+    })
+    return status
+
+def open_restore_archive(api_key,agent_id,file_paths=None,path_prefix=None):
+    """
+    Request a tar archive of many backed up files from /api/restore-files-archive,
+    either the listed file_paths or every file under the directory path_prefix.
+
+    Returns the streaming response (the caller reads it, e.g. with tarfile
+    mode 'r|', and closes it), or None if there was no response.
+    """
+    data = {
+        'request_type': "restore_files_archive",
+        'api_key': api_key,
+        'agent_id': agent_id
+    }
+
+    if file_paths is not None:
+        data['file_paths'] = ",".join(base64.b64encode(str(path).encode("utf-8")).decode('utf-8') for path in file_paths)
+    else:
+        data['path_prefix'] = base64.b64encode(str(path_prefix).encode("utf-8")).decode('utf-8')
+
+    try:
+        response = get_session().post(API_ENDPOINT_RESTORE_FILES_ARCHIVE, headers={'Content-Type': 'application/json'},
+                                      json=data, stream=True, timeout=get_timeout())
+        response.raw.decode_content = True
+        return response
+    except Exception as e:
+        logging.log(logging.ERROR, "Restore archive request failed: %s" % e)
+        return None
+
 def dump_file_info(path,size):
     logging.log(logging.INFO,"== SENDING FILE : ==")
     logging.log(logging.INFO,"\tPATH: %s" %path)
@@ -244,7 +775,7 @@ def sync_backup_folders(settings):
     }
     
     try:
-        response = requests.post(API_ENDPOINT_REGISTER_BACKUP_FOLDERS, json=data)
+        response = get_session().post(API_ENDPOINT_REGISTER_BACKUP_FOLDERS, json=data, timeout=get_timeout())
         if response.status_code == 200 and response.json()['SUCCESS']:
             logging.info("Backup folders synchronized successfully")
         else:
@@ -266,7 +797,7 @@ def summarize_file_with_ai(api_key: str, agent_id: str, filepath: str, content:
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = get_session().post(url, headers=headers, json=data, timeout=get_timeout())
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
@@ -290,7 +821,7 @@ def submit_error_log(api_key: str, agent_id: str, application_version: str, log_
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = get_session().post(url, headers=headers, json=data, timeout=get_timeout())
         print(response)
         response.raise_for_status()
         return response.json()
@@ -3,7 +3,6 @@ import json
 import logging
 import yaml
 
-import requests
 import pdb
 
 import network_utils as scnet
@@ -17,7 +16,7 @@ def fetch_and_update_backup_paths(settings_file_path, api_key, agent_id, interva
         data = {"api_key": api_key, "agent_id": agent_id}
 
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = scnet.get_session().post(url, headers=headers, json=data, timeout=scnet.get_timeout())
             if response.status_code == 200:
                 result = response.json()
                 
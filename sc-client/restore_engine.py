@@ -0,0 +1,245 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import network_utils
+
+ONE_MB = 1024*1024
+
+DEFAULT_RESTORE_WORKERS  = 4
+DEFAULT_RESTORE_RANGE_MB = 16
+
+# Completed ranges are recorded (after the data is flushed to disk) at most this often
+STATE_SAVE_SECONDS = 2.0
+
+restore_workers    = DEFAULT_RESTORE_WORKERS
+restore_range_size = DEFAULT_RESTORE_RANGE_MB * ONE_MB
+
+class RestoreCancelled(Exception):
+    pass
+
+def configure_restore(settings):
+    """Apply RESTORE_WORKERS and RESTORE_RANGE_MB from settings.cfg"""
+    global restore_workers, restore_range_size
+
+    restore_workers    = max(1, int(settings.get('RESTORE_WORKERS', DEFAULT_RESTORE_WORKERS)))
+    restore_range_size = int(float(settings.get('RESTORE_RANGE_MB', DEFAULT_RESTORE_RANGE_MB)) * ONE_MB)
+
+class RangeBitmap:
+    """One bit per range of the file, set once that range is on disk"""
+
+    def __init__(self, total_ranges, data=None):
+        self.total_ranges = total_ranges
+        self.bits = bytearray(data) if data else bytearray((total_ranges + 7) // 8)
+
+    def set(self, index):
+        self.bits[index // 8] |= 1 << (index % 8)
+
+    def is_set(self, index):
+        return bool(self.bits[index // 8] & (1 << (index % 8)))
+
+    def missing(self):
+        return [index for index in range(self.total_ranges) if not self.is_set(index)]
+
+    def count(self):
+        return self.total_ranges - len(self.missing())
+
+class ParallelRestore:
+    """
+    Restores one file by downloading byte ranges concurrently.
+
+    The ranges are written in place into a preallocated (sparse) file next to
+    the destination, each worker seeking its own file handle, so nothing is
+    buffered or reassembled. Which ranges are done is kept in a small state
+    file: the server's ETag and the file size, plus a bitmap with one bit per
+    range. An interrupted restore downloads only the missing ranges, as long
+    as the file on the server still has the same ETag. Once every range is
+    there the whole file is checked against the server's SHA-256 (when it has
+    one) before it replaces the destination, and the restore is confirmed to
+    the server once, for the whole file.
+    """
+
+    def __init__(self, file_path, api_key, agent_id, destination=None, version_id=None,
+                 range_size=None, workers=None, should_stop=None):
+        self.file_path = str(file_path)
+        self.api_key = api_key
+        self.agent_id = agent_id
+        self.destination = str(destination or file_path)
+        self.version_id = version_id
+        self.range_size = range_size or restore_range_size
+        self.workers = workers or restore_workers
+        self.should_stop = should_stop or (lambda: False)
+
+        self.part_path = self.destination + ".sc-restore"
+        self.state_path = self.destination + ".sc-restore.state"
+
+        self._lock = threading.Lock()
+        self._bytes_done = 0
+
+    def restore(self, progress_callback=None):
+        """
+        Restore the file. progress_callback(percent, downloaded, total) is
+        called as ranges complete.
+
+        Returns True or False, or None if the server has no streaming endpoint.
+        """
+        status_code, headers = network_utils.get_download_info(self.api_key, self.agent_id, self.file_path, self.version_id)
+
+        if status_code in (404, 405) and 'application/json' not in headers.get('Content-Type', ''):
+            return None
+
+        if status_code != 200:
+            logging.error(f"Could not start restore of {self.file_path}: status {status_code}")
+            return False
+
+        total_size = int(headers['Content-Length'])
+        etag = headers.get('ETag')
+        expected_sha256 = headers.get('X-Content-SHA256')
+
+        bitmap = self._load_or_create(total_size, etag)
+        missing = bitmap.missing()
+        self._bytes_done = sum(self._range_length(index, total_size) for index in range(bitmap.total_ranges) if bitmap.is_set(index))
+
+        if missing:
+            logging.info(f"Restoring {self.file_path}: {len(missing)} of {bitmap.total_ranges} ranges, {self.workers} workers")
+
+        try:
+            self._download_ranges(missing, bitmap, total_size, etag, progress_callback)
+        except RestoreCancelled:
+            logging.info(f"Restore of {self.file_path} stopped, it will resume from {bitmap.count()} ranges")
+            return False
+        except Exception as e:
+            logging.error(f"Restore of {self.file_path} failed, it will resume from {bitmap.count()} ranges: {e}")
+            return False
+
+        if expected_sha256 and self._hash_part_file() != expected_sha256:
+            logging.error(f"Restored {self.file_path} does not match the server's digest, discarding it")
+            self._clear_state()
+            return False
+
+        os.replace(self.part_path, self.destination)
+        self._clear_state()
+
+        logging.info(f"Successfully restored {self.file_path} to {self.destination}")
+
+        # A failed confirmation only means the file is restored again later
+        if network_utils.confirm_restore(self.api_key, self.agent_id, self.file_path) != 200:
+            logging.warning(f"Could not confirm the restore of {self.file_path} to the server")
+        return True
+
+    def _range_length(self, index, total_size):
+        return min(self.range_size, total_size - index * self.range_size)
+
+    def _load_or_create(self, total_size, etag):
+        total_ranges = -(-total_size // self.range_size)
+
+        state = self._load_state()
+        if (state and os.path.exists(self.part_path) and etag and state['etag'] == etag and
+                state['size'] == total_size and state['range_size'] == self.range_size):
+            return RangeBitmap(total_ranges, bytes.fromhex(state['bitmap']))
+
+        os.makedirs(os.path.dirname(self.part_path) or '.', exist_ok=True)
+
+        # Sparse where the filesystem allows it; ranges are filled in any order
+        with open(self.part_path, 'wb') as f:
+            f.truncate(total_size)
+
+        bitmap = RangeBitmap(total_ranges)
+        self._save_state(bitmap, total_size, etag)
+        return bitmap
+
+    def _download_ranges(self, missing, bitmap, total_size, etag, progress_callback):
+        last_save = time.monotonic()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="sc-restore") as pool:
+            futures = {pool.submit(self._download_range, index, total_size, etag, progress_callback): index for index in missing}
+
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    bitmap.set(futures[future])
+
+                    if time.monotonic() - last_save >= STATE_SAVE_SECONDS:
+                        self._flush_and_save(bitmap, total_size, etag)
+                        last_save = time.monotonic()
+
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+            finally:
+                # Record whatever finished, so a later attempt can skip it
+                self._flush_and_save(bitmap, total_size, etag)
+
+    def _download_range(self, index, total_size, etag, progress_callback):
+        if self.should_stop():
+            raise RestoreCancelled(self.file_path)
+
+        offset = index * self.range_size
+        length = self._range_length(index, total_size)
+
+        with open(self.part_path, 'r+b') as f:
+            f.seek(offset)
+            status_code, headers = network_utils.download_file(
+                self.api_key, self.agent_id, self.file_path, f,
+                version_id=self.version_id, offset=offset, length=length, etag=etag
+            )
+            written = f.tell() - offset
+
+        if status_code != 206 or written != length:
+            raise IOError(f"range {index} at {offset} returned status {status_code} with {written} of {length} bytes")
+
+        with self._lock:
+            self._bytes_done += length
+            done = self._bytes_done
+
+        if progress_callback:
+            progress_callback((done / total_size) * 100 if total_size else 100.0, done, total_size)
+
+    def _flush_and_save(self, bitmap, total_size, etag):
+        # The ranges must be on disk before the bitmap says they are
+        with open(self.part_path, 'r+b') as f:
+            os.fsync(f.fileno())
+
+        self._save_state(bitmap, total_size, etag)
+
+    def _hash_part_file(self):
+        file_hash = hashlib.sha256()
+        with open(self.part_path, 'rb') as f:
+            while chunk := f.read(ONE_MB):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable restore state {self.state_path}: {e}")
+            return None
+
+    def _save_state(self, bitmap, total_size, etag):
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'file_path': self.file_path,
+                'etag': etag,
+                'size': total_size,
+                'range_size': self.range_size,
+                'bitmap': bitmap.bits.hex()
+            }, f)
+        os.replace(temp_path, self.state_path)
+
+    def _clear_state(self):
+        for path in (self.state_path, self.part_path):
+            if os.path.exists(path):
+                os.remove(path)
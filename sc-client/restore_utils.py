@@ -3,8 +3,14 @@ import os
 import json
 import logging
 import base64
+import hashlib
+import tarfile
 
 import network_utils as scnet
+from restore_engine import ParallelRestore, RestoreCancelled
+
+# Paths per /api/restore-files-archive request
+RESTORE_ARCHIVE_BATCH = 10000
 
 def is_previewable_file(file_path: str) -> bool:
     """Determine if a file can be previewed based on its mimetype and extension"""
@@ -65,7 +71,38 @@ def restore_file(file_path, api_key, agent_id, version_id=None, preview_path=Non
         agent_id: Agent ID for authentication
         version_id: Optional version ID
         preview_path: If provided, write to this location instead of original path
+
+    Restoring the current version to its original location is confirmed to
+    the server, which takes the file off the agent's restore queue; previews
+    and older versions are not. Returns True if the file was restored.
     """
+    restored, _ = _restore_file(file_path, api_key, agent_id, version_id, preview_path)
+    return restored
+
+def restore_queued_file(file_path, api_key, agent_id):
+    """
+    Restore a file the server queued for this agent to its original location.
+
+    Returns (restored, confirmed). confirmed is False if the server could not
+    be told the restore is done, so the file is still in its restore queue.
+    """
+    return _restore_file(file_path, api_key, agent_id, None, None)
+
+def _restore_file(file_path, api_key, agent_id, version_id, preview_path):
+    destination = preview_path if preview_path else file_path
+
+    restored = stream_restore_file(file_path, api_key, agent_id, destination, version_id)
+    if restored is not None:
+        # Only restoring the current version in place is what a queued restore asked for
+        if not restored or version_id is not None or str(destination) != str(file_path):
+            return restored, False
+
+        confirmed = scnet.confirm_restore(api_key, agent_id, file_path) == 200
+        if not confirmed:
+            logging.warning(f"Could not confirm the restore of {file_path} to the server")
+        return True, confirmed
+
+    logging.info("Server has no streaming restore endpoint, using JSON restore")
     path_for_request = base64.b64encode(str(file_path).encode("utf-8")).decode('utf-8')
 
     restore_file_request_data = json.dumps({
@@ -83,21 +120,168 @@ def restore_file(file_path, api_key, agent_id, version_id=None, preview_path=Non
     )
     
     logging.info("Status code returned: {}".format(status_code))
-    logging.info("Response data returned: {}".format(response_data))
 
+    # The JSON endpoint takes the file off the restore queue itself
     if response_data and 'file_content' in response_data:
         file_content = base64.b64decode(response_data['file_content'])
-        # Use preview_path if provided, otherwise use original file_path
-        destination = preview_path if preview_path else file_path
-        return write_file_to_disk(file_content, destination)
+        restored = write_file_to_disk(file_content, destination)
+        return restored, restored
             
     logging.warning("Failed to get response from restore_file request")
-    return False
+    return False, False
+
+def stream_restore_file(file_path, api_key, agent_id, destination, version_id=None, progress_callback=None):
+    """
+    Download a file from the streaming restore endpoint straight to disk.
+    The data goes to a temporary file next to destination, which replaces
+    destination only once the whole file has arrived. The restore is not
+    confirmed to the server here; see restore_file.
+
+    Returns True or False, or None if the server has no streaming endpoint.
+    """
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    temp_path = f"{destination}.sc-restore"
+
+    try:
+        with open(temp_path, 'wb') as f:
+            status_code, headers = scnet.download_file(
+                api_key, agent_id, file_path, f, version_id=version_id, progress_callback=progress_callback
+            )
+
+        if status_code == 200:
+            os.replace(temp_path, destination)
+            logging.info(f"Successfully restored {file_path} to {destination}")
+            return True
+
+        # Our server answers a missing file with a JSON error; anything else
+        # is an older server without the endpoint.
+        if status_code in (404, 405) and 'application/json' not in headers.get('Content-Type', ''):
+            return None
+
+        logging.error(f"Streaming restore of {file_path} failed with status {status_code}")
+        return False
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def restore_files(file_paths, api_key, agent_id, progress_callback=None, should_stop=None):
+    """
+    Restore many files, RESTORE_ARCHIVE_BATCH at a time, each batch arriving
+    as one streamed tar archive that is unpacked to disk as it is read.
+    
+    Args:
+        file_paths: Paths to restore, as they were backed up
+        api_key: API key for authentication
+        agent_id: Agent ID for authentication
+        progress_callback: Optional callback(file_path, success) for each file
+        should_stop: Optional shared value; restoring stops once it is set
+        
+    Returns:
+        dict of file_path -> success, or None if the server has no archive endpoint
+    """
+    file_paths = [str(path) for path in file_paths]
+    results = {}
+
+    for start in range(0, len(file_paths), RESTORE_ARCHIVE_BATCH):
+        if should_stop and should_stop.value:
+            break
+
+        batch = file_paths[start:start + RESTORE_ARCHIVE_BATCH]
+        batch_results = _restore_archive(batch, api_key, agent_id, progress_callback, should_stop)
+
+        if batch_results is None:
+            if start == 0:
+                return None
+            batch_results = {}
+
+        for path in batch:
+            if path not in batch_results:
+                batch_results[path] = False
+                if progress_callback and not (should_stop and should_stop.value):
+                    progress_callback(path, False)
+
+        results.update(batch_results)
+
+    return results
+
+def _restore_archive(file_paths, api_key, agent_id, progress_callback, should_stop):
+    """Unpack the archive of file_paths. Returns {path: success} for the files it held, or None if there is no endpoint."""
+    response = scnet.open_restore_archive(api_key, agent_id, file_paths=file_paths)
+    if response is None:
+        return {}
+
+    results = {}
+    # Member names are the paths as the server stores them, always with /
+    requested = {path.replace('\\', '/'): path for path in file_paths}
+
+    with response:
+        if response.status_code != 200:
+            if response.status_code in (404, 405) and 'application/json' not in response.headers.get('Content-Type', ''):
+                return None
+
+            logging.error(f"Restore archive request failed with status {response.status_code}")
+            return {}
+
+        try:
+            with tarfile.open(fileobj=response.raw, mode='r|') as archive:
+                for member in archive:
+                    if should_stop and should_stop.value:
+                        logging.info("Restore cancelled, closing archive")
+                        break
+
+                    # Only ever write files that were asked for
+                    if not member.isfile() or member.name not in requested:
+                        logging.warning(f"Skipping unexpected archive member {member.name}")
+                        continue
+
+                    path = requested[member.name]
+                    success = _write_archive_member(archive, member, path)
+                    results[path] = success
+
+                    if progress_callback:
+                        progress_callback(path, success)
+
+        except Exception as e:
+            logging.error(f"Restore archive was cut short after {len(results)} files: {e}")
+
+    return results
+
+def _write_archive_member(archive, member, destination):
+    """Write one archive member to destination through a temporary file, checking its digest if the server sent one"""
+    temp_path = f"{destination}.sc-restore"
+    file_hash = hashlib.sha256()
+
+    try:
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+
+        with archive.extractfile(member) as source, open(temp_path, 'wb') as target:
+            while block := source.read(scnet.ONE_MB):
+                file_hash.update(block)
+                target.write(block)
+
+        expected = member.pax_headers.get('SC.sha256')
+        if expected and file_hash.hexdigest() != expected:
+            logging.error(f"Restored {destination} does not match the server's digest")
+            return False
+
+        os.replace(temp_path, destination)
+        os.utime(destination, (member.mtime, member.mtime))
+        return True
+
+    except OSError as e:
+        logging.error(f"Failed to write {destination}: {e}")
+        return False
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 def restore_large_file(file_path: str, api_key: str, agent_id: str, 
                       progress_callback=None, should_stop=None) -> bool:
     """
-    Restore a large file using chunked downloads
+    Restore a large file by downloading byte ranges of it in parallel.
+    An interrupted restore resumes from the ranges already on disk.
     
     Args:
         file_path: Path to restore the file to
@@ -109,6 +293,25 @@ def restore_large_file(file_path: str, api_key: str, agent_id: str,
     Returns:
         bool: True if successful, False otherwise
     """
+    def on_progress(percent, downloaded, total_size):
+        if progress_callback:
+            progress_callback(percent)
+
+    restore = ParallelRestore(file_path, api_key, agent_id,
+                              should_stop=lambda: bool(should_stop and should_stop.value))
+    restored = restore.restore(progress_callback=on_progress)
+
+    if restored is None:
+        logging.info("Server has no streaming restore endpoint, using chunked JSON restore")
+        return _restore_large_file_in_chunks(file_path, api_key, agent_id, progress_callback, should_stop)
+
+    if not restored and should_stop and should_stop.value:
+        logging.info(f"Cancelled restore of {file_path}")
+
+    return restored
+
+def _restore_large_file_in_chunks(file_path, api_key, agent_id, progress_callback=None, should_stop=None):
+    """restore_large_file for servers without /api/restore-file-stream"""
     try:
         temp_path = f"{file_path}.tmp"
         chunk_size = 16 * 1024 * 1024  # 16MB chunks
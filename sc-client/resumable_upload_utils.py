@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import network_utils
+
+ONE_MB = 1024*1024
+
+DEFAULT_RESUMABLE_THRESHOLD_MB = 64
+DEFAULT_UPLOAD_CHUNK_MB        = 8
+
+# Attempts per chunk before the upload is left to be resumed on a later pass
+CHUNK_ATTEMPTS = 3
+
+resumable_threshold = DEFAULT_RESUMABLE_THRESHOLD_MB * ONE_MB
+upload_chunk_size   = DEFAULT_UPLOAD_CHUNK_MB * ONE_MB
+
+def configure_resumable_uploads(settings):
+    """Apply RESUMABLE_UPLOAD_MB and UPLOAD_CHUNK_MB from settings.cfg"""
+    global resumable_threshold, upload_chunk_size
+
+    resumable_threshold = int(float(settings.get('RESUMABLE_UPLOAD_MB', DEFAULT_RESUMABLE_THRESHOLD_MB)) * ONE_MB)
+    upload_chunk_size   = int(float(settings.get('UPLOAD_CHUNK_MB', DEFAULT_UPLOAD_CHUNK_MB)) * ONE_MB)
+
+def use_resumable_upload(file_size):
+    return file_size >= resumable_threshold
+
+def get_upload_state_directory():
+    appdata_path = os.getenv('APPDATA') or tempfile.gettempdir()
+    return os.path.join(appdata_path, 'Stormcloud', 'upload_sessions')
+
+class ResumableUpload:
+    """
+    Uploads a file as numbered chunks through a server-side upload session.
+
+    The session id is saved to a small JSON file under APPDATA, keyed by the
+    file path, together with the size and mtime of the file it was made for.
+    After a failure (or a reboot) the next attempt asks the server which
+    chunks it already has and only sends the rest, as long as the file has
+    not changed in between.
+    """
+
+    def __init__(self, file_path, api_key, agent_id, chunk_size=None, state_directory=None):
+        self.file_path = str(file_path)
+        self.api_key = api_key
+        self.agent_id = agent_id
+        self.chunk_size = chunk_size or upload_chunk_size
+        self.state_directory = state_directory or get_upload_state_directory()
+
+        path_key = hashlib.sha256(self.file_path.encode("utf-8")).hexdigest()[:32]
+        self.state_file = os.path.join(self.state_directory, path_key + ".json")
+
+    def upload(self, file_hash=None):
+        """
+        Upload the file, resuming a previous session if there is one.
+        file_hash (a hashlib object) is updated with the whole file.
+        Returns an HTTP-style status code: 200 once the server has committed
+        the file, 404 if the server does not support upload sessions.
+        """
+        file_stat = os.stat(self.file_path)
+
+        status, session_id, total_chunks, received = self._resume_or_create(file_stat)
+        if status != 200:
+            return status
+
+        logging.info("Uploading %s in %d chunks (%d already on server)" % (self.file_path, total_chunks, len(received)))
+
+        with open(self.file_path, 'rb') as f:
+            for index in range(total_chunks):
+                chunk = f.read(self.chunk_size)
+
+                # Chunks the server already has are still read, for file_hash
+                if file_hash:
+                    file_hash.update(chunk)
+
+                if index in received:
+                    continue
+
+                status = self._put_chunk(session_id, index, chunk)
+                if status == 404:
+                    self._clear_state()   # session expired on the server
+
+                if status != 200:
+                    logging.error("Giving up on %s at chunk %d (status %d), will resume later" % (self.file_path, index, status))
+                    return status
+
+        current_stat = os.stat(self.file_path)
+        if (current_stat.st_size, current_stat.st_mtime_ns) != (file_stat.st_size, file_stat.st_mtime_ns):
+            logging.warning("%s changed during upload, starting over next time" % self.file_path)
+            self._clear_state()
+            return 409
+
+        status, _ = network_utils.commit_upload_session(self.api_key, self.agent_id, session_id)
+        if status == 200 or status == 404:
+            # Committed, or the session is gone; either way it cannot be resumed.
+            self._clear_state()
+
+        return status
+
+    def _resume_or_create(self, file_stat):
+        """Returns (status_code, session_id, total_chunks, chunk indexes the server already has)"""
+        state = self._load_state()
+
+        if (state and state['file_size'] == file_stat.st_size and
+                state['mtime_ns'] == file_stat.st_mtime_ns):
+            status, response = network_utils.get_upload_session_status(self.api_key, self.agent_id, state['session_id'])
+
+            if status == 200:
+                self.chunk_size = response['chunk_size']
+                return 200, state['session_id'], response['total_chunks'], set(response['received_chunks'])
+
+            logging.info("Could not resume upload session for %s (status %d), starting a new one" % (self.file_path, status))
+
+        self._clear_state()
+
+        status, response = network_utils.create_upload_session(
+            self.api_key, self.agent_id, self.file_path, file_stat.st_size, self.chunk_size
+        )
+        if status != 200:
+            return status, None, 0, set()
+
+        self.chunk_size = response['chunk_size']
+        self._save_state({
+            'file_path': self.file_path,
+            'session_id': response['session_id'],
+            'file_size': file_stat.st_size,
+            'mtime_ns': file_stat.st_mtime_ns
+        })
+
+        return 200, response['session_id'], response['total_chunks'], set()
+
+    def _put_chunk(self, session_id, index, chunk):
+        chunk_sha256 = hashlib.sha256(chunk).hexdigest()
+
+        for attempt in range(CHUNK_ATTEMPTS):
+            status = network_utils.upload_session_chunk(self.api_key, self.agent_id, session_id, index, chunk, chunk_sha256)
+            if status == 200 or status in (401, 404):
+                return status
+
+            logging.warning("Chunk %d of %s failed with status %d (attempt %d)" % (index, self.file_path, status, attempt + 1))
+
+        return status
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return None
+
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable upload state %s: %s" % (self.state_file, e))
+            return None
+
+    def _save_state(self, state):
+        os.makedirs(self.state_directory, exist_ok=True)
+
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_file, self.state_file)
+
+    def _clear_state(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
@@ -26,9 +26,16 @@ import logging
 
 import keepalive_utils
 import backup_utils
+import backup_engine
+import hash_utils
 import logging_utils
 import reconfigure_utils
 import network_utils
+import resumable_upload_utils
+import chunked_upload_utils
+import restore_engine
+import restore_utils
+import manifest_utils
 
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel, 
                            QPushButton, QCheckBox, QApplication)
@@ -37,7 +44,7 @@ from PyQt5.QtGui import QIcon, QPixmap
 
 from infi.systray import SysTrayIcon   # pip install infi.systray
 
-from client_db_utils import get_or_create_hash_db
+from client_db_utils import get_or_create_hash_db, HashDBWriter
 
 # App Device History tracking using SQLite
 from history_db import (
@@ -54,6 +61,7 @@ class BackupState:
         self.backup_start_time = None
         self.last_successful_backup = None
         self.current_backup_source = None  # 'weekly', 'monthly', or None
+        self._stop_requested = threading.Event()
         self._lock = threading.Lock()
         logging.info("Initialized new BackupState instance")
 
@@ -74,6 +82,7 @@ class BackupState:
             self.backup_in_progress = True
             self.backup_start_time = datetime.now()
             self.current_backup_source = source
+            self._stop_requested.clear()
             logging.info(
                 f"Starting {source} backup at {self.backup_start_time.strftime('%Y-%m-%d %H:%M:%S')}"
             )
@@ -110,6 +119,18 @@ class BackupState:
                 f"Last successful backup: {self.last_successful_backup.strftime('%Y-%m-%d %H:%M:%S') if self.last_successful_backup else 'None'}"
             )
 
+    def request_stop(self):
+        """
+        Ask the running backup to stop. Files already being hashed or uploaded
+        are finished; no new files are started.
+        """
+        if self.backup_in_progress:
+            logging.warning(f"Stop requested for {self.current_backup_source} backup")
+            self._stop_requested.set()
+
+    def stop_requested(self):
+        return self._stop_requested.is_set()
+
     def get_backup_duration(self):
         """
         Calculate the duration of the current backup in seconds.
@@ -283,125 +304,28 @@ class RestoreChunkManager:
         self.api_key = api_key
         self.agent_id = agent_id
         self.chunk_size = chunk_size
-        self.temp_dir = os.path.join(
-            os.path.dirname(file_path), 
-            f'.temp_{os.path.basename(file_path)}'
-        )
-        self.progress_file = f"{self.temp_dir}.progress"
-        self.downloaded_chunks = set()
-        self.total_size = None
-        self._load_progress()
-        
-    def _load_progress(self):
-        """Load existing progress if any"""
-        if os.path.exists(self.progress_file):
-            with open(self.progress_file, 'r') as f:
-                data = json.load(f)
-                self.downloaded_chunks = set(data['chunks'])
-                self.total_size = data['total_size']
-                
-    def _save_progress(self):
-        """Save download progress"""
-        with open(self.progress_file, 'w') as f:
-            json.dump({
-                'chunks': list(self.downloaded_chunks),
-                'total_size': self.total_size
-            }, f)
-
-    def download_chunk(self, offset: int, length: int) -> bytes:
-        """Download a specific byte range"""
-        request_data = json.dumps({
-            'request_type': 'restore_file',
-            'file_path': base64.b64encode(
-                str(self.file_path).encode("utf-8")
-            ).decode('utf-8'),
-            'api_key': self.api_key,
-            'agent_id': self.agent_id,
-            'range': f'bytes={offset}-{offset+length-1}'
-        })
-        
-        status_code, response = scnet.tls_send_json_data_get(
-            request_data, 
-            206,  # Partial Content
-            show_json=False
-        )
-        
-        if status_code != 206 or 'file_content' not in response:
-            raise Exception(f"Failed to download chunk: {status_code}")
-            
-        return base64.b64decode(response['file_content'])
 
     def restore_file(self, progress_callback=None) -> bool:
         """
-        Restore file with resume capability
+        Restore file with resume capability. Chunks are downloaded in parallel
+        straight into place; an interrupted restore only fetches the chunks
+        it is missing. Servers without the streaming endpoint are restored
+        from through restore_utils.restore_file.
         
         Args:
             progress_callback: Optional callback(percent, downloaded, total)
         """
         try:
-            # Create temp directory
-            os.makedirs(self.temp_dir, exist_ok=True)
-            
-            # Get file size if we don't have it
-            if not self.total_size:
-                info_request = json.dumps({
-                    'request_type': 'restore_file_info',
-                    'file_path': base64.b64encode(str(self.file_path).encode("utf-8")).decode('utf-8'),
-                    'api_key': self.api_key,
-                    'agent_id': self.agent_id
-                })
-                
-                status_code, response = scnet.tls_send_json_data_get(info_request, 200)
-                
-                if status_code != 200 or 'size' not in response:
-                    raise Exception("Failed to get file size")
-                    
-                self.total_size = response['size']
-                self._save_progress()
-
-            # Calculate chunks
-            total_chunks = (self.total_size + self.chunk_size - 1) // self.chunk_size
-                          
-            # Download missing chunks
-            for chunk_num in range(total_chunks):
-                if chunk_num in self.downloaded_chunks:
-                    continue
-                    
-                offset = chunk_num * self.chunk_size
-                length = min(self.chunk_size, self.total_size - offset)
-                           
-                chunk_data = self.download_chunk(offset, length)
-                chunk_path = os.path.join(self.temp_dir, f"chunk_{chunk_num:08d}")
-                
-                with open(chunk_path, 'wb') as f:
-                    f.write(chunk_data)
-                    
-                self.downloaded_chunks.add(chunk_num)
-                self._save_progress()
-                
-                if progress_callback:
-                    downloaded = len(self.downloaded_chunks) * self.chunk_size
-                    progress_callback(
-                        (downloaded / self.total_size) * 100,
-                        downloaded,
-                        self.total_size
-                    )
+            restore = restore_engine.ParallelRestore(
+                self.file_path, self.api_key, self.agent_id, range_size=self.chunk_size
+            )
+            restored = restore.restore(progress_callback=progress_callback)
 
-            # Reassemble file
-            with open(f"{self.file_path}.tmp", 'wb') as outfile:
-                for chunk_num in range(total_chunks):
-                    chunk_path = os.path.join(self.temp_dir, f"chunk_{chunk_num:08d}")
-                    with open(chunk_path, 'rb') as chunk:
-                        outfile.write(chunk.read())
-                        
-            # Atomic rename
-            os.replace(f"{self.file_path}.tmp", self.file_path)
-            
-            # Cleanup
-            shutil.rmtree(self.temp_dir)
-            os.remove(self.progress_file)
-            
-            return True
+            if restored is None:
+                logging.info("Server has no streaming restore endpoint, using JSON restore")
+                return restore_utils.restore_file(self.file_path, self.api_key, self.agent_id)
+
+            return restored
             
         except Exception as e:
             logging.error(f"Restore failed: {e}")
@@ -1040,7 +964,17 @@ def main(settings_file_path,hash_db_file_path,ignore_hash_db):
             lambda x: logging.log(logging.INFO, "User clicked 'Backup now', but backup is always running.")
         )
     ,)
-    systray = SysTrayIcon("stormcloud.ico", "Stormcloud Backup Engine", systray_menu_options)
+    backup_state = BackupState()
+    shutdown = threading.Event()
+
+    def on_quit(systray):
+        # Quitting from the tray stops the running backup after the files in
+        # flight and ends the action loop.
+        logging.log(logging.INFO, "User quit from the system tray, shutting down")
+        shutdown.set()
+        backup_state.request_stop()
+
+    systray = SysTrayIcon("stormcloud.ico", "Stormcloud Backup Engine", systray_menu_options, on_quit=on_quit)
     systray.start()
 
     # Initialize and start drive monitor
@@ -1053,7 +987,9 @@ def main(settings_file_path,hash_db_file_path,ignore_hash_db):
             settings_file_path=settings_file_path,
             dbconn=hash_db_conn,
             ignore_hash=ignore_hash_db,
-            systray=systray
+            systray=systray,
+            backup_state=backup_state,
+            shutdown=shutdown
         )
     finally:
         # Ensure drive monitor is stopped on exit
@@ -1063,69 +999,50 @@ def save_file_metadata(settings):
     """Save file metadata to the manifest directory"""
     api_key = settings['API_KEY']
     agent_id = settings['AGENT_ID']
-    
-    metadata = network_utils.fetch_file_metadata(api_key, agent_id)
-    
-    if metadata:
+
+    try:
         # Get installation path from settings
         appdata_path = os.getenv('APPDATA')
         settings_path = os.path.join(appdata_path, 'Stormcloud', 'stable_settings.cfg')
-        
+
+        with open(settings_path, 'r') as f:
+            stable_settings = json.load(f)
+        install_path = stable_settings.get('install_path', '')
+
+        # Create manifest directory
+        manifest_dir = os.path.join(install_path, 'file_explorer', 'manifest')
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    except Exception as e:
+        logging.error(f"Failed to save metadata: {e}")
+        return
+
+    # Only what changed since the last sync is downloaded
+    changed = manifest_utils.sync_manifest(api_key, agent_id, manifest_dir)
+
+    if changed is None:
+        # Server without the changes endpoint, or the sync failed
+        metadata = network_utils.fetch_file_metadata(api_key, agent_id)
+        if not metadata:
+            logging.error("Failed to fetch file metadata")
+            return
+
         try:
-            with open(settings_path, 'r') as f:
-                stable_settings = json.load(f)
-            install_path = stable_settings.get('install_path', '')
-            
-            # Create manifest directory
-            manifest_dir = os.path.join(install_path, 'file_explorer', 'manifest')
-            os.makedirs(manifest_dir, exist_ok=True)
-            
-            # Save new metadata file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"file_metadata_{timestamp}.json"
-            file_path = os.path.join(manifest_dir, filename)
-            
-            with open(file_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
-            
-            logging.info(f"File metadata saved to {file_path}")
-            
-            # Cleanup old files
-            cleanup_old_metadata(manifest_dir)
-            
+            with manifest_utils.ManifestStore(manifest_dir) as store:
+                store.replace_records(metadata)
         except Exception as e:
             logging.error(f"Failed to save metadata: {e}")
-    else:
-        logging.error("Failed to fetch file metadata")
+            return
 
-def cleanup_old_metadata(manifest_dir, max_files=10):
-    """Remove old metadata files keeping only the most recent ones"""
-    try:
-        # Get list of metadata files
-        files = [f for f in os.listdir(manifest_dir) 
-                if f.startswith('file_metadata_') and f.endswith('.json')]
-        
-        # Sort by timestamp in filename
-        files.sort(key=lambda x: datetime.strptime(
-            x, 'file_metadata_%Y%m%d_%H%M%S.json'), reverse=True)
-        
-        # Remove old files
-        if len(files) > max_files:
-            for old_file in files[max_files:]:
-                file_path = os.path.join(manifest_dir, old_file)
-                try:
-                    os.remove(file_path)
-                    logging.info(f"Removed old metadata file: {old_file}")
-                except Exception as e:
-                    logging.error(f"Failed to remove old metadata file {old_file}: {e}")
-                    
-    except Exception as e:
-        logging.error(f"Error during metadata cleanup: {e}")
+    manifest_utils.remove_legacy_snapshots(manifest_dir)
+    logging.info(f"File metadata saved to {os.path.join(manifest_dir, manifest_utils.MANIFEST_DB_NAME)}")
 
-def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, systray):
+def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, systray,
+                          backup_state=None, shutdown=None):
     active_thread = None
     last_check_time = datetime.now()
-    backup_state = BackupState()
+    backup_state = backup_state or BackupState()
+    shutdown = shutdown or threading.Event()
     
     # Initialize history manager
     appdata_path = os.getenv('APPDATA')
@@ -1142,7 +1059,7 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
         settings['AGENT_ID']
     )
 
-    while True:
+    while not shutdown.is_set():
         try:
             # Check for date transition in logs
             log_monitor.check_date_transition()
@@ -1161,6 +1078,13 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
                     )
         
             settings = read_yaml_settings_file(settings_file_path)
+            backup_utils.configure_change_detection(settings)
+            hash_utils.configure_hashing(settings)
+            network_utils.configure_session(settings)
+            resumable_upload_utils.configure_resumable_uploads(settings)
+            chunked_upload_utils.configure_chunked_uploads(settings)
+            restore_engine.configure_restore(settings)
+            backup_utils.configure_uploads(settings)
             network_utils.sync_backup_folders(settings)
 
             # Handle keepalive thread
@@ -1190,7 +1114,8 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
                             ignore_hash,
                             systray,
                             history_manager,
-                            operation_id
+                            operation_id,
+                            backup_state
                         )
                         save_file_metadata(settings)
                         backup_state.complete_backup(success=success)
@@ -1208,7 +1133,7 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
                         )
                     
                 last_check_time = current_time
-                sleep(ACTION_TIMER)
+                shutdown.wait(ACTION_TIMER)
                 
             else:  # Scheduled mode
                 logging.info("Attempting scheduled mode backup...")
@@ -1231,7 +1156,8 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
                                 ignore_hash,
                                 systray,
                                 history_manager,
-                                operation_id
+                                operation_id,
+                                backup_state
                             )
                             save_file_metadata(settings)
                             backup_state.complete_backup(success=success)
@@ -1249,161 +1175,92 @@ def action_loop_and_sleep(settings, settings_file_path, dbconn, ignore_hash, sys
                             )
                 
                 last_check_time = current_time
-                sleep(ACTION_TIMER)
+                shutdown.wait(ACTION_TIMER)
             
         except Exception as e:
             logging.error(f"Error in backup loop: {str(e)}")
-            sleep(ACTION_TIMER)
+            shutdown.wait(ACTION_TIMER)
 
 def perform_backup_with_history(backup_paths, recursive_paths, settings, dbconn, 
-                              ignore_hash, systray, history_manager, operation_id):
-    """Perform backup with history tracking"""
+                              ignore_hash, systray, history_manager, operation_id,
+                              backup_state=None):
+    """
+    Perform backup with history tracking
+
+    Files are hashed and uploaded in parallel by backup_engine.BackupEngine
+    (BACKUP_HASH_WORKERS / BACKUP_UPLOAD_WORKERS in settings). Hash db updates
+    and history records are still written from this thread, in walk order.
+    """
     success = True
     files_processed = False  # Track if we actually processed any files
-    
-    def normalize_path(path):
-        """Normalize path to use forward slashes"""
-        return str(path).replace('\\', '/')
-    
-    def process_path(path, is_recursive=False):
+
+    # Hash db updates for this pass are committed in bulk rather than once per file
+    hash_writer = HashDBWriter(
+        dbconn,
+        flush_count=int(settings.get('HASH_DB_FLUSH_COUNT', 500)),
+        flush_interval=float(settings.get('HASH_DB_FLUSH_SECONDS', 5))
+    ) if dbconn else None
+
+    engine = backup_engine.BackupEngine.from_settings(
+        settings,
+        dbconn,
+        ignore_hash,
+        hash_writer,
+        should_stop=backup_state.stop_requested if backup_state else None
+    )
+
+    def record_result(result):
         nonlocal success, files_processed
-        path = normalize_path(path)
-        
-        try:
-            if os.path.isfile(path):
-                try:
-                    backup_result = backup_utils.process_file(
-                        pathlib.Path(path),
-                        settings['API_KEY'],
-                        settings['AGENT_ID'],
-                        dbconn,
-                        ignore_hash
-                    )
-                    
-                    if backup_result == BackupResult.BACKED_UP:
-                        files_processed = True
-                        history_manager.add_file_record(
-                            operation_id,
-                            path,
-                            OperationStatus.SUCCESS,
-                            None
-                        )
-                    elif backup_result == BackupResult.FAILED:
-                        files_processed = True
-                        success = False
-                        history_manager.add_file_record(
-                            operation_id,
-                            path,
-                            OperationStatus.FAILED,
-                            "Backup operation failed"
-                        )
-                    # Skip recording UNCHANGED files
-                    
-                except Exception as e:
-                    files_processed = True
-                    success = False
-                    error_msg = str(e)
-                    logging.error(f"Error backing up file {path}: {error_msg}")
-                    history_manager.add_file_record(
-                        operation_id,
-                        path,
-                        OperationStatus.FAILED,
-                        error_msg
-                    )
-                    
-            elif is_recursive:  # Directory with recursive backup
-                for root, _, files in os.walk(path):
-                    for file in files:
-                        file_path = normalize_path(os.path.join(root, file))
-                        try:
-                            file_success = backup_utils.process_file(
-                                pathlib.Path(file_path),
-                                settings['API_KEY'],
-                                settings['AGENT_ID'],
-                                dbconn,
-                                ignore_hash
-                            )
-                            status = OperationStatus.SUCCESS if file_success else OperationStatus.FAILED
-                            history_manager.add_file_record(
-                                operation_id, 
-                                file_path, 
-                                status,
-                                None if file_success else "File backup failed"
-                            )
-                            if not file_success:
-                                success = False
-                                logging.error(f"Failed to backup file: {file_path}")
-                        except Exception as e:
-                            success = False
-                            error_msg = str(e)
-                            logging.error(f"Error backing up file {file_path}: {error_msg}")
-                            history_manager.add_file_record(
-                                operation_id,
-                                file_path,
-                                OperationStatus.FAILED,
-                                error_msg
-                            )
-            
-            elif os.path.isdir(path):  # Directory without recursive backup
-                # Only process files in the immediate directory
-                for entry in os.scandir(path):
-                    if entry.is_file():
-                        file_path = normalize_path(entry.path)
-                        try:
-                            file_success = backup_utils.process_file(
-                                pathlib.Path(file_path),
-                                settings['API_KEY'],
-                                settings['AGENT_ID'],
-                                dbconn,
-                                ignore_hash
-                            )
-                            status = OperationStatus.SUCCESS if file_success else OperationStatus.FAILED
-                            history_manager.add_file_record(
-                                operation_id, 
-                                file_path, 
-                                status,
-                                None if file_success else "File backup failed"
-                            )
-                            if not file_success:
-                                success = False
-                                logging.error(f"Failed to backup file: {file_path}")
-                        except Exception as e:
-                            success = False
-                            error_msg = str(e)
-                            logging.error(f"Error backing up file {file_path}: {error_msg}")
-                            history_manager.add_file_record(
-                                operation_id,
-                                file_path,
-                                OperationStatus.FAILED,
-                                error_msg
-                            )
 
-        except Exception as e:
+        if result.status == BackupResult.BACKED_UP:
+            files_processed = True
+            history_manager.add_file_record(
+                operation_id,
+                result.path,
+                OperationStatus.SUCCESS,
+                None
+            )
+        elif result.status == BackupResult.FAILED:
             files_processed = True
             success = False
-            error_msg = f"Error processing path {path}: {str(e)}"
-            logging.error(error_msg)
             history_manager.add_file_record(
                 operation_id,
-                path,
+                result.path,
                 OperationStatus.FAILED,
-                error_msg
+                result.error_message
             )
+        # Skip recording UNCHANGED files
 
-    # Process backup paths
-    logging.info("Processing regular backup paths: %s", backup_paths)
-    for path in backup_paths:
-        process_path(path, False)
+    def record_path_error(path, error_msg):
+        nonlocal success, files_processed
+        files_processed = True
+        success = False
+        history_manager.add_file_record(
+            operation_id,
+            path,
+            OperationStatus.FAILED,
+            error_msg
+        )
 
-    # Process recursive backup paths
-    logging.info("Processing recursive backup paths: %s", recursive_paths)
-    for path in recursive_paths:
-        process_path(path, True)
+    try:
+        logging.info("Processing regular backup paths: %s", backup_paths)
+        logging.info("Processing recursive backup paths: %s", recursive_paths)
+        engine.run(
+            backup_engine.iter_backup_files(backup_paths, recursive_paths, record_path_error),
+            record_result
+        )
+    finally:
+        if hash_writer:
+            hash_writer.flush()
 
     # If no files needed processing, consider it a success
     if not files_processed:
         success = True
 
+    # A stopped backup did not get to every file
+    if engine.stopped:
+        success = False
+
     return success
 
 def parse_schedule(settings):
@@ -1469,7 +1326,8 @@ def _get_install_directory():
 def start_keepalive_thread(freq,api_key,agent_id):
     logging.log(logging.INFO,"starting new keepalive thread with freq %d" % freq)
 
-    t = threading.Thread(target=keepalive_utils.execute_ping_loop,args=(freq,api_key,agent_id))
+    # Daemon, so the ping loop does not keep the process alive after a quit
+    t = threading.Thread(target=keepalive_utils.execute_ping_loop,args=(freq,api_key,agent_id),daemon=True)
     t.start()
 
     logging.log(logging.INFO,"returning from start thread")
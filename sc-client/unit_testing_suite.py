@@ -1,9 +1,12 @@
 import hashlib
+import http.server
+import io
 import json
 import logging
 import os
 import shutil
 import sqlite3
+import tarfile
 import tempfile
 import unittest
 import yaml
@@ -23,7 +26,14 @@ from application_backup_manager import (LoginDialog, StormcloudApp
 					, FilesystemIndexer, FilesystemIndex)
 
 import backup_utils
+import hash_utils
+import backup_engine
+import resumable_upload_utils
+import chunked_upload_utils
 import restore_utils
+import restore_engine
+import keepalive_utils
+import manifest_utils
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow
 							 , QPushButton, QLabel
@@ -47,6 +57,7 @@ import smtplib
 import sqlite3
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import queue
@@ -89,8 +100,8 @@ import restore_utils
 import backup_utils
 import network_utils
 
-from client_db_utils import get_or_create_hash_db
-from stormcloud import save_file_metadata, read_yaml_settings_file
+from client_db_utils import get_or_create_hash_db, HashDBWriter
+from stormcloud import save_file_metadata, read_yaml_settings_file, RestoreChunkManager
 
 # Imports from application
 from application_backup_manager import (InitiationSource, OperationStatus
@@ -225,6 +236,7 @@ class TestUserAuthentication(TestAuthenticationBase):
             
         # Set up network mock
         self.requests_mock = patch('network_utils.requests').start()
+        patch('network_utils.get_session', return_value=self.requests_mock).start()
         
         # Create default mock response
         self.default_response = Mock()
@@ -572,6 +584,7 @@ class TestAppInitialization(QtTestCase):
         
         # Set up network mock
         self.requests_mock = patch('network_utils.requests').start()
+        patch('network_utils.get_session', return_value=self.requests_mock).start()
         
         # Mock successful authentication
         self.requests_mock.post.return_value.ok = True
@@ -1705,13 +1718,15 @@ class TestRemoteFileSystem(QtTestCase):
             }
         ]
         
-        # Create test metadata file
-        self.metadata_path = os.path.join(self.test_dir, 'file_metadata_20250101_100000.json')
-        with open(self.metadata_path, 'w') as f:
-            json.dump(self.test_metadata, f)
+        # Create test manifest
+        self._save_metadata()
             
         self.model = RemoteFileSystemModel()
 
+    def _save_metadata(self):
+        with manifest_utils.ManifestStore(self.test_dir) as store:
+            store.replace_records(self.test_metadata)
+
     def tearDown(self):
         import shutil
         if os.path.exists(self.test_dir):
@@ -1806,8 +1821,7 @@ class TestRemoteFileSystem(QtTestCase):
             for path in test_paths:
                 self.test_metadata[0]['ClientFullNameAndPathAsPosix'] = path
                 
-                with open(self.metadata_path, 'w') as f:
-                    json.dump(self.test_metadata, f)
+                self._save_metadata()
                     
                 self.model.load_data(self.test_dir)
                 root = self.model.invisibleRootItem()
@@ -1839,8 +1853,7 @@ class TestRemoteFileSystem(QtTestCase):
                 'delete': False
             }
             
-            with open(self.metadata_path, 'w') as f:
-                json.dump(self.test_metadata, f)
+            self._save_metadata()
                 
             self.model.load_data(self.test_dir)
             root = self.model.invisibleRootItem()
@@ -1869,7 +1882,7 @@ class TestRemoteFileSystem(QtTestCase):
         
         try:
             # Simulate connection error
-            with patch('builtins.open', side_effect=ConnectionError("Network error")):
+            with patch('manifest_utils.ManifestStore', side_effect=ConnectionError("Network error")):
                 self.model.load_data(self.test_dir)
                 root = self.model.invisibleRootItem()
                 
@@ -1893,7 +1906,7 @@ class TestRemoteFileSystem(QtTestCase):
         
         try:
             # Simulate timeout
-            with patch('builtins.open', side_effect=TimeoutError("Operation timed out")):
+            with patch('manifest_utils.ManifestStore', side_effect=TimeoutError("Operation timed out")):
                 self.model.load_data(self.test_dir)
                 root = self.model.invisibleRootItem()
                 
@@ -5013,6 +5026,7 @@ class TestNetworkOperations(NonQtTestCase):
         
         # Set up network mock
         self.requests_mock = patch('network_utils.requests').start()
+        patch('network_utils.get_session', return_value=self.requests_mock).start()
         
         # Initialize test tracking
         self.test_result = None
@@ -5882,6 +5896,1385 @@ class TestPerformance(QtTestCase):
             except Empty:
                 continue
 
+class TestHTTPSession(NonQtTestCase):
+    """Test suite for the shared HTTP session in network_utils"""
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'   # keep connections open between requests
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = b'{"SUCCESS": true}'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        """Start a local keep-alive server and a fresh session"""
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/api/test' % self.server.server_port
+
+        network_utils.configure_session({'HTTP_POOL_SIZE': 3, 'HTTP_MAX_RETRIES': 1})
+        self.test_result = None
+
+    def tearDown(self):
+        """Stop the server and drop the session"""
+        network_utils.configure_session({})
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_reused(self):
+        """Test that sequential requests share one kept-alive connection"""
+        self.test_result = TestResult(
+            "http-session-reuse",
+            "Network Operations",
+            "HTTP Session",
+            "Connection Reuse"
+        )
+
+        try:
+            self.assertIs(network_utils.get_session(), network_utils.get_session())
+
+            for i in range(5):
+                response = network_utils.get_session().post(
+                    self.url, json={'request': i}, timeout=network_utils.get_timeout()
+                )
+                self.assertEqual(response.status_code, 200)
+
+            stats = network_utils.get_connection_stats()
+            self.assertEqual(stats['requests'], 5)
+            self.assertEqual(stats['connections_opened'], 1)
+            self.assertEqual(stats['reused'], 4)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_upload_streams_file(self):
+        """Test that uploads stream the file in bounded blocks and hash what was sent"""
+        self.test_result = TestResult(
+            "http-session-stream",
+            "Network Operations",
+            "HTTP Session",
+            "Streaming Upload"
+        )
+
+        try:
+            test_dir = tempfile.mkdtemp()
+            file_path = os.path.join(test_dir, 'upload.bin')
+            content = os.urandom(3 * 1024 * 1024)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+
+            file_hash = hashlib.blake2b()
+            with patch.object(network_utils, 'API_ENDPOINT_BACKUP_FILE_STREAM', self.url):
+                status = network_utils.ship_file_to_server('test_key', 'test_agent', file_path, file_hash)
+
+            self.assertEqual(status, 200)
+            self.assertEqual(file_hash.hexdigest(), hashlib.blake2b(content).hexdigest())
+
+            if network_utils._urllib3_supports_blocksize():
+                pool_kw = network_utils.get_session().get_adapter('http://').poolmanager.connection_pool_kw
+                self.assertEqual(pool_kw['blocksize'], network_utils.UPLOAD_BUFFER_SIZE)
+
+            shutil.rmtree(test_dir, ignore_errors=True)
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_reconfigure_rebuilds_session(self):
+        """Test that changed settings replace the session and unchanged ones keep it"""
+        self.test_result = TestResult(
+            "http-session-config",
+            "Network Operations",
+            "HTTP Session",
+            "Session Configuration"
+        )
+
+        try:
+            session = network_utils.get_session()
+
+            network_utils.configure_session({'HTTP_POOL_SIZE': 3, 'HTTP_MAX_RETRIES': 1})
+            self.assertIs(network_utils.get_session(), session)
+
+            network_utils.configure_session({'HTTP_POOL_SIZE': 3, 'HTTP_MAX_RETRIES': 1, 'HTTP_READ_TIMEOUT': 30})
+            self.assertIsNot(network_utils.get_session(), session)
+            self.assertEqual(network_utils.get_timeout()[1], 30)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestHashDatabase(NonQtTestCase):
+    """Test suite for hash database change detection"""
+
+    def setUp(self):
+        """Set up test environment"""
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, 'schash.db')
+        self.file_path = os.path.join(self.test_dir, 'tracked.txt')
+
+        with open(self.file_path, 'wb') as f:
+            f.write(b'original content')
+
+        self.conn = get_or_create_hash_db(self.db_path)
+        backup_utils.configure_change_detection({})
+        hash_utils.configure_hashing({})
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        self.conn.close()
+        try:
+            shutil.rmtree(self.test_dir)
+        except Exception as e:
+            logging.warning(f"Failed to clean up test directory: {e}")
+
+    def _record_file(self):
+        """Store the file in the hash db as if it had been verified a while ago"""
+        two_hours_ago = time.time() - 7200
+        os.utime(self.file_path, (two_hours_ago, two_hours_ago))
+
+        backup_utils.update_hash_db(Path(self.file_path), self.conn)
+        self.conn.execute("UPDATE files SET verified_at = verified_at - 3600")
+        self.conn.commit()
+
+    def test_unchanged_file_skips_hash(self):
+        """Test that matching size/mtime/file id avoids reading the file"""
+        self.test_result = TestResult(
+            "hashdb-fast-path",
+            "Hash Database",
+            "Change Detection",
+            "Metadata Fast Path"
+        )
+
+        try:
+            self._record_file()
+
+            with patch('hash_utils.hash_file') as mock_hash:
+                status = backup_utils.check_hash_db(Path(self.file_path), self.conn)
+
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_NO_CHANGE)
+            mock_hash.assert_not_called()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_modified_file_detected(self):
+        """Test that a stat change falls back to hashing and reports the change"""
+        self.test_result = TestResult(
+            "hashdb-modified",
+            "Hash Database",
+            "Change Detection",
+            "Modified File"
+        )
+
+        try:
+            self._record_file()
+
+            with open(self.file_path, 'ab') as f:
+                f.write(b' plus more')
+
+            status = backup_utils.check_hash_db(Path(self.file_path), self.conn)
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_CHANGE)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_paranoid_sweep_rehashes(self):
+        """Test that the periodic full verify hashes files with matching stat"""
+        self.test_result = TestResult(
+            "hashdb-paranoid",
+            "Hash Database",
+            "Change Detection",
+            "Paranoid Verify"
+        )
+
+        try:
+            self._record_file()
+            backup_utils.configure_change_detection({'PARANOID_VERIFY_HOURS': 0.5})
+
+            with patch('hash_utils.hash_file', wraps=hash_utils.hash_file) as mock_hash:
+                status = backup_utils.check_hash_db(Path(self.file_path), self.conn)
+
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_NO_CHANGE)
+            mock_hash.assert_called_once()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_batched_writer(self):
+        """Test that the hash db writer commits in bulk and upserts by file name"""
+        self.test_result = TestResult(
+            "hashdb-batch-writer",
+            "Hash Database",
+            "Batched Writes",
+            "Batched Writer"
+        )
+
+        try:
+            file_stat = os.stat(self.file_path)
+            count_rows = lambda: self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+            with HashDBWriter(self.conn, flush_count=2, flush_interval=3600) as writer:
+                writer.record(self.file_path, 'first', file_stat)
+                self.assertEqual(count_rows(), 0)
+
+                # Same file again collapses into one pending row
+                writer.record(self.file_path, 'second', file_stat)
+                self.assertEqual(count_rows(), 0)
+
+                writer.record(os.path.join(self.test_dir, 'other.txt'), 'third', file_stat)
+                self.assertEqual(count_rows(), 2)
+
+                writer.record(self.file_path, 'fourth', file_stat)
+
+            # Leaving the context flushes, updating the existing row in place
+            self.assertEqual(count_rows(), 2)
+            md5 = self.conn.execute("SELECT md5 FROM files WHERE file_name = ?", (self.file_path,)).fetchone()[0]
+            self.assertEqual(md5, 'fourth')
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_changed_file_hashed_during_upload(self):
+        """Test that a changed file is read once and its digest stored after upload"""
+        self.test_result = TestResult(
+            "hashdb-single-pass",
+            "Hash Database",
+            "Change Detection",
+            "Single Pass Hashing"
+        )
+
+        try:
+            self._record_file()
+
+            with open(self.file_path, 'wb') as f:
+                f.write(b'completely new content')
+
+            def fake_ship(api_key, agent_id, path, file_hash=None):
+                with open(path, 'rb') as f:
+                    file_hash.update(f.read())
+                return 200
+
+            with patch('network_utils.ship_file_to_server', side_effect=fake_ship) as mock_ship, \
+                 patch('hash_utils.hash_file') as mock_hash:
+                result = backup_utils.process_file(
+                    Path(self.file_path), 'test_key', 'test_agent', self.conn, False
+                )
+
+            self.assertTrue(result)
+            mock_ship.assert_called_once()
+            mock_hash.assert_not_called()
+
+            digest, algorithm = self.conn.execute(
+                "SELECT md5, hash_algorithm FROM files WHERE file_name = ?", (self.file_path,)
+            ).fetchone()
+            self.assertEqual(algorithm, 'blake2b')
+            self.assertEqual(digest, hashlib.blake2b(b'completely new content').hexdigest())
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_legacy_db_migration(self):
+        """Test that a hash db created before the stat columns is upgraded"""
+        self.test_result = TestResult(
+            "hashdb-migration",
+            "Hash Database",
+            "Schema",
+            "Legacy Migration"
+        )
+
+        try:
+            legacy_path = os.path.join(self.test_dir, 'legacy.db')
+            with sqlite3.connect(legacy_path) as conn:
+                conn.execute("CREATE TABLE files ([file_id] INTEGER PRIMARY KEY, [file_name] TEXT, [md5] TEXT)")
+                conn.execute("INSERT INTO files (file_name, md5) VALUES (?, ?)", (self.file_path, 'abc'))
+            conn.close()
+
+            conn = get_or_create_hash_db(legacy_path)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+            for column in ('size', 'mtime_ns', 'inode', 'verified_at', 'hash_algorithm'):
+                self.assertIn(column, columns)
+
+            # Legacy rows have no stat data, so they must still be hashed
+            status = backup_utils.check_hash_db(Path(self.file_path), conn)
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_CHANGE)
+            conn.close()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_md5_rows_migrate_lazily(self):
+        """Test that an unchanged file stored with MD5 is re-recorded with the configured algorithm"""
+        self.test_result = TestResult(
+            "hashdb-algorithm-migration",
+            "Hash Database",
+            "Schema",
+            "Hash Algorithm Migration"
+        )
+
+        try:
+            self.conn.execute(
+                "INSERT INTO files (file_name, md5) VALUES (?, ?)",
+                (self.file_path, hashlib.md5(b'original content').hexdigest())
+            )
+            self.conn.commit()
+
+            status = backup_utils.check_hash_db(Path(self.file_path), self.conn)
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_NO_CHANGE)
+
+            digest, algorithm = self.conn.execute(
+                "SELECT md5, hash_algorithm FROM files WHERE file_name = ?", (self.file_path,)
+            ).fetchone()
+            self.assertEqual(algorithm, 'blake2b')
+            self.assertEqual(digest, hashlib.blake2b(b'original content').hexdigest())
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestBackupEngine(NonQtTestCase):
+    """Test suite for the parallel backup engine"""
+
+    def setUp(self):
+        """Set up test environment"""
+        self.test_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.test_dir, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'nested'))
+
+        for i in range(12):
+            folder = self.source_dir if i % 2 else os.path.join(self.source_dir, 'nested')
+            with open(os.path.join(folder, f'doc_{i:02d}.txt'), 'wb') as f:
+                f.write(f'document {i}'.encode())
+
+        self.conn = get_or_create_hash_db(os.path.join(self.test_dir, 'schash.db'))
+        backup_utils.configure_change_detection({})
+        hash_utils.configure_hashing({})
+
+        self.active_uploads = 0
+        self.max_active_uploads = 0
+        self.batch_sizes = []
+        self.upload_lock = threading.Lock()
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        self.conn.close()
+        try:
+            shutil.rmtree(self.test_dir)
+        except Exception as e:
+            logging.warning(f"Failed to clean up test directory: {e}")
+
+    def _fake_ship(self, api_key, agent_id, path, file_hash=None):
+        with self.upload_lock:
+            self.active_uploads += 1
+            self.max_active_uploads = max(self.max_active_uploads, self.active_uploads)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if file_hash:
+            file_hash.update(data)
+        time.sleep(0.05)
+
+        with self.upload_lock:
+            self.active_uploads -= 1
+        return 200
+
+    def _fake_ship_batch(self, api_key, agent_id, entries):
+        self.batch_sizes.append(len(entries))
+        return [self._fake_ship(api_key, agent_id, path, file_hash) for path, file_hash in entries]
+
+    def _run_engine(self, should_stop=None, on_result=None, upload_workers=4, batch_max_files=0):
+        results = []
+        engine = backup_engine.BackupEngine(
+            'test_key', 'test_agent', self.conn, False,
+            hash_workers=1, upload_workers=upload_workers, should_stop=should_stop,
+            batch_max_files=batch_max_files
+        )
+
+        def collect(result):
+            results.append(result)
+            if on_result:
+                on_result(result)
+
+        engine.run(backup_engine.iter_backup_files([], [self.source_dir]), collect)
+        return engine, results
+
+    def test_parallel_uploads_in_walk_order(self):
+        """Test that uploads overlap while results and hash db rows follow the walk"""
+        self.test_result = TestResult(
+            "engine-parallel",
+            "Backup Engine",
+            "Pipeline",
+            "Parallel Uploads"
+        )
+
+        try:
+            with patch('network_utils.ship_file_to_server', side_effect=self._fake_ship):
+                engine, results = self._run_engine()
+
+            walked = list(backup_engine.iter_backup_files([], [self.source_dir]))
+            self.assertEqual([r.path for r in results], walked)
+            self.assertTrue(all(r.status == backup_engine.BACKED_UP for r in results))
+            self.assertGreater(self.max_active_uploads, 1)
+
+            stored = self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            self.assertEqual(stored, 12)
+            self.assertEqual(engine.get_stats()["upload"]["files"], 12)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_unchanged_files_not_uploaded(self):
+        """Test that a second pass over unchanged files uploads nothing"""
+        self.test_result = TestResult(
+            "engine-unchanged",
+            "Backup Engine",
+            "Pipeline",
+            "Unchanged Files"
+        )
+
+        try:
+            with patch('network_utils.ship_file_to_server', side_effect=self._fake_ship):
+                self._run_engine()
+
+            with patch('network_utils.ship_file_to_server') as mock_ship:
+                _, results = self._run_engine()
+
+            mock_ship.assert_not_called()
+            self.assertTrue(all(r.status == backup_engine.UNCHANGED for r in results))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_small_files_batched(self):
+        """Test that small changed files are packed into batch uploads"""
+        self.test_result = TestResult(
+            "engine-batch",
+            "Backup Engine",
+            "Pipeline",
+            "Batched Uploads"
+        )
+
+        try:
+            with patch('network_utils.upload_file_batch', side_effect=self._fake_ship_batch), \
+                 patch('network_utils.ship_file_to_server') as mock_ship:
+                engine, results = self._run_engine(batch_max_files=5)
+
+            mock_ship.assert_not_called()
+            self.assertEqual(sum(self.batch_sizes), 12)
+            self.assertTrue(all(size <= 5 for size in self.batch_sizes))
+            self.assertLess(len(self.batch_sizes), 12)
+            self.assertTrue(all(r.status == backup_engine.BACKED_UP for r in results))
+
+            expected = hashlib.blake2b(b'document 3').hexdigest()
+            stored = self.conn.execute(
+                "SELECT md5 FROM files WHERE file_name LIKE ?", ('%doc_03.txt',)
+            ).fetchone()[0]
+            self.assertEqual(stored, expected)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_stop_requested(self):
+        """Test that a stop request finishes in-flight files but starts no new ones"""
+        self.test_result = TestResult(
+            "engine-stop",
+            "Backup Engine",
+            "Pipeline",
+            "Stop Requested"
+        )
+
+        try:
+            stop = threading.Event()
+
+            with patch('network_utils.ship_file_to_server', side_effect=self._fake_ship):
+                engine, results = self._run_engine(
+                    should_stop=stop.is_set, on_result=lambda r: stop.set(), upload_workers=1
+                )
+
+            self.assertTrue(engine.stopped)
+            self.assertLess(len(results), 12)
+            self.assertTrue(all(r.status == backup_engine.BACKED_UP for r in results))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestResumableUpload(NonQtTestCase):
+    """Test suite for resumable chunked uploads"""
+
+    def setUp(self):
+        """Set up a file and an in-memory stand-in for the server's upload sessions"""
+        self.test_dir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.test_dir, 'upload_sessions')
+        self.file_path = os.path.join(self.test_dir, 'large.bin')
+        self.content = os.urandom(5 * 1024 + 17)
+
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+
+        self.sessions = {}
+        self.chunks_sent = []
+        self.failing_chunks = set()
+
+        patch('network_utils.create_upload_session', side_effect=self._create).start()
+        patch('network_utils.upload_session_chunk', side_effect=self._put).start()
+        patch('network_utils.get_upload_session_status', side_effect=self._status).start()
+        patch('network_utils.commit_upload_session', side_effect=self._commit).start()
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _create(self, api_key, agent_id, path, file_size, chunk_size):
+        session_id = 'session%d' % len(self.sessions)
+        total_chunks = -(-file_size // chunk_size)
+        self.sessions[session_id] = {'chunks': {}, 'total_chunks': total_chunks, 'chunk_size': chunk_size}
+        return 200, {'session_id': session_id, 'chunk_size': chunk_size, 'total_chunks': total_chunks}
+
+    def _put(self, api_key, agent_id, session_id, index, chunk, chunk_sha256):
+        self.chunks_sent.append(index)
+        if index in self.failing_chunks:
+            return 503
+        self.assertEqual(hashlib.sha256(chunk).hexdigest(), chunk_sha256)
+        self.sessions[session_id]['chunks'][index] = chunk
+        return 200
+
+    def _status(self, api_key, agent_id, session_id):
+        session = self.sessions[session_id]
+        return 200, {'received_chunks': list(session['chunks']), 'total_chunks': session['total_chunks'],
+                     'chunk_size': session['chunk_size']}
+
+    def _commit(self, api_key, agent_id, session_id):
+        session = self.sessions[session_id]
+        self.committed = b''.join(session['chunks'][i] for i in range(session['total_chunks']))
+        return 200, {}
+
+    def _upload(self, file_hash=None):
+        upload = resumable_upload_utils.ResumableUpload(
+            self.file_path, 'test_key', 'test_agent', chunk_size=1024, state_directory=self.state_dir
+        )
+        return upload.upload(file_hash)
+
+    def test_resume_sends_only_missing_chunks(self):
+        """Test that a failed upload resumes from the chunks the server already has"""
+        self.test_result = TestResult(
+            "resumable-upload-resume",
+            "Network Operations",
+            "Resumable Upload",
+            "Resume After Failure"
+        )
+
+        try:
+            self.failing_chunks = {3}
+            self.assertEqual(self._upload(), 503)
+            self.assertEqual(len(os.listdir(self.state_dir)), 1)
+
+            self.chunks_sent = []
+            self.failing_chunks = set()
+            file_hash = hashlib.blake2b()
+            self.assertEqual(self._upload(file_hash), 200)
+
+            self.assertEqual(self.chunks_sent, [3, 4, 5])
+            self.assertEqual(self.committed, self.content)
+            self.assertEqual(file_hash.hexdigest(), hashlib.blake2b(self.content).hexdigest())
+            self.assertEqual(os.listdir(self.state_dir), [])
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_changed_file_starts_new_session(self):
+        """Test that saved session state is not reused once the file has changed"""
+        self.test_result = TestResult(
+            "resumable-upload-changed",
+            "Network Operations",
+            "Resumable Upload",
+            "Changed File"
+        )
+
+        try:
+            self.failing_chunks = {2}
+            self.assertEqual(self._upload(), 503)
+
+            with open(self.file_path, 'ab') as f:
+                f.write(b'appended')
+            self.content += b'appended'
+
+            self.failing_chunks = set()
+            self.assertEqual(self._upload(), 200)
+
+            self.assertEqual(len(self.sessions), 2)
+            self.assertEqual(self.committed, self.content)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestChunkedUpload(NonQtTestCase):
+    """Test suite for content-defined chunking and chunked uploads"""
+
+    def setUp(self):
+        """Set up test files and an in-memory chunk store"""
+        self.test_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.test_dir, 'mailbox.pst')
+        self.content = os.urandom(3 * chunked_upload_utils.MAX_CHUNK_SIZE)
+
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+
+        self.chunk_store = {}
+        self.committed = None
+
+        patch('network_utils.find_missing_chunks', side_effect=lambda api_key, agent_id, digests: (
+            200, {'missing': [d for d in digests if d not in self.chunk_store]})).start()
+        patch('network_utils.upload_content_chunk', side_effect=self._put).start()
+        patch('network_utils.commit_chunked_file', side_effect=self._commit).start()
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _put(self, api_key, agent_id, digest, chunk):
+        self.assertEqual(hashlib.sha256(chunk).hexdigest(), digest)
+        self.chunk_store[digest] = chunk
+        return 200
+
+    def _commit(self, api_key, agent_id, path, file_size, chunk_list):
+        chunks = [entry.split(":") for entry in chunk_list.split(",")]
+        self.committed = b''.join(self.chunk_store[digest] for digest, _ in chunks)
+        self.assertEqual(len(self.committed), file_size)
+        return 200, {}
+
+    def _chunk_digests(self):
+        return [hashlib.sha256(data).hexdigest() for _, data in chunked_upload_utils.iter_chunks(self.file_path)]
+
+    def test_insert_only_changes_nearby_chunks(self):
+        """Test that inserting data in the middle of a file keeps the other chunks"""
+        self.test_result = TestResult(
+            "chunked-upload-cdc",
+            "Network Operations",
+            "Chunked Upload",
+            "Content Defined Boundaries"
+        )
+
+        try:
+            before = self._chunk_digests()
+
+            with open(self.file_path, 'wb') as f:
+                f.write(self.content[:5000000] + b'inserted' + self.content[5000000:])
+
+            after = self._chunk_digests()
+
+            self.assertTrue(all(len(data) <= chunked_upload_utils.MAX_CHUNK_SIZE
+                                for _, data in chunked_upload_utils.iter_chunks(self.file_path)))
+
+            self.assertGreater(len(before), 3)
+            self.assertLessEqual(len(set(after) - set(before)), 2)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_only_missing_chunks_are_sent(self):
+        """Test that a second upload of a changed file only sends new chunks"""
+        self.test_result = TestResult(
+            "chunked-upload-dedup",
+            "Network Operations",
+            "Chunked Upload",
+            "Missing Chunks Only"
+        )
+
+        try:
+            upload = chunked_upload_utils.ChunkedUpload(self.file_path, 'test_key', 'test_agent')
+            self.assertEqual(upload.upload(), 200)
+            self.assertEqual(self.committed, self.content)
+            self.assertEqual(upload.bytes_sent, len(self.content))
+
+            changed = self.content[:-1000] + os.urandom(1000)
+            with open(self.file_path, 'wb') as f:
+                f.write(changed)
+
+            file_hash = hashlib.blake2b()
+            upload = chunked_upload_utils.ChunkedUpload(self.file_path, 'test_key', 'test_agent')
+            self.assertEqual(upload.upload(file_hash), 200)
+
+            self.assertEqual(self.committed, changed)
+            self.assertLessEqual(upload.bytes_sent, chunked_upload_utils.MAX_CHUNK_SIZE)
+            self.assertEqual(file_hash.hexdigest(), hashlib.blake2b(changed).hexdigest())
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_no_chunking_without_extension(self):
+        """Test that large files are not chunked when the fastcdc extension is missing"""
+        self.test_result = TestResult(
+            "chunked-upload-no-extension",
+            "Network Operations",
+            "Chunked Upload",
+            "Pure Python Fallback"
+        )
+
+        try:
+            size = 2 * chunked_upload_utils.chunked_upload_threshold
+
+            with patch('chunked_upload_utils.fastcdc_ext', None):
+                self.assertFalse(chunked_upload_utils.use_chunked_upload(size))
+
+            with patch('chunked_upload_utils.fastcdc_ext', object()):
+                self.assertTrue(chunked_upload_utils.use_chunked_upload(size))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestKnownFileUpload(NonQtTestCase):
+    """Test suite for backing up files the server already has the content of"""
+
+    def setUp(self):
+        """Set up a changed file"""
+        self.test_dir = tempfile.mkdtemp()
+        self.file_path = Path(self.test_dir) / 'report.docx'
+        self.content = os.urandom(512 * 1024)
+        self.file_path.write_bytes(self.content)
+
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+
+        self.ship_mock = patch('network_utils.ship_file_to_server', return_value=200).start()
+        patch('hash_utils.hash_algorithm', 'sha256').start()
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_known_content_is_not_uploaded(self):
+        """Test that a file whose SHA-256 the server knows is backed up without an upload"""
+        self.test_result = TestResult(
+            "known-file-skip",
+            "Network Operations",
+            "Known File",
+            "Skip Upload"
+        )
+
+        try:
+            known_mock = patch('network_utils.backup_known_file', return_value=200).start()
+
+            with patch('hash_utils.hash_file', side_effect=AssertionError("file was read")):
+                ret, digest, _ = backup_utils.upload_changed_file(self.file_path, 'test_key', 'test_agent', self.sha256)
+
+            self.assertEqual(ret, 200)
+            self.assertEqual(digest, self.sha256)
+            self.assertEqual(known_mock.call_args[0][4], self.sha256)
+            self.ship_mock.assert_not_called()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_unknown_content_is_uploaded(self):
+        """Test that unknown content, small files and files not yet hashed are uploaded as usual"""
+        self.test_result = TestResult(
+            "known-file-upload",
+            "Network Operations",
+            "Known File",
+            "Upload Unknown"
+        )
+
+        try:
+            known_mock = patch('network_utils.backup_known_file', return_value=404).start()
+
+            ret, digest, _ = backup_utils.upload_changed_file(self.file_path, 'test_key', 'test_agent', self.sha256)
+            self.assertEqual(ret, 200)
+            self.assertEqual(digest, self.sha256)
+            self.assertEqual(self.ship_mock.call_count, 1)
+
+            small_file = Path(self.test_dir) / 'small.txt'
+            small_file.write_bytes(b'small')
+            backup_utils.upload_changed_file(small_file, 'test_key', 'test_agent', hashlib.sha256(b'small').hexdigest())
+
+            # Not hashed by change detection: uploaded (and hashed) without an offer
+            backup_utils.upload_changed_file(self.file_path, 'test_key', 'test_agent')
+
+            self.assertEqual(known_mock.call_count, 1)
+            self.assertEqual(self.ship_mock.call_count, 3)
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_changed_file_offered_with_default_algorithm(self):
+        """Test that change detection with the default algorithm leaves a SHA-256 to offer"""
+        self.test_result = TestResult(
+            "known-file-default-algorithm",
+            "Network Operations",
+            "Known File",
+            "Default Hash Algorithm"
+        )
+
+        try:
+            patch('hash_utils.hash_algorithm', hash_utils.DEFAULT_HASH_ALGORITHM).start()
+            known_mock = patch('network_utils.backup_known_file', return_value=200).start()
+
+            hash_row = (str(self.file_path), 'stale', None, None, None, None, hash_utils.DEFAULT_HASH_ALGORITHM)
+            status, digest, file_stat, _ = backup_utils.compare_with_hash_row(str(self.file_path), hash_row)
+            self.assertEqual(status, backup_utils.BACKUP_STATUS_CHANGE)
+
+            with patch('hash_utils.hash_file', side_effect=AssertionError("file was read")):
+                ret, stored_digest, _ = backup_utils.upload_changed_file(self.file_path, 'test_key', 'test_agent', digest, file_stat)
+
+            self.assertEqual(ret, 200)
+            self.assertEqual(stored_digest, digest)
+            self.assertEqual(known_mock.call_args[0][4], self.sha256)
+            self.ship_mock.assert_not_called()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestStreamingRestore(NonQtTestCase):
+    """Test suite for restoring files from the streaming restore endpoint"""
+
+    def setUp(self):
+        """Set up a restore destination"""
+        self.test_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.test_dir, 'restored', 'file.bin')
+        self.content = os.urandom(64 * 1024)
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_file_is_streamed_to_destination(self):
+        """Test that the streamed content replaces the destination only when complete"""
+        self.test_result = TestResult(
+            "streaming-restore-success",
+            "Restore Operations",
+            "Streaming Restore",
+            "Stream To Disk"
+        )
+
+        try:
+            def download(api_key, agent_id, path, target_file, version_id=None, progress_callback=None):
+                self.assertFalse(os.path.exists(self.destination))
+                target_file.write(self.content)
+                return 200, {'Content-Type': 'application/octet-stream'}
+
+            patch('network_utils.download_file', side_effect=download).start()
+            confirm_mock = patch('network_utils.confirm_restore', return_value=200).start()
+
+            self.assertTrue(restore_utils.restore_file(self.destination, 'test_key', 'test_agent'))
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+            self.assertEqual(os.listdir(os.path.dirname(self.destination)), ['file.bin'])
+
+            # Confirmed once the file is in place, not before
+            confirm_mock.assert_called_once_with('test_key', 'test_agent', self.destination)
+
+            # Previews and older versions are not what a queued restore asked for
+            confirm_mock.reset_mock()
+            os.remove(self.destination)
+            self.assertTrue(restore_utils.restore_file('/original/file.bin', 'test_key', 'test_agent',
+                                                       preview_path=self.destination))
+            os.remove(self.destination)
+            self.assertTrue(restore_utils.restore_file(self.destination, 'test_key', 'test_agent', version_id=3))
+            confirm_mock.assert_not_called()
+
+            patch('network_utils.download_file', return_value=(500, {})).start()
+            self.assertFalse(restore_utils.restore_file(self.destination, 'test_key', 'test_agent'))
+            confirm_mock.assert_not_called()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_unconfirmed_restore_is_reported(self):
+        """Test that a queued restore the server was not told about is retried later, not at once"""
+        self.test_result = TestResult(
+            "streaming-restore-unconfirmed",
+            "Restore Operations",
+            "Streaming Restore",
+            "Unconfirmed Restore"
+        )
+
+        try:
+            def download(api_key, agent_id, path, target_file, version_id=None, progress_callback=None):
+                target_file.write(self.content)
+                return 200, {'Content-Type': 'application/octet-stream'}
+
+            patch('network_utils.download_file', side_effect=download).start()
+            confirm_mock = patch('network_utils.confirm_restore', return_value=500).start()
+
+            self.assertEqual(restore_utils.restore_queued_file(self.destination, 'test_key', 'test_agent'), (True, False))
+            self.assertFalse(keepalive_utils.process_keepalive_response(
+                {'restore_queue': [self.destination]}, 'test_key', 'test_agent'))
+
+            confirm_mock.return_value = 200
+            self.assertTrue(keepalive_utils.process_keepalive_response(
+                {'restore_queue': [self.destination]}, 'test_key', 'test_agent'))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_old_server_falls_back_to_json_restore(self):
+        """Test that a server without the streaming endpoint is restored from through the JSON endpoint"""
+        self.test_result = TestResult(
+            "streaming-restore-fallback",
+            "Restore Operations",
+            "Streaming Restore",
+            "JSON Fallback"
+        )
+
+        try:
+            patch('network_utils.download_file', return_value=(404, {'Content-Type': 'text/html'})).start()
+            json_mock = patch('network_utils.tls_send_json_data_get', return_value=(
+                0, {'file_content': b64encode(self.content).decode('utf-8')})).start()
+
+            self.assertTrue(restore_utils.restore_file('/original/file.bin', 'test_key', 'test_agent',
+                                                       preview_path=self.destination))
+            self.assertEqual(json_mock.call_count, 1)
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+
+            json_mock.reset_mock()
+            patch('network_utils.download_file', return_value=(404, {'Content-Type': 'application/json'})).start()
+            self.assertFalse(restore_utils.restore_file('/original/missing.bin', 'test_key', 'test_agent',
+                                                        preview_path=self.destination))
+            json_mock.assert_not_called()
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestParallelRestore(NonQtTestCase):
+    """Test suite for restoring files as parallel byte ranges"""
+
+    def setUp(self):
+        """Set up a restore destination and a fake file on the server"""
+        self.test_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.test_dir, 'restored', 'file.bin')
+        self.content = os.urandom(10 * 1000)
+        self.range_size = 1000
+        self.requested_offsets = []
+        self.test_result = None
+
+        patch('network_utils.get_download_info', return_value=(200, {
+            'Content-Length': str(len(self.content)),
+            'ETag': '"v1"',
+            'X-Content-SHA256': hashlib.sha256(self.content).hexdigest()
+        })).start()
+        self.confirm_mock = patch('network_utils.confirm_restore', return_value=200).start()
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _download(self, failing_offset=None, content=None):
+        def download(api_key, agent_id, path, target_file, version_id=None, offset=0, length=None,
+                     progress_callback=None, etag=None):
+            self.assertEqual(etag, '"v1"')
+            self.requested_offsets.append(offset)
+            if offset == failing_offset:
+                return 500, {}
+            target_file.write((content or self.content)[offset:offset + length])
+            return 206, {}
+        return download
+
+    def _restore(self):
+        return restore_engine.ParallelRestore('/original/file.bin', 'test_key', 'test_agent', destination=self.destination,
+                                              range_size=self.range_size, workers=3).restore()
+
+    def test_interrupted_restore_resumes_missing_ranges(self):
+        """Test that a failed restore keeps finished ranges and a retry only downloads the rest"""
+        self.test_result = TestResult(
+            "parallel-restore-resume",
+            "Restore Operations",
+            "Parallel Restore",
+            "Resume From Bitmap"
+        )
+
+        try:
+            patch('network_utils.download_file', side_effect=self._download(failing_offset=9000)).start()
+            self.assertFalse(self._restore())
+            self.assertFalse(os.path.exists(self.destination))
+            self.assertTrue(os.path.exists(self.destination + '.sc-restore.state'))
+            self.confirm_mock.assert_not_called()
+
+            self.requested_offsets = []
+            patch('network_utils.download_file', side_effect=self._download()).start()
+            self.assertTrue(self._restore())
+
+            # One confirmation for the whole file, not one per range
+            self.confirm_mock.assert_called_once_with('test_key', 'test_agent', '/original/file.bin')
+
+            self.assertIn(9000, self.requested_offsets)
+            self.assertLess(len(self.requested_offsets), 10)
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+            self.assertEqual(os.listdir(os.path.dirname(self.destination)), ['file.bin'])
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_digest_mismatch_discards_download(self):
+        """Test that a file not matching the server's SHA-256 never replaces the destination"""
+        self.test_result = TestResult(
+            "parallel-restore-digest",
+            "Restore Operations",
+            "Parallel Restore",
+            "Digest Check"
+        )
+
+        try:
+            corrupted = bytes([self.content[0] ^ 0xFF]) + self.content[1:]
+            patch('network_utils.download_file', side_effect=self._download(content=corrupted)).start()
+
+            self.assertFalse(self._restore())
+            self.assertEqual(os.listdir(os.path.dirname(self.destination)), [])
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_old_server_falls_back_to_restore_file(self):
+        """Test that the chunk manager restores through restore_file when the server has no streaming endpoint"""
+        self.test_result = TestResult(
+            "parallel-restore-fallback",
+            "Restore Operations",
+            "Parallel Restore",
+            "JSON Fallback"
+        )
+
+        try:
+            patch('network_utils.get_download_info', return_value=(404, {'Content-Type': 'text/html'})).start()
+            restore_mock = patch('restore_utils.restore_file', return_value=True).start()
+
+            manager = RestoreChunkManager('/original/file.bin', 'test_key', 'test_agent', chunk_size=self.range_size)
+            self.assertTrue(manager.restore_file())
+            restore_mock.assert_called_once_with('/original/file.bin', 'test_key', 'test_agent')
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestBulkRestore(NonQtTestCase):
+    """Test suite for restoring many files from one streamed archive"""
+
+    def setUp(self):
+        """Set up restore destinations"""
+        self.test_dir = tempfile.mkdtemp().replace('\\', '/')
+        self.paths = [self.test_dir + '/project/file%d.txt' % i for i in range(3)]
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _archive_response(self, members, status_code=200, content_type='application/x-tar'):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w', format=tarfile.PAX_FORMAT) as tar:
+            for name, content, digest in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                if digest:
+                    info.pax_headers = {'SC.sha256': digest}
+                tar.addfile(info, io.BytesIO(content))
+        archive.seek(0)
+
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {'Content-Type': content_type}
+        response.raw = archive
+        return response
+
+    def test_archive_is_unpacked_to_requested_paths(self):
+        """Test that requested files are written, and unrequested, missing or corrupt ones are not"""
+        self.test_result = TestResult(
+            "bulk-restore-unpack",
+            "Restore Operations",
+            "Bulk Restore",
+            "Unpack Archive"
+        )
+
+        try:
+            good = b'restored content'
+            outside = self.test_dir + '/elsewhere.txt'
+            archive_mock = patch('network_utils.open_restore_archive', return_value=self._archive_response([
+                (self.paths[0], good, hashlib.sha256(good).hexdigest()),
+                (outside, b'not requested', None),
+                (self.paths[1], b'corrupted', hashlib.sha256(good).hexdigest())
+            ])).start()
+
+            progress = []
+            results = restore_utils.restore_files(self.paths, 'test_key', 'test_agent',
+                                                  progress_callback=lambda path, success: progress.append((path, success)))
+
+            self.assertEqual(archive_mock.call_count, 1)
+            self.assertEqual(results, {self.paths[0]: True, self.paths[1]: False, self.paths[2]: False})
+            self.assertEqual(len(progress), 3)
+            with open(self.paths[0], 'rb') as f:
+                self.assertEqual(f.read(), good)
+            self.assertFalse(os.path.exists(outside))
+            self.assertEqual(os.listdir(os.path.dirname(self.paths[0])), ['file0.txt'])
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_old_server_has_no_archive_endpoint(self):
+        """Test that a server without the archive endpoint is reported so callers restore file by file"""
+        self.test_result = TestResult(
+            "bulk-restore-fallback",
+            "Restore Operations",
+            "Bulk Restore",
+            "No Endpoint"
+        )
+
+        try:
+            patch('network_utils.open_restore_archive',
+                  return_value=self._archive_response([], status_code=404, content_type='text/html')).start()
+            self.assertIsNone(restore_utils.restore_files(self.paths, 'test_key', 'test_agent'))
+
+            patch('network_utils.open_restore_archive',
+                  return_value=self._archive_response([], status_code=401, content_type='application/json')).start()
+            self.assertEqual(restore_utils.restore_files(self.paths, 'test_key', 'test_agent'),
+                             {path: False for path in self.paths})
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+class TestManifestSync(NonQtTestCase):
+    """Test suite for keeping the local file manifest in sync with the server"""
+
+    def setUp(self):
+        """Set up manifest directory"""
+        self.test_dir = tempfile.mkdtemp()
+        self.test_result = None
+
+    def tearDown(self):
+        """Clean up test environment"""
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _record(self, path, size):
+        return {'ClientFullNameAndPathAsPosix': path, 'FileName': path.split('/')[-1], 'FileSize': size}
+
+    def _stream(self, header, records, end=True, status_code=200):
+        lines = [header] + records + ([{'end': True, 'count': len(records)}] if end else [])
+
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {'Content-Type': 'application/x-ndjson'}
+        response.iter_lines.return_value = [json.dumps(line).encode('utf-8') for line in lines]
+        return response
+
+    def test_snapshot_then_changes(self):
+        """Test that a full snapshot is followed by deltas requested with the server's cursor"""
+        self.test_result = TestResult(
+            "manifest-sync-delta",
+            "Backup Operations",
+            "Manifest Sync",
+            "Snapshot And Delta"
+        )
+
+        try:
+            patch('manifest_utils.WRITE_BATCH', 2).start()
+            responses = [
+                self._stream({'full': True, 'cursor': 'e:5', 'device': {'DeviceName': 'pc'}},
+                             [self._record('C:/a.txt', 1), self._record('C:/b.txt', 2), self._record('C:/d.txt', 4)]),
+                self._stream({'full': False, 'cursor': 'e:7'}, [self._record('C:/b.txt', 20), self._record('C:/c.txt', 3)]),
+                self._stream({'full': False, 'cursor': 'e:7'}, [])
+            ]
+            open_mock = patch('network_utils.open_file_metadata_changes', side_effect=responses).start()
+
+            self.assertEqual(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir), 3)
+            self.assertEqual(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir), 2)
+            self.assertEqual(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir), 0)
+
+            self.assertEqual([call.args[2] for call in open_mock.call_args_list], ['', 'e:5', 'e:7'])
+
+            with manifest_utils.ManifestStore(self.test_dir) as store:
+                records = list(store.records())
+
+            self.assertEqual([(r['ClientFullNameAndPathAsPosix'], r['FileSize']) for r in records],
+                             [('C:/a.txt', 1), ('C:/b.txt', 20), ('C:/c.txt', 3), ('C:/d.txt', 4)])
+            self.assertTrue(all(r['DeviceName'] == 'pc' for r in records))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_failed_sync_keeps_manifest(self):
+        """Test that errors, cut off streams and empty snapshots leave the local manifest alone"""
+        self.test_result = TestResult(
+            "manifest-sync-failure",
+            "Backup Operations",
+            "Manifest Sync",
+            "Keep On Failure"
+        )
+
+        try:
+            patch('manifest_utils.WRITE_BATCH', 1).start()
+            patch('network_utils.open_file_metadata_changes', side_effect=[
+                self._stream({'full': True, 'cursor': 'e:1', 'device': {}}, [self._record('C:/a.txt', 1)]),
+                self._stream({}, [], end=False, status_code=404),
+                self._stream({'full': True, 'cursor': 'e2:9', 'device': {}},
+                             [self._record('C:/x.txt', 1), self._record('C:/y.txt', 1)], end=False),
+                self._stream({'full': True, 'cursor': 'e2:0', 'device': {}}, [])
+            ]).start()
+
+            self.assertEqual(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir), 1)
+            self.assertIsNone(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir))
+            self.assertIsNone(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir))
+            self.assertIsNone(manifest_utils.sync_manifest('test_key', 'test_agent', self.test_dir))
+
+            with manifest_utils.ManifestStore(self.test_dir) as store:
+                self.assertEqual([r['ClientFullNameAndPathAsPosix'] for r in store.records()], ['C:/a.txt'])
+                self.assertEqual(store.get_cursor(), 'e:1')
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
+    def test_directory_and_prefix_queries(self):
+        """Test that the manifest answers directory and prefix queries and upgrades an older store"""
+        self.test_result = TestResult(
+            "manifest-queries",
+            "Backup Operations",
+            "Manifest Sync",
+            "Directory And Prefix Queries"
+        )
+
+        try:
+            # A store from before the directory index: dropped, and the cursor with it
+            conn = sqlite3.connect(os.path.join(self.test_dir, manifest_utils.MANIFEST_DB_NAME))
+            conn.execute('''CREATE TABLE files (path TEXT PRIMARY KEY, record TEXT NOT NULL)''')
+            conn.execute('''CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)''')
+            conn.execute('''INSERT INTO files VALUES ('C:/old.txt', '{}')''')
+            conn.execute('''INSERT INTO meta VALUES ('cursor', 'e:3')''')
+            conn.commit()
+            conn.close()
+
+            legacy_snapshot = os.path.join(self.test_dir, 'file_metadata_20250101_100000.json')
+            with open(legacy_snapshot, 'w') as f:
+                json.dump([], f)
+
+            with manifest_utils.ManifestStore(self.test_dir) as store:
+                self.assertEqual(store.count(), 0)
+                self.assertEqual(store.get_cursor(), '')
+
+                store.replace_records([self._record(path, 1) for path in [
+                    'C:/Users/a.txt', 'C:/Users/docs/b.txt', 'C:/Users/docs/c.txt', 'C:/Users2/d.txt', 'D:/e.txt']])
+
+                self.assertEqual([r['FileName'] for r in store.list_directory('C:/Users/docs/')], ['b.txt', 'c.txt'])
+                self.assertEqual([r['FileName'] for r in store.records_under('C:/Users/')], ['a.txt', 'b.txt', 'c.txt'])
+                self.assertEqual([r['FileName'] for r in store.records_under('C:/Users')], ['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+                self.assertEqual(store.directories(), ['C:/Users', 'C:/Users/docs', 'C:/Users2', 'D:'])
+                self.assertEqual(store.get('D:/e.txt')['FileName'], 'e.txt')
+                self.assertIsNone(store.get('D:/missing.txt'))
+
+            manifest_utils.remove_legacy_snapshots(self.test_dir)
+            self.assertFalse(os.path.exists(legacy_snapshot))
+
+            self.test_result.complete('pass')
+
+        except Exception as e:
+            self.test_result.complete('fail', str(e), traceback.format_exc())
+            raise
+
 def create_test_suite():
     """Create organized test suite with proper initialization"""
     suite = unittest.TestSuite()
@@ -5892,7 +7285,17 @@ def create_test_suite():
         TestErrorLogging,
         TestNetworkOperations,
         TestHistoryTracking,
-        TestProcessManagement
+        TestProcessManagement,
+        TestHTTPSession,
+        TestHashDatabase,
+        TestBackupEngine,
+        TestResumableUpload,
+        TestChunkedUpload,
+        TestKnownFileUpload,
+        TestStreamingRestore,
+        TestParallelRestore,
+        TestBulkRestore,
+        TestManifestSync
     ]
     
     # Qt-dependent tests
@@ -0,0 +1,162 @@
+import functools
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import logging_utils
+
+# Short-lived cache of the lookups every authenticated request makes:
+#
+#   api_key_status   api_key  -> "API_KEY_ACTIVE" / "API_KEY_INACTIVE" / ...
+#   customer_id      api_key  -> customer_id
+#   device           agent_id -> the device row
+#
+# Entries live AUTH_CACHE_TTL_SECONDS; lookups that found nothing (unknown
+# keys and agents) are cached too, for the shorter AUTH_CACHE_NEGATIVE_TTL_SECONDS,
+# so a client retrying with a bad key cannot hammer the database either.
+# Lookups that failed (a database error) are not cached at all. Each cache
+# holds at most AUTH_CACHE_MAX_ENTRIES, evicting the least recently used.
+#
+# Writes that change a key or device (database_utils, the Stripe handlers)
+# invalidate the entries they affect. The caches are per process, so in a
+# multi-process deployment another process may serve a deactivated key for
+# up to the TTL.
+DEFAULT_TTL_SECONDS = 60
+DEFAULT_NEGATIVE_TTL_SECONDS = 10
+DEFAULT_MAX_ENTRIES = 10000
+
+def __logger__():
+    return logging_utils.logger
+
+class TTLCache:
+    def __init__(self, name, max_entries, ttl, negative_ttl):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (value, expires, negative), least recently used first
+
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+        # Bumped by every invalidation, so a lookup that was already running
+        # when its key was invalidated does not put the old value back
+        self.generation = 0
+
+    def get(self, key):
+        """Returns (True, value) on a hit, (False, None) on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            if entry[2]:
+                self._negative_hits += 1
+
+            return True, entry[0]
+
+    def put(self, key, value, negative=False, generation=None):
+        expires = time.monotonic() + (self.negative_ttl if negative else self.ttl)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (value, expires, negative)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'negative_hits': self._negative_hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations
+            }
+
+def _make_cache(name):
+    return TTLCache(
+        name,
+        int(os.getenv('AUTH_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+        float(os.getenv('AUTH_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+        float(os.getenv('AUTH_CACHE_NEGATIVE_TTL_SECONDS', DEFAULT_NEGATIVE_TTL_SECONDS))
+    )
+
+api_key_status_cache = _make_cache('api_key_status')
+customer_id_cache    = _make_cache('customer_id')
+device_cache         = _make_cache('device')
+
+def cached(cache, is_negative, is_cacheable=lambda value: True):
+    """
+        Cache a single-argument lookup in cache. is_negative(value) says the
+        lookup found nothing (cached for the negative TTL); values for which
+        is_cacheable(value) is false, such as errors, are never cached.
+    """
+    def decorator(lookup):
+        @functools.wraps(lookup)
+        def wrapper(key):
+            hit, value = cache.get(key)
+            if hit:
+                return value
+
+            generation = cache.generation
+            value = lookup(key)
+            if is_cacheable(value):
+                cache.put(key, value, negative=is_negative(value), generation=generation)
+
+            return value
+
+        return wrapper
+
+    return decorator
+
+def invalidate_api_key(api_key):
+    """Forget what is known about api_key, e.g. after it was activated or deactivated"""
+    api_key_status_cache.invalidate(api_key)
+    customer_id_cache.invalidate(api_key)
+
+def invalidate_agent_id(agent_id):
+    device_cache.invalidate(agent_id)
+
+def invalidate_all():
+    """For changes that cannot be traced to one key, such as a customer removed by Stripe id"""
+    for cache in (api_key_status_cache, customer_id_cache, device_cache):
+        cache.clear()
+
+    __logger__().info("Cleared authentication caches")
+
+def get_cache_stats():
+    return {cache.name: cache.get_stats() for cache in (api_key_status_cache, customer_id_cache, device_cache)}
@@ -2,14 +2,21 @@ import json
 from datetime import datetime
 
 import database_utils as db
-import logging_utils, crypto_utils, backup_utils
+import logging_utils, crypto_utils, backup_utils, upload_session_utils, chunk_store_utils, blob_store_utils, catalog_utils, work_queue_utils, file_record_utils, db_pool_utils
 
 import base64
+import os
 import pathlib
 from pathlib import Path
 
 CHUNK_SIZE = 1024*1024
 
+# Upper bound on files in one /api/backup-files-batch request
+MAX_BATCH_FILES = 1000
+
+# Versions kept of each file, including the current one
+MAX_VERSIONS = 3
+
 STRING_401_BAD_REQUEST = "Bad request."
 RESPONSE_401_BAD_REQUEST = (
   401,json.dumps({'error':STRING_401_BAD_REQUEST})
@@ -82,13 +89,354 @@ def handle_backup_file_request(request, file):
     if not path_on_device:
         return RESPONSE_401_BAD_REQUEST
 
+    store_backup_file(customer_id, device_id, path_on_device, file)
+
+    return 200,json.dumps({'backup_file-response': 'Received file successfully.'})
+
+def handle_backup_files_batch_request(request, files):
+    """
+        Stores every file of a batch upload. The API key and device are
+        looked up once for the whole batch.
+
+        request holds 'file_count' and a base64 'file_path_<n>' for each
+        file; files maps 'file_content_<n>' to the uploaded file streams.
+        Returns per-file results in request order, so one bad file does
+        not fail the others.
+    """
+    __logger__().info("Server handling batch backup request.")
+    backup_utils.print_request_no_file(request)
+
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
+
+    device_id,_,_,_,_,_,_,_,_,_ = results
+
+    try:
+        file_count = int(request['file_count'])
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    if file_count < 1 or file_count > MAX_BATCH_FILES:
+        return RESPONSE_401_BAD_REQUEST
+
+    file_results = []
+    for index in range(file_count):
+        file_results.append(_store_batch_file(customer_id, device_id, request, files, index))
+
+    stored = len([r for r in file_results if r['status'] == 200])
+    __logger__().info("Stored %d of %d files from batch." % (stored, file_count))
+
+    return 200,json.dumps({
+        'backup_files_batch-response': 'Received %d of %d files successfully.' % (stored, file_count),
+        'results': file_results
+    })
+
+def _store_batch_file(customer_id, device_id, request, files, index):
+    encoded_path = request.get('file_path_%d' % index)
+    file = files.get('file_content_%d' % index)
+
+    if not encoded_path or file is None:
+        return {'index': index, 'status': 400, 'error': 'Missing file path or content.'}
+
+    try:
+        path_on_device = base64.b64decode(encoded_path).decode("utf-8")
+        if not path_on_device:
+            return {'index': index, 'status': 400, 'error': 'Missing file path or content.'}
+
+        store_backup_file(customer_id, device_id, path_on_device, file.stream)
+        return {'index': index, 'status': 200}
+
+    except Exception as e:
+        __logger__().error("Failed to store file %d of batch: %s" % (index, e))
+        return {'index': index, 'status': 500, 'error': 'Failed to store file.'}
+
+def handle_create_upload_session_request(request):
+    """
+        Start a resumable upload: the client then PUTs numbered chunks,
+        can ask which chunks the server already has, and commits.
+    """
+    __logger__().info("Server handling create upload session request.")
+    backup_utils.print_request_no_file(request)
+
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    try:
+        path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+        file_size = int(request['file_size'])
+        chunk_size = int(request.get('chunk_size', upload_session_utils.DEFAULT_CHUNK_SIZE))
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    if not path_on_device or file_size < 0 or chunk_size < 1 or chunk_size > upload_session_utils.MAX_CHUNK_SIZE:
+        return RESPONSE_401_BAD_REQUEST
+
+    session = upload_session_utils.create_session(customer_id, device_id, path_on_device, file_size, chunk_size)
+
+    return 200,json.dumps({
+        'create_upload_session-response': 'Upload session created.',
+        'session_id': session['session_id'],
+        'chunk_size': session['chunk_size'],
+        'total_chunks': session['total_chunks']
+    })
+
+def handle_upload_chunk_request(request, chunk_stream):
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    session = upload_session_utils.load_session(customer_id, device_id, request.get('session_id'))
+    if not session:
+        return 404,json.dumps({'error': 'Upload session not found.'})
+
+    try:
+        index = int(request['index'])
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    db_pool_utils.release_connection()
+    error = upload_session_utils.write_chunk(customer_id, session, index, chunk_stream, request.get('sha256', ''))
+    if error:
+        __logger__().warning("Rejected chunk for session %s: %s" % (session['session_id'], error))
+        return 400,json.dumps({'error': error})
+
+    return 200,json.dumps({'upload_chunk-response': 'Received chunk %d.' % index})
+
+def handle_upload_session_status_request(request):
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    session = upload_session_utils.load_session(customer_id, device_id, request.get('session_id'))
+    if not session:
+        return 404,json.dumps({'error': 'Upload session not found.'})
+
+    return 200,json.dumps({
+        'upload_session_status-response': 'OK',
+        'received_chunks': sorted(upload_session_utils.get_received_chunks(customer_id, session)),
+        'total_chunks': session['total_chunks'],
+        'chunk_size': session['chunk_size']
+    })
+
+def handle_commit_upload_session_request(request):
+    __logger__().info("Server handling commit upload session request.")
+
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    session = upload_session_utils.load_session(customer_id, device_id, request.get('session_id'))
+    if not session:
+        return 404,json.dumps({'error': 'Upload session not found.'})
+
+    path_on_device = session['path_on_device']
+    path_on_server, _ = backup_utils.make_server_path(customer_id,device_id,path_on_device)
+
+    # Hashes the whole file
+    db_pool_utils.release_connection()
+
+    stored = []
+    error = upload_session_utils.commit_session(
+        customer_id,
+        session,
+        lambda data_path: stored.extend(blob_store_utils.add_blob(data_path))
+    )
+    if error:
+        __logger__().warning("Could not commit session %s: %s" % (session['session_id'], error))
+        return 409,json.dumps({'error': error})
+
+    digest, file_size, pin_id = stored
+    queue_store_version(customer_id, device_id, path_on_device, path_on_server, digest, file_size, pin_id)
+
+    return 200,json.dumps({'commit_upload_session-response': 'Received file successfully.'})
+
+def handle_backup_known_file_request(request):
+    """
+        Back up a file without its content, if this customer has already
+        stored a file with the same SHA-256: the new version just points at
+        the existing blob. Returns 404 if the content is not known, and the
+        client then uploads the file as usual.
+    """
+    __logger__().info("Server handling backup known file request.")
+
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    try:
+        path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+        file_size = int(request['file_size'])
+        digest = str(request['sha256'])
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    if not path_on_device or not blob_store_utils.is_valid_digest(digest):
+        return RESPONSE_401_BAD_REQUEST
+
+    known_size = catalog_utils.get_customer_blob_size(customer_id, digest)
+    if known_size is None or known_size != file_size:
+        return 404,json.dumps({'error': 'Unknown content.'})
+
+    # Pinned before checking the blob is there, so it stays until the version is recorded
+    pin_id = catalog_utils.pin_blob(digest)
+    if not os.path.exists(blob_store_utils.get_blob_path(digest)):
+        catalog_utils.unpin_blob(pin_id)
+        return 404,json.dumps({'error': 'Unknown content.'})
+
+    path_on_server, _ = backup_utils.make_server_path(customer_id,device_id,path_on_device)
+    queue_store_version(customer_id, device_id, path_on_device, path_on_server, digest, file_size, pin_id)
+
+    return 200,json.dumps({'backup_known_file-response': 'Stored file from known content.'})
+
+def handle_missing_chunks_request(request):
+    """
+        Of the chunk digests in request['digests'] (comma separated), report
+        the ones this customer's chunk store does not have yet.
+    """
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    digests = [d for d in str(request.get('digests', '')).split(",") if d]
+
+    if len(digests) > chunk_store_utils.MAX_QUERY_CHUNKS or not all(chunk_store_utils.is_valid_digest(d) for d in digests):
+        return RESPONSE_401_BAD_REQUEST
+
+    missing = chunk_store_utils.find_missing_chunks(customer_id, digests)
+    __logger__().info("Chunk query: %d of %d chunks missing." % (len(missing), len(digests)))
+
+    return 200,json.dumps({
+        'missing_chunks-response': 'OK',
+        'missing': missing
+    })
+
+def handle_upload_content_chunk_request(request, chunk_stream):
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    db_pool_utils.release_connection()
+    error = chunk_store_utils.store_chunk(customer_id, request.get('sha256', ''), chunk_stream)
+    if error:
+        __logger__().warning("Rejected chunk %s: %s" % (request.get('sha256'), error))
+        return 400,json.dumps({'error': error})
+
+    return 200,json.dumps({'upload_content_chunk-response': 'Received chunk.'})
+
+def handle_commit_chunked_file_request(request):
+    """
+        Store a file from chunks already in the chunk store. request['chunks']
+        is the file's recipe. Returns 409 with the missing digests if any
+        chunk still has to be uploaded.
+    """
+    __logger__().info("Server handling commit chunked file request.")
+
+    customer_id, device_id = _get_customer_and_device(request)
+    if not device_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    try:
+        path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+        file_size = int(request['file_size'])
+        chunks = chunk_store_utils.parse_chunk_list(str(request['chunks']))
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    if not path_on_device or sum(length for _, length in chunks) != file_size:
+        return RESPONSE_401_BAD_REQUEST
+
+    path_on_server, _ = backup_utils.make_server_path(customer_id,device_id,path_on_device)
+
+    # The chunks are the durable copy; rebuilding the file from them is queued
+    missing = chunk_store_utils.find_missing_chunks(customer_id, sorted(set(digest for digest, _ in chunks)))
+    if missing:
+        return 409,json.dumps({'error': 'Chunks missing.', 'missing': missing})
+
+    work_queue_utils.enqueue('commit_chunks', path_on_server, {
+        'customer_id': customer_id,
+        'device_id': device_id,
+        'path_on_device': path_on_device,
+        'path_on_server': path_on_server,
+        'chunks': ",".join("%s:%d" % chunk for chunk in chunks)
+    })
+
+    return 200,json.dumps({'commit_chunked_file-response': 'Received file successfully.'})
+
+def _get_customer_and_device(request):
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+    if not customer_id:
+        return None, None
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return customer_id, None
+
+    device_id,_,_,_,_,_,_,_,_,_ = results
+    return customer_id, device_id
+
+def store_backup_file(customer_id, device_id, path_on_device, file):
+    """
+        Write one uploaded file to the blob store and queue recording it
+        for the device. Returns the path on the server.
+    """
     path_on_server, device_root_directory_on_server = backup_utils.make_server_path(customer_id,device_id,path_on_device)
 
-    file_size = backup_utils.stream_write_file_to_disk(path=path_on_server,file_handle=file,max_versions=3,chunk_size=CHUNK_SIZE)
+    # No database calls while the upload is copied to disk
+    db_pool_utils.release_connection()
 
-    # TODO: eventually respond to client more quickly and queue the writes to disk / database calls until afterwards
-    __logger__().info("Done writing file to %s" % path_on_server)
+    temp_path, digest, _ = blob_store_utils.write_stream_to_temp(file, CHUNK_SIZE)
+    digest, file_size, pin_id = blob_store_utils.add_blob(temp_path, digest)
+    __logger__().info("Stored upload for %s as blob %s" % (path_on_server, digest))
+
+    queue_store_version(customer_id, device_id, path_on_device, path_on_server, digest, file_size, pin_id)
+
+    return path_on_server
+
+def queue_store_version(customer_id, device_id, path_on_device, path_on_server, digest, file_size, pin_id):
+    """
+        Queue making the stored blob digest the current version of
+        path_on_server and recording it in the database. The upload is
+        durable once this returns: pin_id (catalog_utils.pin_blob) keeps
+        the blob until the job has recorded the version.
+    """
+    work_queue_utils.enqueue('store_version', path_on_server, {
+        'customer_id': customer_id,
+        'device_id': device_id,
+        'path_on_device': path_on_device,
+        'path_on_server': path_on_server,
+        'digest': digest,
+        'file_size': file_size,
+        'pin_id': pin_id
+    })
 
+def _run_store_version_job(job):
+    blob_store_utils.store_version(
+        job['customer_id'], job['device_id'], job['path_on_server'], job['digest'], job['file_size'], MAX_VERSIONS)
+
+    # The version now holds a reference of its own. Jobs queued before pins have none.
+    if job.get('pin_id') is not None:
+        catalog_utils.unpin_blob(job['pin_id'])
+
+    record_backup_file(job['device_id'], job['path_on_device'], job['path_on_server'], job['file_size'])
+
+def _run_commit_chunks_job(job):
+    chunks = chunk_store_utils.parse_chunk_list(job['chunks'])
+    file_size, missing = chunk_store_utils.commit_file_from_chunks(
+        job['customer_id'], job['device_id'], chunks, job['path_on_server'], MAX_VERSIONS)
+    if missing:
+        raise IOError("%d chunks of %s are no longer stored" % (len(missing), job['path_on_server']))
+
+    record_backup_file(job['device_id'], job['path_on_device'], job['path_on_server'], file_size)
+
+def record_backup_file(device_id, path_on_device, path_on_server, file_size):
+    """Queue the database record of a file that is now stored at path_on_server; see file_record_utils"""
     # TODO: clean this up and put as a helper function in backup_utils
     if "\\" in path_on_device:
         p = pathlib.PureWindowsPath(r'%s'%path_on_device)
@@ -108,7 +456,7 @@ def handle_backup_file_request(request, file):
     file_path = backup_utils.get_file_path_without_name(path_on_server)
     file_type = backup_utils.get_file_type(path_on_server)
 
-    _ = db.add_or_update_file_for_device(
+    file_record_utils.add(
         device_id,
         #backup_id,
         file_name,
@@ -121,5 +469,6 @@ def handle_backup_file_request(request, file):
         path_on_server
     )
 
-    return 200,json.dumps({'backup_file-response': 'Received file successfully.'})
-
+work_queue_utils.register_handler('store_version', _run_store_version_job)
+work_queue_utils.register_handler('commit_chunks', _run_commit_chunks_job)
+work_queue_utils.register_batch_hook(file_record_utils.flush)
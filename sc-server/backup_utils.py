@@ -3,6 +3,7 @@ import logging_utils
 import os
 import sys
 import glob
+import threading
 
 def __logger__():
     return logging_utils.logger
@@ -51,23 +52,43 @@ def normalize_path(p):
         return p
 
 def stream_write_file_to_disk(path,file_handle,max_versions,chunk_size):
-    if os.path.exists(path):
-        handle_versions(path, max_versions)
-
+    """
+        Write the upload to a temporary file next to path and only then
+        move it into place, so an interrupted or retried upload never
+        leaves a partial (or appended-to) file at path.
+    """
     __logger__().info("Stream writing file to disk: %s   %s   %s   %s" % (path,file_handle,max_versions,chunk_size))
 
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'ab') as target_file:
-        while True:
-            chunk = file_handle.read(chunk_size)
-            if not chunk:
-                break
+    temp_path = make_temp_path(path)
+
+    try:
+        with open(temp_path, 'wb') as target_file:
+            while True:
+                chunk = file_handle.read(chunk_size)
+                if not chunk:
+                    break
+
+                __logger__().info("got a chunk of %s" % path)
+                target_file.write(chunk)
 
-            __logger__().info("got a chunk of %s" % path)
-            target_file.write(chunk)
+            target_file.flush()
+            os.fsync(target_file.fileno())
+
+        if os.path.exists(path):
+            handle_versions(path, max_versions)
+
+        os.replace(temp_path, path)
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
     return os.path.getsize(path)
 
+def make_temp_path(path):
+    return "%s/.%s.sc-upload-%d-%d" % (os.path.dirname(path), get_file_name(path), os.getpid(), threading.get_ident())
+
 def handle_versions(path,max_versions):
     original_file_name = get_file_name(path)
     sc_version_directory = os.path.dirname(path) + "/.SCVERS/"
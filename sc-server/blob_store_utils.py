@@ -0,0 +1,304 @@
+import errno
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import logging_utils, backup_utils, catalog_utils, chunk_store_utils
+
+# Content-addressed store of whole files, shared by every customer and device:
+#
+#   /storage/blobs/ab/cd/abcd....   named by the SHA-256 of the content
+#   /storage/blobs/tmp/             uploads being written, before their digest is known
+#
+# A backed up file at its usual server path is a hard link to the blob of its
+# current version, so identical files (on one device, across devices, across
+# customers) take up the space of one copy. Older versions exist only as rows
+# in catalog_utils pointing at their blobs. A new version is one link and one
+# catalog insert; versions beyond the limit are pruned by a background thread,
+# which also deletes blobs that no version points at any more. Its hourly sweep
+# prunes every path over the limit, so paths queued before a restart are not
+# left with extra versions.
+BLOB_STORE_ROOT = "/storage/blobs/"
+
+# How often the pruner sweeps for unreferenced blobs when no uploads wake it up
+PRUNE_SWEEP_SECONDS = 3600
+
+_prune_lock = threading.Lock()
+_prune_pending = {}   # path_on_server -> max_versions
+_sweep_max_versions = None   # the limit last requested, applied by the hourly sweep
+_prune_wakeup = threading.Event()
+_prune_thread = None
+
+def __logger__():
+    return logging_utils.logger
+
+def get_blob_path(digest):
+    return BLOB_STORE_ROOT + "%s/%s/%s" % (digest[0:2], digest[2:4], digest)
+
+def is_valid_digest(digest):
+    return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+def write_stream_to_temp(file_handle, chunk_size):
+    """Write an upload to a temporary file in the store, hashing it on the way. Returns (temp_path, digest, size)."""
+    temp_directory = BLOB_STORE_ROOT + "tmp/"
+    os.makedirs(temp_directory, exist_ok=True)
+
+    temp_path = temp_directory + "upload-%d-%d" % (os.getpid(), threading.get_ident())
+    file_hash = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(temp_path, 'wb') as target_file:
+            while True:
+                chunk = file_handle.read(chunk_size)
+                if not chunk:
+                    break
+
+                file_hash.update(chunk)
+                target_file.write(chunk)
+                size += len(chunk)
+
+            target_file.flush()
+            os.fsync(target_file.fileno())
+
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return temp_path, file_hash.hexdigest(), size
+
+def add_blob(source_path, digest=None):
+    """
+        Move a complete file into the store. If the store already has the
+        same content the file is simply removed. Returns (digest, size, pin_id).
+
+        The blob is pinned (catalog_utils.pin_blob) before the store is
+        checked for it, so garbage collection cannot remove it before the
+        version it is for is recorded; the caller unpins it after that.
+    """
+    if digest is None:
+        digest = hash_file(source_path)
+
+    size = os.path.getsize(source_path)
+    blob_path = get_blob_path(digest)
+    pin_id = catalog_utils.pin_blob(digest)
+
+    if os.path.exists(blob_path):
+        os.remove(source_path)
+        __logger__().info("Blob %s already stored, upload deduplicated" % digest)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(source_path, blob_path)
+        _fsync_directory(os.path.dirname(blob_path))
+
+    return digest, size, pin_id
+
+def hash_file(path, chunk_size=1024*1024):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def store_stream(customer_id, device_id, path_on_server, file_handle, max_versions, chunk_size):
+    """Store an upload stream as the new version of path_on_server. Returns (digest, size)."""
+    temp_path, digest, _ = write_stream_to_temp(file_handle, chunk_size)
+    digest, size, pin_id = add_blob(temp_path, digest)
+
+    try:
+        store_version(customer_id, device_id, path_on_server, digest, size, max_versions)
+    finally:
+        catalog_utils.unpin_blob(pin_id)
+
+    return digest, size
+
+def store_version(customer_id, device_id, path_on_server, digest, size, max_versions):
+    """
+        Make blob digest the current version of path_on_server: link the
+        blob into place and record it in the catalog. This is all an upload
+        of already known content costs. Returns the new version_id.
+
+        If digest is already the current version (a job run again after a
+        crash, or the same content sent twice) nothing changes and the
+        current version_id is returned.
+    """
+    latest = catalog_utils.get_latest_version(path_on_server)
+    if latest and latest[1] == digest and os.path.exists(path_on_server) and _is_file_of_blob(path_on_server, digest):
+        return latest[0]
+
+    keep_existing_file_as_version(customer_id, device_id, path_on_server)
+
+    os.makedirs(os.path.dirname(path_on_server), exist_ok=True)
+    temp_path = backup_utils.make_temp_path(path_on_server)
+    _link_or_copy(get_blob_path(digest), temp_path)
+
+    try:
+        os.replace(temp_path, path_on_server)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    version_id = catalog_utils.add_file_version(customer_id, device_id, path_on_server, digest, size)
+
+    # Garbage collection may have removed the blob between it being linked
+    # above and the catalog row going in; put it back from the linked file.
+    if not os.path.exists(get_blob_path(digest)):
+        os.makedirs(os.path.dirname(get_blob_path(digest)), exist_ok=True)
+        _link_or_copy(path_on_server, get_blob_path(digest))
+
+    request_prune(path_on_server, max_versions)
+    return version_id
+
+def keep_existing_file_as_version(customer_id, device_id, path_on_server):
+    """
+        Before path_on_server is replaced, make sure the file there is in the
+        catalog. Files written before the blob store (or rebuilt from the
+        chunk store) are added as a version by linking them into the store.
+    """
+    if not os.path.exists(path_on_server):
+        return
+
+    latest = catalog_utils.get_latest_version(path_on_server)
+    if latest and _is_file_of_blob(path_on_server, latest[1]):
+        return
+
+    digest = hash_file(path_on_server)
+    blob_path = get_blob_path(digest)
+
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        _link_or_copy(path_on_server, blob_path)
+
+    catalog_utils.add_file_version(customer_id, device_id, path_on_server, digest, os.path.getsize(path_on_server))
+    __logger__().info("Kept existing %s as a version in the catalog" % path_on_server)
+
+def _is_file_of_blob(path, digest):
+    blob_path = get_blob_path(digest)
+    if not os.path.exists(blob_path):
+        return False
+
+    if os.path.samefile(path, blob_path):
+        return True
+
+    # Copied rather than linked (blob store on another filesystem)
+    return os.path.getsize(path) == os.path.getsize(blob_path) and hash_file(path) == digest
+
+def get_version_digest(version_id, customer_id, device_id, path_on_device):
+    """Returns the digest of a stored version, or None if it is not a version of this device's path_on_device"""
+    version = catalog_utils.get_file_version(version_id)
+    if not version:
+        return None
+
+    version_customer_id, version_device_id, version_path_on_server, digest, _, _ = version
+    if (version_customer_id, version_device_id) != (customer_id, device_id):
+        return None
+
+    path_on_server, _ = backup_utils.make_server_path(customer_id, device_id, path_on_device)
+    if version_path_on_server != path_on_server:
+        return None
+
+    return digest
+
+def get_version_path(version_id, customer_id, device_id, path_on_device):
+    """Returns the path of a stored version's content, or None if it is not a version of this device's path_on_device"""
+    digest = get_version_digest(version_id, customer_id, device_id, path_on_device)
+    return get_blob_path(digest) if digest else None
+
+def request_prune(path_on_server, max_versions):
+    """Have the pruner thread drop versions of path_on_server beyond max_versions"""
+    global _prune_thread, _sweep_max_versions
+
+    with _prune_lock:
+        _prune_pending[path_on_server] = max_versions
+        _sweep_max_versions = max_versions
+
+        # Started on first use, so it runs in the process that serves requests
+        if _prune_thread is None or not _prune_thread.is_alive():
+            _prune_thread = threading.Thread(target=_prune_loop, name="sc-version-pruner", daemon=True)
+            _prune_thread.start()
+
+    _prune_wakeup.set()
+
+def prune_pending():
+    """Prune every path queued by request_prune. Returns the number of blobs removed."""
+    with _prune_lock:
+        pending = dict(_prune_pending)
+        _prune_pending.clear()
+
+    unreferenced = set()
+    for path_on_server, max_versions in pending.items():
+        unreferenced.update(catalog_utils.prune_versions(path_on_server, max_versions))
+
+    return collect_garbage(sorted(unreferenced))
+
+def prune_over_limit(max_versions):
+    """Prune every path in the catalog with more than max_versions versions. Returns the number of blobs removed."""
+    unreferenced = set()
+    for path_on_server in catalog_utils.get_paths_over_version_limit(max_versions):
+        unreferenced.update(catalog_utils.prune_versions(path_on_server, max_versions))
+
+    return collect_garbage(sorted(unreferenced))
+
+def _prune_loop():
+    last_sweep = time.time()
+
+    while True:
+        woken = _prune_wakeup.wait(PRUNE_SWEEP_SECONDS)
+        _prune_wakeup.clear()
+
+        try:
+            if woken:
+                # Let a burst of uploads queue up before touching the catalog
+                time.sleep(1)
+                prune_pending()
+
+            # Checked after every wakeup too, or a busy server would never sweep
+            if time.time() - last_sweep >= PRUNE_SWEEP_SECONDS:
+                last_sweep = time.time()
+
+                if _sweep_max_versions is not None:
+                    prune_over_limit(_sweep_max_versions)
+                collect_garbage()
+                chunk_store_utils.collect_garbage_if_due()
+
+        except Exception as e:
+            __logger__().error("Version pruning failed: %s" % e)
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        # A blob store on another filesystem still works, without the space savings
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(source, target)
+
+def collect_garbage(digests=None):
+    """
+        Delete blobs that no file version points at. With no digests, sweeps
+        every unreferenced blob in the catalog. Returns the number removed.
+    """
+    if digests is None:
+        digests = catalog_utils.get_unreferenced_blobs()
+
+    removed = 0
+    for digest in digests:
+        if catalog_utils.delete_blob_if_unreferenced(digest):
+            blob_path = get_blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+            removed += 1
+
+    if removed:
+        __logger__().info("Removed %d unreferenced blobs" % removed)
+
+    return removed
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
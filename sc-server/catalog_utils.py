@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+import time
+
+import logging_utils
+
+# Index of the content-addressed blob store (see blob_store_utils):
+#
+#   blobs          one row per stored object, with the number of file versions
+#                  that point at it. A blob whose refcount drops to 0 is garbage.
+#   file_versions  every stored version of every backed up file. version_ids only
+#                  ever increase, so the newest version of a path has the highest.
+#                  Listing a file's versions or finding one by id is an index lookup.
+#   blob_pins      blobs an acknowledged upload is waiting on: taken when the upload
+#                  lands in the store, dropped once its queued version is recorded.
+#                  A pinned blob is never garbage, whatever its refcount.
+#
+# Kept in SQLite next to the blobs rather than in MySQL so that a blob and the
+# rows pointing at it live on the same disk and are backed up together.
+CATALOG_PATH = "/storage/catalog.db"
+
+_local = threading.local()
+
+def __logger__():
+    return logging_utils.logger
+
+def get_connection():
+    """One connection per thread, created (with the schema) on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != CATALOG_PATH:
+        conn = sqlite3.connect(CATALOG_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _create_tables(conn)
+        _local.conn = conn
+        _local.path = CATALOG_PATH
+
+    return conn
+
+def _create_tables(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            )''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_versions (
+                version_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id INTEGER NOT NULL,
+                device_id INTEGER NOT NULL,
+                path_on_server TEXT NOT NULL,
+                digest TEXT NOT NULL REFERENCES blobs(digest),
+                file_size INTEGER NOT NULL,
+                created REAL NOT NULL
+            )''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blob_pins (
+                pin_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                digest TEXT NOT NULL,
+                created REAL NOT NULL
+            )''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_file_versions_path ON file_versions (path_on_server, version_id)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_file_versions_customer_digest ON file_versions (customer_id, digest)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount = 0''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_blob_pins_digest ON blob_pins (digest)''')
+
+def add_file_version(customer_id, device_id, path_on_server, digest, file_size):
+    """
+        Record a new version of path_on_server pointing at blob digest.
+        Returns its version_id; later versions always get higher ids.
+        Old versions are dropped separately, by prune_versions.
+    """
+    conn = get_connection()
+    now = time.time()
+
+    with conn:
+        conn.execute('''INSERT OR IGNORE INTO blobs (digest, size, refcount, created) VALUES (?,?,0,?)''',
+                     (digest, file_size, now))
+
+        cursor = conn.execute('''INSERT INTO file_versions (customer_id, device_id, path_on_server, digest, file_size, created)
+                                 VALUES (?,?,?,?,?,?)''', (customer_id, device_id, path_on_server, digest, file_size, now))
+
+        conn.execute('''UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?''', (digest,))
+
+    return cursor.lastrowid
+
+def prune_versions(path_on_server, max_versions):
+    """
+        Drop the versions of path_on_server beyond the newest max_versions.
+        Returns the digests of blobs no version points at any more, which
+        the caller can remove with blob_store_utils.collect_garbage.
+    """
+    conn = get_connection()
+
+    with conn:
+        expired = conn.execute('''SELECT version_id, digest FROM file_versions WHERE path_on_server = ?
+                                  ORDER BY version_id DESC LIMIT -1 OFFSET ?''', (path_on_server, max_versions)).fetchall()
+
+        for version_id, expired_digest in expired:
+            conn.execute('''DELETE FROM file_versions WHERE version_id = ?''', (version_id,))
+            conn.execute('''UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?''', (expired_digest,))
+
+        unreferenced = [expired_digest for _, expired_digest in expired if conn.execute(
+            '''SELECT 1 FROM blobs WHERE digest = ? AND refcount = 0''', (expired_digest,)).fetchone()]
+
+    return sorted(set(unreferenced))
+
+def get_paths_over_version_limit(max_versions):
+    """Returns every path with more than max_versions versions"""
+    return [row[0] for row in get_connection().execute('''
+        SELECT path_on_server FROM file_versions GROUP BY path_on_server HAVING COUNT(*) > ?''', (max_versions,))]
+
+def get_file_versions(path_on_server):
+    """Returns (version_id, digest, file_size, created) for each version of path_on_server, newest first"""
+    return get_connection().execute('''
+        SELECT version_id, digest, file_size, created FROM file_versions WHERE path_on_server = ?
+        ORDER BY version_id DESC''', (path_on_server,)).fetchall()
+
+def get_latest_version(path_on_server):
+    """Returns (version_id, digest, file_size, created) of the current version, or None"""
+    return get_connection().execute('''
+        SELECT version_id, digest, file_size, created FROM file_versions WHERE path_on_server = ?
+        ORDER BY version_id DESC LIMIT 1''', (path_on_server,)).fetchone()
+
+def get_file_version(version_id):
+    """Returns (customer_id, device_id, path_on_server, digest, file_size, created) or None"""
+    return get_connection().execute('''
+        SELECT customer_id, device_id, path_on_server, digest, file_size, created FROM file_versions
+        WHERE version_id = ?''', (version_id,)).fetchone()
+
+def get_customer_blob_size(customer_id, digest):
+    """
+        Returns the size of blob digest if one of this customer's files
+        already points at it, else None. Blobs only known from other
+        customers are not reported, so a digest alone never grants access
+        to someone else's data.
+    """
+    row = get_connection().execute('''
+        SELECT b.size FROM file_versions v JOIN blobs b ON b.digest = v.digest
+        WHERE v.customer_id = ? AND v.digest = ? LIMIT 1''', (customer_id, digest)).fetchone()
+
+    return row[0] if row else None
+
+def pin_blob(digest):
+    """Keep blob digest from garbage collection until unpin_blob(pin_id). Returns the pin_id."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute('''INSERT INTO blob_pins (digest, created) VALUES (?,?)''', (digest, time.time()))
+
+    return cursor.lastrowid
+
+def unpin_blob(pin_id):
+    """Drop a pin. Dropping one that is already gone does nothing, so a job that runs twice is harmless."""
+    conn = get_connection()
+    with conn:
+        conn.execute('''DELETE FROM blob_pins WHERE pin_id = ?''', (pin_id,))
+
+def get_unreferenced_blobs():
+    return [row[0] for row in get_connection().execute('''
+        SELECT digest FROM blobs b WHERE refcount = 0
+          AND NOT EXISTS (SELECT 1 FROM blob_pins p WHERE p.digest = b.digest)''')]
+
+def delete_blob_if_unreferenced(digest):
+    """Remove the blob row if still nothing points at it or pins it. Returns True if it was removed."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute('''DELETE FROM blobs WHERE digest = ? AND refcount = 0
+                                 AND NOT EXISTS (SELECT 1 FROM blob_pins p WHERE p.digest = ?)''', (digest, digest))
+
+    return cursor.rowcount == 1
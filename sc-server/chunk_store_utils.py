@@ -0,0 +1,292 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import logging_utils, backup_utils, blob_store_utils, catalog_utils, work_queue_utils
+
+# Content-defined chunks uploaded by clients, one file per chunk, named by its
+# SHA-256 and sharded on the first two bytes so no directory gets too large:
+#
+#   /storage/<customer>/chunks/ab/cd/abcd....
+#
+# A chunked upload is committed by rebuilding the file from its chunks into the
+# blob store and making it the current version there, exactly as a whole-file
+# upload would be: it is linked at its usual server path, and its versions are
+# listed, restored and pruned through catalog_utils like any other file's.
+#
+# The recipe of the current version, the list of (sha256, length) chunks that
+# make it up, is kept in .SCRECIPES/<name>.json next to the file so its chunks
+# stay in the store: the client's next upload of the file then only sends the
+# chunks that changed. The current version therefore takes its size twice on
+# disk, once as its blob and once in the chunk store. Older versions are
+# blobs only. (Histories written before this kept older versions only as
+# recipes; those are rebuilt into the catalog on the file's next commit.)
+#
+# Chunks no recipe refers to any more (replaced versions) are deleted by
+# collect_garbage, which the blob store's pruner runs once a day. A chunk is
+# kept while a queued commit_chunks job lists it, and for CHUNK_GRACE_SECONDS
+# after it was last uploaded or reported present to a client, so a file whose
+# chunks are still arriving, or being committed, does not lose them.
+CHUNK_STORE_ROOT = "/storage/%s/chunks/"
+
+CHUNK_GRACE_SECONDS = 24*3600
+CHUNK_SWEEP_SECONDS = 24*3600
+
+MAX_CHUNK_SIZE = 16*1024*1024
+
+# Upper bound on digests in one /api/chunks/missing request
+MAX_QUERY_CHUNKS = 10000
+
+_sweep_lock = threading.Lock()
+_last_sweep = 0.0
+
+def __logger__():
+    return logging_utils.logger
+
+def is_valid_digest(digest):
+    return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+def get_chunk_path(customer_id, digest):
+    return CHUNK_STORE_ROOT % customer_id + "%s/%s/%s" % (digest[0:2], digest[2:4], digest)
+
+def parse_chunk_list(chunk_list):
+    """
+        Parse a "<sha256>:<length>,<sha256>:<length>,..." recipe (the form the
+        client sends, which passes request sanitization) into a list of
+        (digest, length). Raises ValueError if it is malformed.
+    """
+    chunks = []
+    for entry in chunk_list.split(","):
+        digest, length = entry.split(":")
+        length = int(length)
+
+        if not is_valid_digest(digest) or length < 1 or length > MAX_CHUNK_SIZE:
+            raise ValueError("Bad chunk entry: %s" % entry)
+
+        chunks.append((digest, length))
+
+    return chunks
+
+def find_missing_chunks(customer_id, digests):
+    """
+        Returns the digests (in request order) that are not in the customer's
+        chunk store. Chunks that are there have their mtime refreshed, so the
+        garbage collector keeps them while the client commits a file using them.
+    """
+    missing = []
+    for digest in digests:
+        try:
+            os.utime(get_chunk_path(customer_id, digest))
+        except FileNotFoundError:
+            missing.append(digest)
+
+    return missing
+
+def store_chunk(customer_id, digest, chunk_stream):
+    """
+        Store one chunk if it is not already there. The data is checked
+        against its digest before it is moved into the store, so a chunk
+        in the store is always complete and correct.
+        Returns None on success or an error string.
+    """
+    if not is_valid_digest(digest):
+        return "Bad chunk digest."
+
+    chunk_path = get_chunk_path(customer_id, digest)
+    if os.path.exists(chunk_path):
+        os.utime(chunk_path)
+        return None
+
+    chunk = chunk_stream.read(MAX_CHUNK_SIZE + 1)
+    if not chunk or len(chunk) > MAX_CHUNK_SIZE:
+        return "Chunk is empty or larger than %d bytes." % MAX_CHUNK_SIZE
+
+    if hashlib.sha256(chunk).hexdigest() != digest:
+        return "Chunk digest mismatch."
+
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    temp_path = backup_utils.make_temp_path(chunk_path)
+
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Two clients storing the same chunk at once both write identical data
+        os.replace(temp_path, chunk_path)
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return None
+
+class RecipeReader:
+    """A readable file of the chunks of a recipe, in order; each read() returns one whole chunk"""
+
+    def __init__(self, customer_id, chunks):
+        self.customer_id = customer_id
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        for digest, length in self.chunks:
+            with open(get_chunk_path(self.customer_id, digest), 'rb') as f:
+                data = f.read()
+
+            if len(data) != length:
+                raise ValueError("Chunk %s has %d bytes, recipe says %d" % (digest, len(data), length))
+
+            return data
+
+        return b""
+
+def add_recipe_blob(customer_id, chunks):
+    """Rebuild a file from its chunks into the blob store. Returns (digest, size, pin_id) as blob_store_utils.add_blob does."""
+    temp_path, digest, _ = blob_store_utils.write_stream_to_temp(RecipeReader(customer_id, chunks), MAX_CHUNK_SIZE)
+    return blob_store_utils.add_blob(temp_path, digest)
+
+def get_recipe_history_path(path_on_server):
+    return os.path.dirname(path_on_server) + "/.SCRECIPES/" + backup_utils.get_file_name(path_on_server) + ".json"
+
+def get_recipe_history(path_on_server):
+    """Returns the stored recipes of a file, oldest first; the last one is the current version"""
+    history_path = get_recipe_history_path(path_on_server)
+    if not os.path.exists(history_path):
+        return []
+
+    with open(history_path, 'r') as f:
+        return json.load(f)
+
+def commit_file_from_chunks(customer_id, device_id, chunks, path_on_server, max_versions):
+    """
+        Rebuild a file from the chunk store, make it the current version of
+        path_on_server (see blob_store_utils.store_version) and keep its
+        recipe for the next upload of the file.
+
+        Returns (file_size, None) on success, or (None, missing digests) if
+        the store does not have every chunk yet.
+    """
+    missing = find_missing_chunks(customer_id, sorted(set(digest for digest, _ in chunks)))
+    if missing:
+        return None, missing
+
+    history = get_recipe_history(path_on_server)
+    if len(history) > 1:
+        _add_recipe_versions(customer_id, device_id, path_on_server, history[:-1])
+
+    digest, file_size, pin_id = add_recipe_blob(customer_id, chunks)
+    try:
+        blob_store_utils.store_version(customer_id, device_id, path_on_server, digest, file_size, max_versions)
+    finally:
+        catalog_utils.unpin_blob(pin_id)
+
+    _write_recipe_history(path_on_server, [{
+        'created': time.time(),
+        'file_size': file_size,
+        'chunks': ",".join("%s:%d" % chunk for chunk in chunks)
+    }])
+
+    __logger__().info("Rebuilt %s from %d chunks (%d bytes)" % (path_on_server, len(chunks), file_size))
+    return file_size, None
+
+def _add_recipe_versions(customer_id, device_id, path_on_server, recipes):
+    """
+        Add the older versions of a history written before chunked files were
+        kept in the catalog, oldest first, unless the catalog already has
+        versions of the file (they would be out of order). The current
+        version, at path_on_server, is added by store_version.
+    """
+    if catalog_utils.get_latest_version(path_on_server):
+        return
+
+    for recipe in recipes:
+        chunks = parse_chunk_list(recipe['chunks'])
+        if find_missing_chunks(customer_id, sorted(set(digest for digest, _ in chunks))):
+            __logger__().warning("Chunks of an old version of %s are gone, not keeping it" % path_on_server)
+            continue
+
+        digest, file_size, pin_id = add_recipe_blob(customer_id, chunks)
+        try:
+            catalog_utils.add_file_version(customer_id, device_id, path_on_server, digest, file_size)
+        finally:
+            catalog_utils.unpin_blob(pin_id)
+
+def _write_recipe_history(path_on_server, history):
+    history_path = get_recipe_history_path(path_on_server)
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+
+    temp_path = backup_utils.make_temp_path(history_path)
+    with open(temp_path, 'w') as f:
+        json.dump(history, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, history_path)
+
+def collect_garbage_if_due():
+    """Run collect_garbage for every customer if the last sweep was CHUNK_SWEEP_SECONDS ago"""
+    global _last_sweep
+
+    with _sweep_lock:
+        if time.time() - _last_sweep < CHUNK_SWEEP_SECONDS:
+            return 0
+        _last_sweep = time.time()
+
+    removed = 0
+    for chunk_root in glob.glob(CHUNK_STORE_ROOT % "*"):
+        customer_id = chunk_root.rstrip("/").split("/")[-2]
+
+        try:
+            removed += collect_garbage(customer_id)
+        except Exception as e:
+            __logger__().error("Chunk garbage collection failed for customer %s: %s" % (customer_id, e))
+
+    return removed
+
+def collect_garbage(customer_id):
+    """
+        Delete the customer's chunks that no stored recipe and no queued
+        commit refers to, and that are older than CHUNK_GRACE_SECONDS.
+        Returns the number removed. Any unreadable recipe aborts the sweep.
+    """
+    # Queued commits first: one that finishes during the walk below has
+    # already written its recipe by the time its job is gone.
+    referenced = set()
+    for job in work_queue_utils.get_payloads('commit_chunks'):
+        if str(job['customer_id']) == str(customer_id):
+            referenced.update(digest for digest, _ in parse_chunk_list(job['chunks']))
+
+    for history_path in _iter_recipe_history_paths(customer_id):
+        with open(history_path, 'r') as f:
+            for recipe in json.load(f):
+                referenced.update(digest for digest, _ in parse_chunk_list(recipe['chunks']))
+
+    cutoff = time.time() - CHUNK_GRACE_SECONDS
+    removed = 0
+
+    for chunk_path in glob.glob(CHUNK_STORE_ROOT % customer_id + "*/*/*"):
+        digest = os.path.basename(chunk_path)
+        if not is_valid_digest(digest) or digest in referenced:
+            continue
+
+        try:
+            if os.path.getmtime(chunk_path) < cutoff:
+                os.remove(chunk_path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+
+    if removed:
+        __logger__().info("Removed %d unreferenced chunks of customer %s" % (removed, customer_id))
+
+    return removed
+
+def _iter_recipe_history_paths(customer_id):
+    for directory, subdirectories, _ in os.walk("/storage/%s/device/" % customer_id):
+        if ".SCRECIPES" in subdirectories:
+            subdirectories.remove(".SCRECIPES")
+            yield from glob.glob(os.path.join(directory, ".SCRECIPES", "*.json"))
@@ -1,5 +1,5 @@
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, errorcode
 
 import binascii
 import hashlib
@@ -9,7 +9,7 @@ import traceback
 # REMEMBER TO cnx.commit()!
 # ALL SINGLE ARG STORED PROCEDURE CALLS MUST USE (field,) SYNTAX TO INDICATE TUPLE!!
 
-import logging_utils
+import logging_utils, db_pool_utils, auth_cache_utils
 
 def __logger__():
     return logging_utils.logger
@@ -105,6 +105,30 @@ def update_callback_for_device(device_id, callback_time, status_code):
     __teardown__(cursor,cnx)
     return ret
 
+def update_callbacks_for_devices(rows):
+  # rows: (device_id, callback_time, status_code) tuples, written in one
+  # transaction. Returns False, having rolled them all back, if any call fails;
+  # keepalive_utils.flush_callbacks then writes them one at a time.
+  cnx = __connect_to_db__()
+  cursor = cnx.cursor(buffered=True)
+
+  try:
+    for row in rows:
+      cursor.callproc('update_callback_for_device', row)
+      for result in cursor.stored_results():
+        result.fetchall()
+
+    cnx.commit()
+    return True
+
+  except Error as e:
+    __logger__().error("Batched callback update of %d devices failed: %s" % (len(rows), e))
+    cnx.rollback()
+    return False
+
+  finally:
+    __teardown__(cursor,cnx)
+
 def add_or_update_customer(customer_name,customer_email,customer_guid,plan,api_key):
   # IN customer_name varchar(256),
   # IN customer_email varchar(256),
@@ -131,6 +155,7 @@ def add_or_update_customer(customer_name,customer_email,customer_guid,plan,api_k
   finally:
     cnx.commit()
     __teardown__(cursor,cnx)
+    auth_cache_utils.invalidate_api_key(api_key)
     return ret
 
 def add_or_update_file_for_device(device_id, file_name, file_path, client_full_name_and_path, client_full_name_and_path_as_posix, client_directory_as_posix, file_size, file_type, stormcloud_full_name_and_path):
@@ -172,6 +197,31 @@ def add_or_update_file_for_device(device_id, file_name, file_path, client_full_n
     __teardown__(cursor,cnx)
     return ret
 
+def add_or_update_files_for_device(rows):
+  # rows: argument tuples for add_or_update_file_for_device, in order.
+  # All of them are written in one transaction, so seeding a device costs one
+  # commit per batch instead of one per file. Returns False, having rolled the
+  # whole batch back, if any call fails.
+  cnx = __connect_to_db__()
+  cursor = cnx.cursor(buffered=True)
+
+  try:
+    for row in rows:
+      cursor.callproc('add_or_update_file_for_device', row)
+      for result in cursor.stored_results():
+        result.fetchall()
+
+    cnx.commit()
+    return True
+
+  except Error as e:
+    __logger__().error("Batched file update of %d rows failed: %s" % (len(rows), e))
+    cnx.rollback()
+    return False
+
+  finally:
+    __teardown__(cursor,cnx)
+
 def add_or_update_device_for_customer(customer_id, device_name, device_type, ip_address, operating_system, device_status, last_callback, stormcloud_path_to_secret_key, agent_id):
   # IN CID INT,
   # IN device_name varchar(512),
@@ -202,6 +252,7 @@ def add_or_update_device_for_customer(customer_id, device_name, device_type, ip_
   finally:
     cnx.commit()
     __teardown__(cursor,cnx)
+    auth_cache_utils.invalidate_agent_id(agent_id)
     return ret
 
 def add_file_to_restore_queue(agent_id, file_path):
@@ -468,6 +519,11 @@ def get_next_customer_id():
         __teardown__(cursor,cnx)
         return ret
 
+# Both lookups return None, rather than [], when the query itself failed:
+# still falsy for callers, but never cached, so a database hiccup does not
+# lock a valid key or agent out for the negative TTL.
+@auth_cache_utils.cached(auth_cache_utils.customer_id_cache, is_negative=lambda customer_id: not customer_id,
+                         is_cacheable=lambda customer_id: customer_id is not None)
 def get_customer_id_by_api_key(api_key):
   ret = []
 
@@ -486,11 +542,14 @@ def get_customer_id_by_api_key(api_key):
 
   except Error as e:
     __logger__().error(e)
+    ret = None
 
   finally:
     __teardown__(cursor,cnx)
     return ret
 
+@auth_cache_utils.cached(auth_cache_utils.device_cache, is_negative=lambda device: not device,
+                         is_cacheable=lambda device: device is not None)
 def get_device_by_agent_id(agent_id):
   ret = []
 
@@ -506,6 +565,7 @@ def get_device_by_agent_id(agent_id):
 
   except Error as e:
     __logger__().error(e)
+    ret = None
 
   finally:
     __teardown__(cursor,cnx)
@@ -554,6 +614,9 @@ def is_api_key_superuser(api_key):
     else:
       return False
 
+@auth_cache_utils.cached(auth_cache_utils.api_key_status_cache,
+                         is_negative=lambda status: status == "API_KEY_DOES_NOT_EXIST",
+                         is_cacheable=lambda status: status != "API_KEY_UNKNOWN")
 def get_api_key_status(api_key):
   ret = []
 
@@ -731,6 +794,26 @@ def register_backup_folders(customer_id, device_id, folders):
         __teardown__(cursor, cnx)
         return ret
 
+def _file_metadata_from_row(row):
+    return {
+        'FileObjectID': row[0],
+        'FileName': row[1],
+        'FilePath': row[2],
+        'ClientFullNameAndPath': row[3],
+        'ClientFullNameAndPathAsPosix': row[4],
+        'ClientDirectoryAsPosix': row[5],
+        'FileSize': row[6],
+        'FileType': row[7],
+        'StormcloudFullNameAndPath': row[8],
+        'TransDate': row[9].isoformat() if row[9] else None,
+        'DeviceName': row[10],
+        'DeviceType': row[11],
+        'IPAddress': row[12],
+        'OperatingSystem': row[13],
+        'DeviceStatus': row[14],
+        'LastCallback': row[15].isoformat() if row[15] else None
+    }
+
 def get_file_metadata_for_agent(agent_id):
     ret = []
     cnx = __connect_to_db__()
@@ -742,24 +825,7 @@ def get_file_metadata_for_agent(agent_id):
         for result in cursor.stored_results():
             rows = result.fetchall()
             for row in rows:
-                ret.append({
-                    'FileObjectID': row[0],
-                    'FileName': row[1],
-                    'FilePath': row[2],
-                    'ClientFullNameAndPath': row[3],
-                    'ClientFullNameAndPathAsPosix': row[4],
-                    'ClientDirectoryAsPosix': row[5],
-                    'FileSize': row[6],
-                    'FileType': row[7],
-                    'StormcloudFullNameAndPath': row[8],
-                    'TransDate': row[9].isoformat() if row[9] else None,
-                    'DeviceName': row[10],
-                    'DeviceType': row[11],
-                    'IPAddress': row[12],
-                    'OperatingSystem': row[13],
-                    'DeviceStatus': row[14],
-                    'LastCallback': row[15]
-                })
+                ret.append(_file_metadata_from_row(row))
 
     except Error as e:
         __logger__().error(f"Error in get_file_metadata_for_agent: {e}")
@@ -768,6 +834,80 @@ def get_file_metadata_for_agent(agent_id):
         __teardown__(cursor, cnx)
         return ret
 
+def iter_file_metadata_for_agent(agent_id, page_size=1000):
+    """
+        Like get_file_metadata_for_agent, but yields the records a page at a
+        time instead of building the whole list. Pages are keyset paginated
+        by FileObjectID, each one a short query whose connection goes back to
+        the pool before its records are yielded, so a client reading slowly
+        holds no connection or result set. Errors are raised, not swallowed:
+        a caller streaming the records cannot take back what it already sent.
+    """
+    after_file_object_id = 0
+
+    while True:
+        rows = get_file_metadata_page_for_agent(agent_id, after_file_object_id, page_size)
+
+        if rows is None:
+            # Database without the paged procedure
+            yield from _iter_file_metadata_unpaged(agent_id, page_size)
+            return
+
+        for row in rows:
+            yield _file_metadata_from_row(row)
+
+        if len(rows) < page_size:
+            return
+
+        after_file_object_id = rows[-1][0]
+
+def get_file_metadata_page_for_agent(agent_id, after_file_object_id, page_size):
+    # IN agent_id varchar(64), IN after_file_object_id INT, IN page_size INT
+    # The rows of get_file_metadata_for_agent with FileObjectID greater than
+    # after_file_object_id, ordered by FileObjectID, at most page_size of them.
+    # Returns None if the database does not have the procedure yet.
+    cnx = __connect_to_db__()
+    cursor = cnx.cursor(buffered=True)
+
+    try:
+        cursor.callproc('get_file_metadata_page_for_agent', (agent_id, after_file_object_id, page_size))
+
+        rows = []
+        for result in cursor.stored_results():
+            rows.extend(result.fetchall())
+
+        return rows
+
+    except Error as e:
+        if e.errno == errorcode.ER_SP_DOES_NOT_EXIST:
+            __logger__().warning("No get_file_metadata_page_for_agent procedure, reading file metadata unpaged")
+            return None
+        raise
+
+    finally:
+        __teardown__(cursor, cnx)
+
+def _iter_file_metadata_unpaged(agent_id, batch_size):
+    # Yields the rows as MySQL sends them (callproc buffers every row, so the
+    # procedure is run with CALL on an unbuffered cursor), holding the
+    # connection until the last one is read
+    cnx = __connect_to_db__()
+    cursor = cnx.cursor()
+
+    try:
+        cursor.execute("CALL get_file_metadata_for_agent(%s)", (agent_id,))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                yield _file_metadata_from_row(row)
+
+    finally:
+        __teardown__(cursor, cnx)
+
 def store_error_log(customer_id, device_id, agent_id, source, application_version, log_content):
     """Store an error log and return the log ID"""
     ret = None
@@ -872,21 +1012,11 @@ def hash_password(password):
     return salt, password_hash
 
 def __connect_to_db__():
-  mysql_username = os.getenv('MYSQLUSER')
-  mysql_password = os.getenv('MYSQLPASSWORD')
-  mysql_db_name  = os.getenv('MYSQLDBNAME')
-  mysql_db_host  = os.getenv('MYSQLHOST')
-  mysql_db_port  = os.getenv('MYSQLPORT')
-
-  return mysql.connector.connect(
-          user=mysql_username,
-          password=mysql_password,
-          database=mysql_db_name,
-          host=mysql_db_host,
-          port=mysql_db_port
-         )
+  # Pooled, and shared by every call within a request; see db_pool_utils
+  return db_pool_utils.get_connection()
 
 def __teardown__(cursor,cnx):
-  if cnx.is_connected():
+  try:
     cursor.close()
-    cnx.close()
+  finally:
+    db_pool_utils.put_connection(cnx)
@@ -0,0 +1,240 @@
+import os
+import threading
+import time
+
+import mysql.connector
+
+import logging_utils
+
+# Process-wide pool of MySQL connections for database_utils.
+#
+# Connections are opened on demand up to MYSQL_POOL_SIZE and handed back to the
+# pool instead of being closed. A caller that finds the pool exhausted waits up
+# to MYSQL_POOL_TIMEOUT seconds for one to be returned. A connection that has
+# sat idle longer than MYSQL_POOL_HEALTH_CHECK_SECONDS is pinged (and
+# reconnected if the server dropped it) before it is handed out, so a busy
+# server does not pay a ping per query.
+#
+# Inside a request (between begin_request and end_request) every database call
+# on the thread shares one connection, so a backup request that checks the API
+# key, customer, device and file costs one checkout instead of four connects.
+# Handlers call release_connection once their lookups are done and before slow
+# work that needs no database (copying a large upload to disk, waiting for
+# restore work), so a few long requests cannot hold the whole pool.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_HEALTH_CHECK_SECONDS = 30
+
+class PoolTimeout(Exception):
+    pass
+
+def __logger__():
+    return logging_utils.logger
+
+def _connection_config():
+    return {
+        'user': os.getenv('MYSQLUSER'),
+        'password': os.getenv('MYSQLPASSWORD'),
+        'database': os.getenv('MYSQLDBNAME'),
+        'host': os.getenv('MYSQLHOST'),
+        'port': os.getenv('MYSQLPORT'),
+        # Results a caller did not fetch are read off before the next query,
+        # so a reused connection never sees "Unread result found"
+        'consume_results': True
+    }
+
+class ConnectionPool:
+    def __init__(self, size, timeout, health_check_seconds, connect=None):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self._connect = connect or (lambda: mysql.connector.connect(**_connection_config()))
+
+        self._condition = threading.Condition()
+        self._idle = []          # (connection, time returned), most recently used last
+        self._open = 0
+
+        self._checkouts = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._waits = 0
+        self._timeouts = 0
+        self._created = 0
+        self._health_check_failures = 0
+
+    def acquire(self):
+        """Returns a healthy connection, waiting for one if the pool is exhausted. Raises PoolTimeout."""
+        started = time.monotonic()
+
+        with self._condition:
+            while not self._idle and self._open >= self.size:
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("No database connection free after %ds (pool size %d)" % (self.timeout, self.size))
+
+                self._condition.wait(remaining)
+
+            if self._idle:
+                cnx, returned = self._idle.pop()
+            else:
+                cnx, returned = None, None
+                self._open += 1
+
+            waited = time.monotonic() - started
+            self._checkouts += 1
+            self._wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+            if waited > 0.001:
+                self._waits += 1
+
+        # Connecting and pinging happen outside the lock
+        try:
+            if cnx is None:
+                return self._new_connection()
+
+            if time.monotonic() - returned > self.health_check_seconds and not self._is_healthy(cnx):
+                self._close_quietly(cnx)
+                return self._new_connection()
+
+            return cnx
+
+        except BaseException:
+            self._discard()
+            raise
+
+    def release(self, cnx):
+        """Hand a connection back, ending any transaction the caller left open"""
+        try:
+            if cnx.in_transaction:
+                cnx.rollback()
+        except Exception as e:
+            __logger__().warning("Dropping database connection that failed to roll back: %s" % e)
+            self.discard(cnx)
+            return
+
+        with self._condition:
+            self._idle.append((cnx, time.monotonic()))
+            self._condition.notify()
+
+    def get_metrics(self):
+        with self._condition:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'average_wait_ms': round(1000 * self._wait_seconds / self._checkouts, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(1000 * self._max_wait_seconds, 3),
+                'connections_created': self._created,
+                'health_check_failures': self._health_check_failures
+            }
+
+    def close_all(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._condition.notify_all()
+
+        for cnx, _ in idle:
+            self._close_quietly(cnx)
+
+    def _new_connection(self):
+        cnx = self._connect()
+        with self._condition:
+            self._created += 1
+        return cnx
+
+    def _is_healthy(self, cnx):
+        try:
+            cnx.ping(reconnect=True, attempts=2, delay=0)
+            return True
+        except Exception as e:
+            with self._condition:
+                self._health_check_failures += 1
+            __logger__().warning("Pooled database connection failed its health check: %s" % e)
+            return False
+
+    def discard(self, cnx):
+        """Close a checked out connection instead of returning it, freeing its place in the pool"""
+        self._close_quietly(cnx)
+        self._discard()
+
+    def _discard(self):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def _close_quietly(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+def get_pool():
+    """The process-wide pool, created from the environment on first use"""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                int(os.getenv('MYSQL_POOL_SIZE', DEFAULT_POOL_SIZE)),
+                float(os.getenv('MYSQL_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)),
+                float(os.getenv('MYSQL_POOL_HEALTH_CHECK_SECONDS', DEFAULT_HEALTH_CHECK_SECONDS))
+            )
+            __logger__().info("Created database connection pool of %d connections" % _pool.size)
+
+        return _pool
+
+def begin_request():
+    """Start sharing one connection between the database calls of this thread's request"""
+    _local.in_request = True
+    _local.connection = None
+
+def end_request():
+    """Return the request's connection, if it used one, to the pool"""
+    release_connection()
+    _local.in_request = False
+
+def release_connection():
+    """Return the request's connection to the pool now; a later database call in the request checks one out again"""
+    cnx = getattr(_local, 'connection', None)
+    _local.connection = None
+
+    if cnx is not None:
+        get_pool().release(cnx)
+
+def get_connection():
+    """A connection for one database call; give it back with put_connection"""
+    if not getattr(_local, 'in_request', False):
+        return get_pool().acquire()
+
+    if _local.connection is None:
+        _local.connection = get_pool().acquire()
+
+    return _local.connection
+
+def put_connection(cnx):
+    if cnx is not getattr(_local, 'connection', None):
+        get_pool().release(cnx)
+        return
+
+    # Kept for the rest of the request, but each call still ends its own
+    # transaction, as it did when every call had its own connection
+    try:
+        if cnx.in_transaction:
+            cnx.rollback()
+    except Exception as e:
+        __logger__().warning("Dropping request database connection: %s" % e)
+        _local.connection = None
+        get_pool().discard(cnx)
+
+def get_pool_metrics():
+    return get_pool().get_metrics()
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import database_utils as db
+import logging_utils, metadata_log_utils
+
+# Batches the MySQL file records (add_or_update_file_for_device) written for
+# uploaded files. Records are grouped per device and written with one
+# transaction per device, rather than one connection and commit per file,
+# which is what made seeding a new device with hundreds of thousands of
+# files slow.
+#
+# A batch is written when it reaches FILE_RECORD_BATCH_SIZE records, when its
+# oldest record has waited FILE_RECORD_FLUSH_SECONDS, and whenever flush() is
+# called. The work queue flushes before it acknowledges a batch of jobs, so a
+# job is only finished once its record is in the database, and a file's
+# record is always written after the version it describes was stored.
+#
+# Records for the same file within one batch collapse to the newest. If a
+# batch fails it is retried one record at a time, so one bad record does not
+# lose the others; a record that still fails is logged, as single writes are.
+# If flush() itself fails (the database is unreachable), the records it had
+# not written go back in the queue and the error is raised, so the work queue
+# leaves the batch unacknowledged and runs its jobs again: a record is never
+# only in memory once its job is gone.
+# Written records are also added to the metadata change log, which clients
+# sync their manifests from.
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_SECONDS = 2.0
+
+batch_size = int(os.getenv('FILE_RECORD_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+flush_seconds = float(os.getenv('FILE_RECORD_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS))
+
+_lock = threading.RLock()
+_pending = OrderedDict()   # device_id -> OrderedDict(path_on_server -> record arguments)
+_pending_count = 0
+_oldest = None
+
+_batches = 0
+_records = 0
+_fallbacks = 0
+
+def __logger__():
+    return logging_utils.logger
+
+def add(device_id, file_name, file_path, path_on_device, path_on_device_posix, directory_on_device_posix, file_size, file_type, path_on_server):
+    """Queue one file record, in the argument order of db.add_or_update_file_for_device"""
+    global _pending_count, _oldest
+
+    with _lock:
+        device_records = _pending.setdefault(device_id, OrderedDict())
+
+        if path_on_server in device_records:
+            # Keep the newest, but write it where the newest would have gone
+            del device_records[path_on_server]
+        else:
+            _pending_count += 1
+
+        device_records[path_on_server] = (device_id, file_name, file_path, path_on_device, path_on_device_posix,
+                                          directory_on_device_posix, file_size, file_type, path_on_server)
+
+        if _oldest is None:
+            _oldest = time.monotonic()
+
+        if _pending_count >= batch_size or time.monotonic() - _oldest >= flush_seconds:
+            try:
+                flush()
+            except Exception as e:
+                # Kept for the flush the work queue runs before acknowledging the job
+                __logger__().error("Writing file records failed, will retry: %s" % e)
+
+def flush():
+    """Write every queued record. Raises if the database fails; unwritten records are kept."""
+    global _pending, _pending_count, _oldest, _batches, _records, _fallbacks
+
+    with _lock:
+        pending, _pending = _pending, OrderedDict()
+        _pending_count = 0
+        _oldest = None
+
+        unwritten = [row for device_records in pending.values() for row in device_records.values()]
+        try:
+            for device_id, device_records in pending.items():
+                rows = list(device_records.values())
+
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    _batches += 1
+                    _records += len(batch)
+
+                    if not db.add_or_update_files_for_device(batch):
+                        _fallbacks += 1
+                        __logger__().warning("Writing %d file records for device %s one at a time" % (len(batch), device_id))
+                        for row in batch:
+                            db.add_or_update_file_for_device(*row)
+
+                    metadata_log_utils.record_files(batch)
+                    del unwritten[:len(batch)]
+        except Exception:
+            _requeue(unwritten)
+            raise
+
+def _requeue(rows):
+    """Put rows a failed flush did not write back in the queue, behind nothing newer for the same file"""
+    global _pending_count, _oldest
+
+    for row in rows:
+        device_id, path_on_server = row[0], row[8]
+        device_records = _pending.setdefault(device_id, OrderedDict())
+
+        if path_on_server not in device_records:
+            device_records[path_on_server] = row
+            _pending_count += 1
+
+    if rows and _oldest is None:
+        _oldest = time.monotonic()
+
+def get_stats():
+    with _lock:
+        return {
+            'pending': _pending_count,
+            'batches': _batches,
+            'records': _records,
+            'average_batch': round(_records / _batches, 1) if _batches else 0.0,
+            'fallbacks': _fallbacks
+        }
@@ -2,6 +2,11 @@ import json
 import base64
 
 import database_utils as db
+import db_pool_utils
+import auth_cache_utils
+import work_queue_utils
+import file_record_utils
+import keepalive_utils
 import logging_utils
 import crypto_utils
 
@@ -46,6 +51,24 @@ def handle_update_build_result_request(request):
 
     return 200, response_data
 
+def handle_db_pool_metrics_request(request):
+    __logger__().info("Server handling database pool metrics request.")
+    return 200, json.dumps({'db_pool_metrics-response': db_pool_utils.get_pool_metrics()})
+
+def handle_auth_cache_metrics_request(request):
+    __logger__().info("Server handling authentication cache metrics request.")
+    return 200, json.dumps({'auth_cache_metrics-response': auth_cache_utils.get_cache_stats()})
+
+def handle_work_queue_metrics_request(request):
+    __logger__().info("Server handling work queue metrics request.")
+    metrics = work_queue_utils.get_queue_metrics()
+    metrics['file_records'] = file_record_utils.get_stats()
+    return 200, json.dumps({'work_queue_metrics-response': metrics})
+
+def handle_keepalive_metrics_request(request):
+    __logger__().info("Server handling keepalive metrics request.")
+    return 200, json.dumps({'keepalive_metrics-response': keepalive_utils.get_callback_stats()})
+
 def handle_get_builds_request(request):
     __logger__().info("Server handling get builds request.")
 
@@ -1,8 +1,9 @@
 import json
+import math
 from datetime import datetime
 
 import database_utils as db
-import logging_utils, keepalive_utils
+import logging_utils, keepalive_utils, db_pool_utils
 
 STRING_401_BAD_REQUEST = "Bad request."
 RESPONSE_401_BAD_REQUEST = (
@@ -30,3 +31,46 @@ def handle_keepalive_request(request):
 
     return 200,json.dumps(response_data)
 
+def handle_keepalive_wait_request(request):
+    """
+        Keepalive that is held open until restore work is queued for the
+        agent or request['wait_seconds'] (at most MAX_WAIT_SECONDS) pass, so
+        a client can stay connected instead of polling /api/keepalive.
+        Responds like /api/keepalive.
+    """
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
+
+    try:
+        wait_seconds = float(request.get('wait_seconds', keepalive_utils.MAX_WAIT_SECONDS))
+    except (TypeError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    # float() accepts "nan" and "inf", which would never time out
+    if not math.isfinite(wait_seconds):
+        return RESPONSE_401_BAD_REQUEST
+
+    wait_seconds = max(0.0, min(wait_seconds, keepalive_utils.MAX_WAIT_SECONDS))
+
+    device_id = results[0]
+    keepalive_utils.record_keepalive(device_id,datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    # Read before querying, so a restore queued in between still wakes us
+    generation = keepalive_utils.get_restore_generation(request['agent_id'])
+
+    response_data = keepalive_utils.get_keepalive_response_data(device_id)
+    if response_data['restore_queue'] or wait_seconds <= 0:
+        return 200,json.dumps(response_data)
+
+    # Don't hold a database connection while waiting
+    db_pool_utils.release_connection()
+
+    if keepalive_utils.wait_for_restore(request['agent_id'], generation, wait_seconds):
+        response_data = keepalive_utils.get_keepalive_response_data(device_id)
+
+    return 200,json.dumps(response_data)
@@ -1,14 +1,124 @@
+import atexit
+import threading
+import time
+
+from datetime import datetime
+
 import database_utils as db
 import logging_utils
 
+# Longest a /api/keepalive-wait request is held open waiting for restore work
+MAX_WAIT_SECONDS = 55
+
+# Keepalive timestamps are kept in memory and written to the database by a
+# background thread every CALLBACK_FLUSH_SECONDS, one transaction for all
+# devices seen since the last flush, so keepalive traffic costs a write per
+# device per interval instead of a connection and commit per ping. A device
+# that pings several times in one interval gets one callback row, with its
+# latest time. If the batch fails, its rows are written one at a time, so one
+# device whose update always fails does not hold back every other device.
+# get_last_seen answers from memory, including pings not yet written; the
+# metadata snapshot uses it for the device's LastCallback.
+CALLBACK_FLUSH_SECONDS = 5
+
+_callback_lock = threading.Lock()
+_pending_callbacks = {}   # device_id -> (callback_time, status_code)
+_last_seen = {}           # device_id -> callback_time, of every device this process has seen
+_callback_thread = None
+_callbacks_received = 0
+_callbacks_written = 0
+_callback_flushes = 0
+
+# Restore queue notifications. Queueing a file for restore bumps the agent's
+# generation and wakes any keepalive-wait request held open for that agent,
+# so the client hears about the restore at once instead of at its next poll.
+# Notifications are per process: a waiter in another process finds the work
+# when its wait times out and the client polls again.
+_restore_condition = threading.Condition()
+_restore_generations = {}   # agent_id -> number of restores queued
+
 def __logger__():
     return logging_utils.logger
 
 def record_keepalive(device_id,current_time):
+    """Buffer a keepalive from device_id; flush_callbacks writes it to the database"""
+    global _callback_thread, _callbacks_received
+
     __logger__().info("recording keepalive for device %d" %device_id)
-    ret = db.update_callback_for_device(device_id,current_time,0)
 
-    return ret
+    with _callback_lock:
+        _pending_callbacks[device_id] = (current_time, 0)
+        _last_seen[device_id] = current_time
+        _callbacks_received += 1
+
+        # Started on first use, so it runs in the process that serves requests
+        if _callback_thread is None or not _callback_thread.is_alive():
+            _callback_thread = threading.Thread(target=_callback_flush_loop, name="sc-callback-writer", daemon=True)
+            _callback_thread.start()
+
+def get_last_seen(device_id):
+    """The device's latest keepalive time seen by this process, in ISO 8601, or None"""
+    with _callback_lock:
+        last_seen = _last_seen.get(device_id)
+
+    return datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S").isoformat() if last_seen else None
+
+def flush_callbacks():
+    """Write every buffered keepalive. Returns the number of devices written."""
+    global _pending_callbacks, _callbacks_written, _callback_flushes
+
+    with _callback_lock:
+        pending, _pending_callbacks = _pending_callbacks, {}
+
+    if not pending:
+        return 0
+
+    rows = [(device_id, callback_time, status_code) for device_id, (callback_time, status_code) in pending.items()]
+
+    if not db.update_callbacks_for_devices(rows):
+        __logger__().warning("Writing %d keepalive callbacks one at a time" % len(rows))
+        written = 0
+
+        try:
+            # A row that fails here is logged and dropped, as single writes always were
+            for row in rows:
+                db.update_callback_for_device(*row)
+                written += 1
+
+        except Exception:
+            # The database is unreachable: put the rest back unless a newer ping arrived meanwhile
+            with _callback_lock:
+                for device_id, callback_time, status_code in rows[written:]:
+                    _pending_callbacks.setdefault(device_id, (callback_time, status_code))
+            raise
+
+    with _callback_lock:
+        _callbacks_written += len(rows)
+        _callback_flushes += 1
+
+    return len(rows)
+
+# Keepalives received since the last flush are not lost on a clean shutdown
+atexit.register(flush_callbacks)
+
+def _callback_flush_loop():
+    while True:
+        time.sleep(CALLBACK_FLUSH_SECONDS)
+
+        try:
+            flush_callbacks()
+        except Exception as e:
+            __logger__().error("Writing keepalive callbacks failed: %s" % e)
+
+def get_callback_stats():
+    with _callback_lock:
+        return {
+            'pending': len(_pending_callbacks),
+            'devices_seen': len(_last_seen),
+            'received': _callbacks_received,
+            'written': _callbacks_written,
+            'flushes': _callback_flushes
+        }
 
 def get_keepalive_response_data(device_id):
     file_list_tuples = db.get_list_of_files_to_restore(device_id)
@@ -19,3 +129,25 @@ def get_keepalive_response_data(device_id):
     }
 
     return data_dict
+
+def notify_restore_queued(agent_id):
+    with _restore_condition:
+        _restore_generations[agent_id] = _restore_generations.get(agent_id, 0) + 1
+        _restore_condition.notify_all()
+
+def get_restore_generation(agent_id):
+    with _restore_condition:
+        return _restore_generations.get(agent_id, 0)
+
+def wait_for_restore(agent_id, generation, timeout):
+    """Wait until a restore is queued for agent_id after generation was read. Returns True if one was."""
+    deadline = time.monotonic() + timeout
+
+    with _restore_condition:
+        while _restore_generations.get(agent_id, 0) == generation:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _restore_condition.wait(remaining)
+
+        return True
@@ -0,0 +1,140 @@
+import json
+import zlib
+
+import database_utils as db
+import logging_utils, keepalive_utils, metadata_log_utils
+
+STRING_401_BAD_REQUEST = "Bad request."
+RESPONSE_401_BAD_REQUEST = (
+  401,json.dumps({'error':STRING_401_BAD_REQUEST})
+)
+
+# Columns of get_file_metadata_for_agent that describe the device rather than
+# the file; sent once per snapshot instead of on every row
+DEVICE_FIELDS = ('DeviceName', 'DeviceType', 'IPAddress', 'OperatingSystem', 'DeviceStatus', 'LastCallback')
+
+# File metadata responses are streamed: records are serialized as they are
+# read and sent in pieces of about this size (before compression), so memory
+# does not grow with the number of files
+STREAM_BUFFER_SIZE = 64*1024
+
+def __logger__():
+    return logging_utils.logger
+
+def dumps_record(record):
+    """
+        One file metadata record as JSON. Column values json cannot encode
+        (DECIMAL, for instance) are sent as strings, as jsonify sent them
+        when the whole response was built at once.
+    """
+    return json.dumps(record, default=str)
+
+def encode_stream(pieces, compress):
+    """Join the strings of pieces into blocks of about STREAM_BUFFER_SIZE bytes, gzip compressed if compress"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    buffered = 0
+
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+
+        if buffered >= STREAM_BUFFER_SIZE:
+            block = "".join(buffer).encode("utf-8")
+            buffer, buffered = [], 0
+
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+
+    block = "".join(buffer).encode("utf-8")
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+def handle_file_metadata_request(request, compress=False):
+    """
+        Every file record of the agent's device, as the JSON document
+        {"success": true, "data": [...]}, streamed.
+        Returns (200, generator of blocks).
+    """
+    __logger__().info("Server handling file metadata request.")
+
+    def pieces():
+        yield '{"success": true, "data": ['
+        separator = ""
+        for record in db.iter_file_metadata_for_agent(request['agent_id']):
+            yield separator + dumps_record(record)
+            separator = ", "
+        yield ']}'
+
+    return 200, encode_stream(pieces(), compress)
+
+def handle_file_metadata_changes_request(request, compress=False):
+    """
+        The device's file records changed since request['cursor'], or all of
+        them if there is no usable cursor, streamed as newline delimited JSON:
+
+            {"full": true|false, "cursor": "...", "device": {...}}
+            one line per file record
+            {"end": true, "count": n}
+
+        The device line is only sent with a full snapshot. The client applies
+        the changes and keeps the cursor for its next request only once it
+        has read the end line. Returns (200, generator of blocks) or
+        (code, json error).
+    """
+    __logger__().info("Server handling file metadata changes request.")
+
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
+
+    device_id = results[0]
+    since_seq = metadata_log_utils.parse_cursor(request.get('cursor', ''))
+
+    if since_seq is None:
+        # Taken before the snapshot: files recorded meanwhile are sent again next time
+        cursor = metadata_log_utils.get_cursor()
+        lines = _snapshot_lines(request['agent_id'], device_id, cursor)
+    else:
+        cursor, until_seq = metadata_log_utils.get_changes_cursor(since_seq)
+        lines = _change_lines(device_id, since_seq, until_seq, cursor)
+
+    return 200, encode_stream(lines, compress)
+
+def _snapshot_lines(agent_id, device_id, cursor):
+    count = 0
+
+    for record in db.iter_file_metadata_for_agent(agent_id):
+        device = {field: record.pop(field, None) for field in DEVICE_FIELDS}
+
+        if count == 0:
+            # Keepalives are written to the database in batches, so memory may be newer
+            last_seen = keepalive_utils.get_last_seen(device_id)
+            device['LastCallback'] = max(filter(None, [device['LastCallback'], last_seen]), default=None)
+            yield json.dumps({'full': True, 'cursor': cursor, 'device': device}, default=str) + "\n"
+
+        yield dumps_record(record) + "\n"
+        count += 1
+
+    if count == 0:
+        yield json.dumps({'full': True, 'cursor': cursor, 'device': {}}) + "\n"
+
+    yield json.dumps({'end': True, 'count': count}) + "\n"
+    __logger__().info("Sent full file metadata snapshot of %d files." % count)
+
+def _change_lines(device_id, since_seq, until_seq, cursor):
+    yield json.dumps({'full': False, 'cursor': cursor}) + "\n"
+
+    count = 0
+    for record in metadata_log_utils.iter_changes(device_id, since_seq, until_seq):
+        yield dumps_record(record) + "\n"
+        count += 1
+
+    yield json.dumps({'end': True, 'count': count}) + "\n"
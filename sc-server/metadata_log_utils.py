@@ -0,0 +1,134 @@
+import datetime
+import json
+import sqlite3
+import threading
+import uuid
+
+import logging_utils
+
+# Change log behind /api/file-metadata-changes, so a client can keep its
+# manifest of backed up files current by fetching only what changed:
+#
+#   changes  one row per file per device, holding the fields
+#            /api/file-metadata returns for it. Recording a file again
+#            replaces its row with a new, higher seq, so "everything since
+#            seq N" is a range scan however many times each file changed.
+#   meta     the log's epoch, a random id chosen when the log is created.
+#
+# Clients hold a cursor "<epoch>:<seq>". A cursor from another epoch (the log
+# was recreated) or no cursor at all gets a full snapshot instead.
+#
+# Files are recorded as their MySQL records are written (file_record_utils),
+# after the database write, so a cursor taken before a snapshot from MySQL
+# never skips a file the snapshot is missing.
+METADATA_LOG_PATH = "/storage/metadata_log.db"
+
+# Changes are read from the log this many at a time (keyset pagination on seq)
+PAGE_SIZE = 1000
+
+_local = threading.local()
+
+def __logger__():
+    return logging_utils.logger
+
+def get_connection():
+    """One connection per thread, created (with the schema) on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != METADATA_LOG_PATH:
+        conn = sqlite3.connect(METADATA_LOG_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _create_tables(conn)
+        _local.conn = conn
+        _local.path = METADATA_LOG_PATH
+
+    return conn
+
+def _create_tables(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                path_on_server TEXT NOT NULL,
+                record TEXT NOT NULL,
+                UNIQUE (device_id, path_on_server)
+            )''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_changes_device_seq ON changes (device_id, seq)''')
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)''')
+        conn.execute('''INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)''', (uuid.uuid4().hex,))
+
+def _get_epoch(conn):
+    return conn.execute('''SELECT value FROM meta WHERE key = 'epoch' ''').fetchone()[0]
+
+def record_files(rows):
+    """
+        Log files whose records were just written. rows are argument tuples
+        of db.add_or_update_file_for_device.
+    """
+    now = datetime.datetime.now().isoformat()
+    conn = get_connection()
+
+    with conn:
+        conn.executemany('''INSERT OR REPLACE INTO changes (device_id, path_on_server, record) VALUES (?,?,?)''', [
+            (device_id, path_on_server, json.dumps({
+                'FileName': file_name,
+                'FilePath': file_path,
+                'ClientFullNameAndPath': path_on_device,
+                'ClientFullNameAndPathAsPosix': path_on_device_posix,
+                'ClientDirectoryAsPosix': directory_on_device_posix,
+                'FileSize': file_size,
+                'FileType': file_type,
+                'StormcloudFullNameAndPath': path_on_server,
+                'TransDate': now
+            }))
+            for (device_id, file_name, file_path, path_on_device, path_on_device_posix,
+                 directory_on_device_posix, file_size, file_type, path_on_server) in rows
+        ])
+
+def get_cursor():
+    """The cursor that follows every change logged so far"""
+    conn = get_connection()
+    seq = conn.execute('''SELECT MAX(seq) FROM changes''').fetchone()[0] or 0
+    return "%s:%d" % (_get_epoch(conn), seq)
+
+def parse_cursor(cursor):
+    """The seq a cursor of this log stands for, or None if it is missing, malformed or from another epoch"""
+    try:
+        epoch, seq = str(cursor).split(":")
+        seq = int(seq)
+    except ValueError:
+        return None
+
+    if epoch != _get_epoch(get_connection()) or seq < 0:
+        return None
+
+    return seq
+
+def get_changes_cursor(since_seq):
+    """
+        The cursor to hand out after sending the changes iter_changes(since_seq)
+        yields; read it before iterating, so a change logged meanwhile is
+        sent next time rather than skipped
+    """
+    conn = get_connection()
+    latest = conn.execute('''SELECT MAX(seq) FROM changes''').fetchone()[0] or 0
+    return "%s:%d" % (_get_epoch(conn), max(latest, since_seq)), latest
+
+def iter_changes(device_id, since_seq, until_seq, page_size=PAGE_SIZE):
+    """Records of the device's files changed after since_seq, up to until_seq, oldest change first"""
+    conn = get_connection()
+
+    while True:
+        rows = conn.execute('''SELECT seq, record FROM changes WHERE device_id = ? AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?''',
+                            (device_id, since_seq, until_seq, page_size)).fetchall()
+
+        for _, record in rows:
+            yield json.loads(record)
+
+        if len(rows) < page_size:
+            return
+
+        since_seq = rows[-1][0]
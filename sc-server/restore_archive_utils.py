@@ -0,0 +1,135 @@
+import os
+import tarfile
+import time
+
+import logging_utils, backup_utils, blob_store_utils, catalog_utils
+
+# Bulk restores are sent as one uncompressed (PAX) tar stream, built on the
+# fly: a header, the file's bytes read straight from disk, and padding, for
+# each file in turn. Nothing is buffered beyond one read block, so an archive
+# of 200k files costs the same memory as one of 2.
+#
+# Member names are the client-side paths exactly as the client backed them up
+# (PAX headers carry long and non-ASCII names). Each member also carries the
+# file's SHA-256 in an "SC.sha256" PAX record when the catalog knows it.
+READ_BLOCK_SIZE = 1024*1024
+
+# Upper bound on paths in one /api/restore-files-archive request
+MAX_ARCHIVE_FILES = 50000
+
+# Server-side bookkeeping that is never part of a restore
+INTERNAL_DIRECTORIES = {".SCVERS", ".SCRECIPES"}
+
+def __logger__():
+    return logging_utils.logger
+
+def get_current_digest(path_on_server):
+    """
+        SHA-256 of the file at path_on_server if it is the current version's
+        blob (a hard link to it), else None. Costs a catalog lookup and a stat,
+        never a read of the file.
+    """
+    latest = catalog_utils.get_latest_version(path_on_server)
+    if not latest:
+        return None
+
+    blob_path = blob_store_utils.get_blob_path(latest[1])
+    if os.path.exists(blob_path) and os.path.samefile(path_on_server, blob_path):
+        return latest[1]
+
+    return None
+
+def resolve_paths(customer_id, device_id, paths_on_device):
+    """Map client-side paths to (path_on_device, path_on_server), dropping any outside the device's storage"""
+    resolved = []
+
+    for path_on_device in paths_on_device:
+        path_on_server, device_root = backup_utils.make_server_path(customer_id, device_id, path_on_device)
+
+        if not _is_inside(path_on_server, device_root):
+            __logger__().warning("Refusing to restore path outside device storage: %s" % path_on_device)
+            continue
+
+        resolved.append((path_on_device, path_on_server))
+
+    return resolved
+
+def walk_prefix(customer_id, device_id, prefix):
+    """Yield (path_on_device, path_on_server) for every backed up file under the client-side directory prefix"""
+    prefix_on_server, device_root = backup_utils.make_server_path(customer_id, device_id, prefix)
+
+    if not _is_inside(prefix_on_server, device_root) or not os.path.isdir(prefix_on_server):
+        return
+
+    prefix_on_device = backup_utils.normalize_path(prefix).rstrip("/")
+
+    for root, directories, files in os.walk(prefix_on_server):
+        directories[:] = sorted(d for d in directories if d not in INTERNAL_DIRECTORIES)
+        relative_root = os.path.relpath(root, prefix_on_server)
+
+        for name in sorted(files):
+            # Uploads still being written
+            if name.startswith(".") and ".sc-upload-" in name:
+                continue
+
+            relative_path = name if relative_root == "." else relative_root + "/" + name
+            yield prefix_on_device + "/" + relative_path, os.path.join(root, name)
+
+def iter_tar_stream(entries):
+    """
+        Generate the tar archive of entries, (path_on_device, path_on_server)
+        pairs, block by block. Files that are missing or unreadable are
+        skipped; the client sees which ones did not arrive.
+    """
+    sent = 0
+    skipped = 0
+    started = time.time()
+
+    for path_on_device, path_on_server in entries:
+        try:
+            f = open(path_on_server, 'rb')
+        except OSError:
+            skipped += 1
+            continue
+
+        with f:
+            file_stat = os.fstat(f.fileno())
+
+            info = tarfile.TarInfo(path_on_device)
+            info.size = file_stat.st_size
+            info.mtime = file_stat.st_mtime
+            info.mode = 0o644
+
+            digest = get_current_digest(path_on_server)
+            if digest:
+                info.pax_headers = {'SC.sha256': digest}
+
+            yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+            remaining = info.size
+            while remaining > 0:
+                block = f.read(min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+
+            # A file that shrank while being sent is padded to the size in its
+            # header so the archive stays readable; its digest will not match.
+            if remaining:
+                __logger__().warning("%s changed while being archived" % path_on_server)
+                yield b"\0" * remaining
+
+            padding = -info.size % tarfile.BLOCKSIZE
+            if padding:
+                yield b"\0" * padding
+
+        sent += 1
+
+    # End of archive: two zero blocks, padded out to a whole record
+    yield b"\0" * tarfile.RECORDSIZE
+
+    __logger__().info("Archived %d files for restore in %.1fs (%d skipped)" % (sent, time.time() - started, skipped))
+
+def _is_inside(path, directory):
+    return os.path.normpath(path).startswith(os.path.normpath(directory) + "/")
@@ -4,11 +4,12 @@ import os
 import base64
 
 import database_utils as db
-import logging_utils, crypto_utils, backup_utils
+import logging_utils, crypto_utils, backup_utils, blob_store_utils, catalog_utils, restore_archive_utils, keepalive_utils
 
 from urllib.parse import unquote
 
-# Unfortunately currently imposing a size limit on restore until I can figure out how to stream responses
+# Only for the JSON /api/restore-file endpoint, which holds the whole (base64)
+# file in memory; /api/restore-file-stream has no limit.
 SIZE_LIMIT = 300*1024*1024
 
 STRING_401_BAD_REQUEST = "Bad request."
@@ -23,6 +24,10 @@ RESPONSE_413_TOO_LARGE = (
   413, json.dumps({'error': STRING_413_TOO_LARGE})
 )
 
+RESPONSE_400_BAD_VERSION = (
+  400, json.dumps({'error': 'Bad version_id.'})
+)
+
 def __logger__():
     return logging_utils.logger
 
@@ -51,6 +56,7 @@ def handle_queue_file_for_restore_request(request):
 
     if ret:
         __logger__().info("Successfully added file to restore queue.")
+        keepalive_utils.notify_restore_queued(request['agent_id'])
         return 200, json.dumps({'queue_file_for_restore-response': 'Successfully added file to restore queue.'})
     else:
         __logger__().info("Got bad return code when trying to add file to restore queue.")
@@ -66,7 +72,18 @@ def handle_restore_file_request(request):
 
     device_id,_,_,_,_,_,_,_,_,_ = db.get_device_by_agent_id(request['agent_id'])
     path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
-    path_on_server = db.get_server_path_for_file(device_id, path_on_device)
+
+    if request.get('version_id') is not None:
+        version_id = _parse_version_id(request['version_id'])
+        if version_id is None:
+            return RESPONSE_400_BAD_VERSION
+
+        # A specific (possibly older) version, served straight from its blob
+        path_on_server = blob_store_utils.get_version_path(version_id, customer_id, device_id, path_on_device)
+        if not path_on_server:
+            return 404, json.dumps({'error': 'Version not found.'})
+    else:
+        path_on_server = db.get_server_path_for_file(device_id, path_on_device)
     
     # Get file size
     file_size = os.path.getsize(path_on_server)
@@ -108,8 +125,149 @@ def handle_restore_file_request(request):
     db.mark_file_as_restored(device_id, path_on_device)
     return 200, json.dumps(response_data)
 
-def handle_restore_complete_request():
-    pass
+def handle_restore_file_stream_request(request):
+    """
+        Find the file to stream for /api/restore-file-stream.
+
+        Returns (200, path_on_server, sha256) where sha256 is the content
+        digest if the catalog knows it (else None), or (code, json error, None).
+
+        The restore queue entry is left alone: this also answers HEAD and
+        Range requests, so the client confirms a finished restore through
+        /api/restore-complete instead.
+    """
+    __logger__().info("Server handling restore file stream request.")
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST + (None,)
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST + (None,)
+
+    device_id,_,_,_,_,_,_,_,_,_ = results
+
+    try:
+        path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST + (None,)
+
+    if request.get('version_id'):
+        version_id = _parse_version_id(request['version_id'])
+        if version_id is None:
+            return RESPONSE_400_BAD_VERSION + (None,)
+
+        digest = blob_store_utils.get_version_digest(version_id, customer_id, device_id, path_on_device)
+        if not digest:
+            return 404, json.dumps({'error': 'Version not found.'}), None
+
+        return 200, blob_store_utils.get_blob_path(digest), digest
+
+    path_on_server = db.get_server_path_for_file(device_id, path_on_device)
+    if not path_on_server or not os.path.exists(path_on_server):
+        return 404, json.dumps({'error': 'File not found.'}), None
+
+    # The current version is a link to its blob, so its digest is known
+    # without reading the file.
+    digest = restore_archive_utils.get_current_digest(path_on_server)
+
+    return 200, path_on_server, digest
+
+def _parse_version_id(value):
+    """Returns value as a version_id, or None if it is not a positive integer"""
+    try:
+        version_id = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    return version_id if version_id > 0 else None
+
+def handle_restore_archive_request(request):
+    """
+        Restore many files in one response: either file_paths, a comma
+        separated list of base64 client paths, or path_prefix, a base64
+        client directory whose files are all restored.
+
+        Returns (200, generator of tar blocks) or (code, json error).
+        Server paths are derived from the customer and device, so there
+        are no per-file database lookups.
+    """
+    __logger__().info("Server handling restore archive request.")
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
 
-    # TODO: receive request with valid api key/agent id/file path (encrypted)
-    # Mark file in database as restored, 
+    device_id,_,_,_,_,_,_,_,_,_ = results
+
+    try:
+        if request.get('file_paths'):
+            paths_on_device = [base64.b64decode(path).decode("utf-8") for path in request['file_paths'].split(",")]
+            if len(paths_on_device) > restore_archive_utils.MAX_ARCHIVE_FILES:
+                return 413, json.dumps({'error': 'At most %d files per request.' % restore_archive_utils.MAX_ARCHIVE_FILES})
+
+            entries = restore_archive_utils.resolve_paths(customer_id, device_id, paths_on_device)
+
+        elif request.get('path_prefix'):
+            prefix = base64.b64decode(request['path_prefix']).decode("utf-8")
+            entries = restore_archive_utils.walk_prefix(customer_id, device_id, prefix)
+
+        else:
+            return RESPONSE_401_BAD_REQUEST
+
+    except ValueError:
+        return RESPONSE_401_BAD_REQUEST
+
+    return 200, restore_archive_utils.iter_tar_stream(entries)
+
+def handle_file_versions_request(request):
+    """List the stored versions of one file, newest first"""
+    __logger__().info("Server handling file versions request.")
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
+
+    device_id,_,_,_,_,_,_,_,_,_ = results
+    path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+    path_on_server, _ = backup_utils.make_server_path(customer_id, device_id, path_on_device)
+
+    versions = [{
+        'version_id': version_id,
+        'sha256': digest,
+        'file_size': file_size,
+        'created': created
+    } for version_id, digest, file_size, created in catalog_utils.get_file_versions(path_on_server)]
+
+    return 200, json.dumps({'file_versions-response': 'OK', 'versions': versions})
+
+def handle_restore_complete_request(request):
+    """Mark a queued restore as done once the client has the whole file on disk"""
+    __logger__().info("Server handling restore complete request.")
+    customer_id = db.get_customer_id_by_api_key(request['api_key'])
+
+    if not customer_id:
+        return RESPONSE_401_BAD_REQUEST
+
+    results = db.get_device_by_agent_id(request['agent_id'])
+    if not results:
+        return RESPONSE_401_BAD_REQUEST
+
+    device_id,_,_,_,_,_,_,_,_,_ = results
+
+    try:
+        path_on_device = base64.b64decode(request['file_path']).decode("utf-8")
+    except (KeyError, ValueError):
+        return RESPONSE_401_BAD_REQUEST
+
+    db.mark_file_as_restored(device_id, path_on_device)
+    return 200, json.dumps({'restore_complete-response': 'Marked file as restored.'})
@@ -4,9 +4,11 @@ import os
 import traceback
 
 import database_utils as db
+import db_pool_utils
 import logging_utils
+import work_queue_utils
 
-import backup_handlers, keepalive_handlers, restore_handlers
+import backup_handlers, keepalive_handlers, restore_handlers, metadata_handlers
 import generic_handlers
 import new_customer_handlers
 import stripe_handlers
@@ -23,6 +25,9 @@ cors = CORS(app, resources={r"/api/*": {"origins": "https://apps.darkage.io"}})
 
 logger = logging_utils.initialize_logging()
 
+# Finish post-upload work left queued by a previous run
+work_queue_utils.start_worker()
+
 STRING_400_BAD_REQUEST = "Bad request."
 STRING_400_MUST_BE_JSON = "Request must be JSON."
 STRING_400_MUST_BE_MULTIPART = "Request must be multipart/form-data."
@@ -68,19 +73,54 @@ RESPONSE_401_UNSAFE_CHARACTERS = (
     {'Content-Type': 'application/json'}
 )
 
+ONE_MB = 1024*1024
+
+# Large fields that are checked for type and length instead of being scanned
+# by db.passes_sanitize, per endpoint: field -> maximum length. They are only
+# ever passed to the database as bound parameters, or decoded before use, so
+# the character scan protects nothing while costing a pass over every byte.
+REQUEST_FIELD_SCHEMAS = {
+    '/api/submit-error-log': {'log_content': 16*ONE_MB},
+    '/api/summarize-file':   {'content': 16*ONE_MB}
+}
+
+def passes_field_schema(value, max_length):
+    return isinstance(value, str) and len(value) <= max_length
+
+def accepts_gzip():
+    """Whether the client takes gzip encoded responses; large streamed responses are compressed if so"""
+    return 'gzip' in flask.request.headers.get('Accept-Encoding', '')
+
 def main():
     app.run()
 
+# All database calls made while handling one request share one pooled connection
+@app.before_request
+def begin_request_db_connection():
+    db_pool_utils.begin_request()
+
+@app.teardown_request
+def end_request_db_connection(exception):
+    db_pool_utils.end_request()
+
 # TODO: each call to validate_request_generic needs to adopt the new definition
 def validate_request_generic(request, api_key_required=True, api_key_must_be_active=True, agent_id_required=True):
+    field_schema = REQUEST_FIELD_SCHEMAS.get(flask.request.path, {}) if flask.has_request_context() else {}
+
     for field in request.keys():
         # TODO: need to figure out how to validate these separately...
         # they will probably contain banned characters
         if 'payment_card_info' in field or 'build_command' in field:
             continue
 
+        if field in field_schema:
+            if not passes_field_schema(request[field], field_schema[field]):
+                logger.warning("Failed schema check (field name: '%s', maximum length %d)" % (field, field_schema[field]))
+                return False, RESPONSE_401_UNSAFE_CHARACTERS
+            continue
+
         if not db.passes_sanitize(str(request[field])):
-            logger.warning("Failed sanitization check (field name: '%s'): %s" %(field,request[field]))
+            logger.warning("Failed sanitization check (field name: '%s'): %.200s" %(field,request[field]))
             return False, RESPONSE_401_UNSAFE_CHARACTERS
 
     if api_key_required:
@@ -293,6 +333,168 @@ def backup_file_stream():
     else:
         return RESPONSE_400_BAD_REQUEST
 
+@app.route('/api/backup-files-batch', methods=['POST'])
+def backup_files_batch():
+    # Many small files in one streamed multipart request: file_count, then a
+    # base64 file_path_<n> field and a file_content_<n> part for each file.
+    logger.info(flask.request)
+    logger.info(flask.request.headers)
+
+    if 'multipart/form-data' not in flask.request.headers['Content-Type']:
+        return RESPONSE_400_MUST_BE_MULTIPART
+
+    stream, form, files = parse_form_data(flask.request.environ, stream_factory=default_stream_factory)
+    data = form
+
+    if not files:
+        return RESPONSE_400_BAD_REQUEST
+
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_backup_files_batch_request(data, files)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/upload-session/create', methods=['POST'])
+def create_upload_session():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_create_upload_session_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/upload-session/chunk', methods=['PUT'])
+def upload_session_chunk():
+    # The body is the raw chunk, so the request fields travel as headers.
+    data = {
+        'api_key': flask.request.headers.get('X-API-Key', ''),
+        'agent_id': flask.request.headers.get('X-Agent-ID', ''),
+        'session_id': flask.request.headers.get('X-Session-ID', ''),
+        'index': flask.request.headers.get('X-Chunk-Index', ''),
+        'sha256': flask.request.headers.get('X-Chunk-SHA256', '')
+    }
+
+    result, response = validate_request_generic(data)
+    if not result:
+        return response
+
+    ret_code, response_data = backup_handlers.handle_upload_chunk_request(data, flask.request.stream)
+    return response_data, ret_code, {'Content-Type': 'application/json'}
+
+@app.route('/api/upload-session/status', methods=['POST'])
+def upload_session_status():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_upload_session_status_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/upload-session/commit', methods=['POST'])
+def commit_upload_session():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_commit_upload_session_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/backup-known-file', methods=['POST'])
+def backup_known_file():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_backup_known_file_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/chunks/missing', methods=['POST'])
+def missing_chunks():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_missing_chunks_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/chunks/upload', methods=['PUT'])
+def upload_content_chunk():
+    # The body is the raw chunk, so the request fields travel as headers.
+    data = {
+        'api_key': flask.request.headers.get('X-API-Key', ''),
+        'agent_id': flask.request.headers.get('X-Agent-ID', ''),
+        'sha256': flask.request.headers.get('X-Chunk-SHA256', '')
+    }
+
+    result, response = validate_request_generic(data)
+    if not result:
+        return response
+
+    ret_code, response_data = backup_handlers.handle_upload_content_chunk_request(data, flask.request.stream)
+    return response_data, ret_code, {'Content-Type': 'application/json'}
+
+@app.route('/api/chunks/commit-file', methods=['POST'])
+def commit_chunked_file():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = backup_handlers.handle_commit_chunked_file_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
 @app.route('/api/keepalive', methods=['POST'])
 def keepalive():
     logger.info(flask.request)
@@ -310,6 +512,24 @@ def keepalive():
     else:
         return RESPONSE_400_BAD_REQUEST
 
+# Long-poll keepalive: held open until restore work is queued for the agent
+@app.route('/api/keepalive-wait', methods=['POST'])
+def keepalive_wait():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = keepalive_handlers.handle_keepalive_wait_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
 @app.route('/api/get-builds', methods=['POST'])
 def get_builds():
     logger.info(flask.request)
@@ -330,6 +550,86 @@ def get_builds():
     else:
         return RESPONSE_400_BAD_REQUEST
 
+@app.route('/api/admin/db-pool-metrics', methods=['POST'])
+def db_pool_metrics():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data, agent_id_required=False)
+        if not result:
+            return response
+
+        if not validate_request_admin(data):
+            return RESPONSE_401_BAD_REQUEST
+
+        ret_code, response_data = generic_handlers.handle_db_pool_metrics_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/admin/auth-cache-metrics', methods=['POST'])
+def auth_cache_metrics():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data, agent_id_required=False)
+        if not result:
+            return response
+
+        if not validate_request_admin(data):
+            return RESPONSE_401_BAD_REQUEST
+
+        ret_code, response_data = generic_handlers.handle_auth_cache_metrics_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/admin/work-queue-metrics', methods=['POST'])
+def work_queue_metrics():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data, agent_id_required=False)
+        if not result:
+            return response
+
+        if not validate_request_admin(data):
+            return RESPONSE_401_BAD_REQUEST
+
+        ret_code, response_data = generic_handlers.handle_work_queue_metrics_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/admin/keepalive-metrics', methods=['POST'])
+def keepalive_metrics():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data, agent_id_required=False)
+        if not result:
+            return response
+
+        if not validate_request_admin(data):
+            return RESPONSE_401_BAD_REQUEST
+
+        ret_code, response_data = generic_handlers.handle_keepalive_metrics_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
 @app.route('/api/update-build-result', methods=['POST'])
 def update_build_result():
     logger.info(flask.request)
@@ -387,6 +687,96 @@ def restore_file():
     else:
         return RESPONSE_400_BAD_REQUEST
 
+@app.route('/api/restore-file-stream', methods=['GET'])
+def restore_file_stream():
+    # Raw file content, so the request fields travel as headers. send_file
+    # answers Range requests with 206 Partial Content and sets ETag and
+    # Content-Length; the file is sent with the server's file wrapper
+    # (sendfile where available), never read into memory.
+    data = {
+        'api_key': flask.request.headers.get('X-API-Key', ''),
+        'agent_id': flask.request.headers.get('X-Agent-ID', ''),
+        'file_path': flask.request.headers.get('X-File-Path', ''),
+        'version_id': flask.request.headers.get('X-Version-ID', '')
+    }
+
+    result, response = validate_request_generic(data)
+    if not result:
+        return response
+
+    ret_code, path_or_response, digest = restore_handlers.handle_restore_file_stream_request(data)
+    if ret_code != 200:
+        return path_or_response, ret_code, {'Content-Type': 'application/json'}
+
+    response = flask.send_file(
+        path_or_response,
+        mimetype='application/octet-stream',
+        conditional=True,
+        etag=digest if digest else True,
+        max_age=0
+    )
+
+    if digest:
+        response.headers['X-Content-SHA256'] = digest
+
+    return response
+
+@app.route('/api/restore-complete', methods=['POST'])
+def restore_complete():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = restore_handlers.handle_restore_complete_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/restore-files-archive', methods=['POST'])
+def restore_files_archive():
+    # Many files in one streamed tar archive; the generator reads each file
+    # from disk as the client consumes the response.
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = restore_handlers.handle_restore_archive_request(data)
+        if ret_code != 200:
+            return response_data, ret_code, {'Content-Type': 'application/json'}
+
+        return flask.Response(response_data, mimetype='application/x-tar')
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
+@app.route('/api/file-versions', methods=['POST'])
+def file_versions():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        ret_code, response_data = restore_handlers.handle_file_versions_request(data)
+        return response_data, ret_code, {'Content-Type': 'application/json'}
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
 @app.route('/api/create-customer', methods=['POST'])
 def create_customer():
     logger.info(flask.request)
@@ -513,16 +903,37 @@ def get_file_metadata():
         if not agent_id:
             return json.dumps({'error': 'Missing agent_id'}), 400, {'Content-Type': 'application/json'}
 
-        file_metadata = db.get_file_metadata_for_agent(agent_id)
-        
-        return jsonify({
-            'success': True,
-            'data': file_metadata
-        }), 200
+        compress = accepts_gzip()
+        ret_code, response_data = metadata_handlers.handle_file_metadata_request(data, compress)
+
+        return flask.Response(response_data, status=ret_code, mimetype='application/json',
+                              headers={'Content-Encoding': 'gzip'} if compress else {})
 
     else:
         return RESPONSE_400_BAD_REQUEST
         
+@app.route('/api/file-metadata-changes', methods=['POST'])
+def get_file_metadata_changes():
+    logger.info(flask.request)
+    if flask.request.headers['Content-Type'] != 'application/json':
+        return RESPONSE_400_MUST_BE_JSON
+
+    data = flask.request.get_json()
+    if data:
+        result, response = validate_request_generic(data)
+        if not result:
+            return response
+
+        compress = accepts_gzip()
+        ret_code, response_data = metadata_handlers.handle_file_metadata_changes_request(data, compress)
+        if ret_code != 200:
+            return response_data, ret_code, {'Content-Type': 'application/json'}
+
+        return flask.Response(response_data, mimetype='application/x-ndjson',
+                              headers={'Content-Encoding': 'gzip'} if compress else {})
+    else:
+        return RESPONSE_400_BAD_REQUEST
+
 @app.route('/api/authenticate', methods=['POST'])
 def authenticate():
     logger.info(flask.request)
@@ -3,6 +3,7 @@ import os
 
 import stripe_utils
 import logging_utils
+import auth_cache_utils
 
 import database_utils as db
 
@@ -44,6 +45,7 @@ def handle_create_customer_request(request):
       # Update the customer with the Stripe ID,
       # and also mark their account as active.
       update_result = db.update_customer_with_stripe_id(customer_id, stripe_id)
+      auth_cache_utils.invalidate_api_key(request['api_key'])
 
       if update_result == 1:
         __logger__().info("Successfully registered new customer with Stripe.")
@@ -76,6 +78,9 @@ def handle_remove_customer_request(request):
 
         # If successful, update your database to reflect the removal
         if deleted_customer:
+            # The removed customer's key cannot be looked up from its Stripe id
+            auth_cache_utils.invalidate_all()
+
             # customer_id = db.get_customer_id_by_stripe_id(stripe_customer_id)
             # if customer_id:
                 # db.remove_stripe_id_from_customer(customer_id)
@@ -0,0 +1,481 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest.mock import patch
+
+import logging_utils
+
+import auth_cache_utils
+import blob_store_utils
+import catalog_utils
+import chunk_store_utils
+import db_pool_utils
+import work_queue_utils
+
+# Server-side unit tests. Storage locations and the work queue are pointed
+# at a temporary directory and MySQL is never contacted (the connection pool
+# is given a fake connect), so these run anywhere the server's
+# Python dependencies are installed:
+#
+#   cd sc-server && python -m unittest unit_testing_suite
+
+if logging_utils.logger is None:
+    logging_utils.logger = logging.getLogger("sc-server-tests")
+
+class StorageTestCase(unittest.TestCase):
+    """Base class for tests that use the catalog, blob store and chunk store in a temporary directory"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        patch('catalog_utils.CATALOG_PATH', os.path.join(self.test_dir, 'catalog.db')).start()
+        patch('blob_store_utils.BLOB_STORE_ROOT', os.path.join(self.test_dir, 'blobs') + '/').start()
+        patch('chunk_store_utils.CHUNK_STORE_ROOT', os.path.join(self.test_dir, '%s', 'chunks') + '/').start()
+
+        # Pruning is run explicitly by the tests that want it, not by the background thread
+        self.prune_mock = patch('blob_store_utils.request_prune').start()
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+class TestChunkStore(StorageTestCase):
+    """Test suite for committing files uploaded as content-defined chunks"""
+
+    def setUp(self):
+        super().setUp()
+        self.customer_id = 7
+        self.device_id = 11
+        self.path_on_server = os.path.join(self.test_dir, 'device', 'big.bin')
+
+    def _store(self, *pieces):
+        """Store each piece as a chunk; returns the recipe"""
+        chunks = []
+        for piece in pieces:
+            digest = hashlib.sha256(piece).hexdigest()
+            self.assertIsNone(chunk_store_utils.store_chunk(self.customer_id, digest, _Stream(piece)))
+            chunks.append((digest, len(piece)))
+
+        return chunks
+
+    def _commit(self, chunks, max_versions=3):
+        return chunk_store_utils.commit_file_from_chunks(
+            self.customer_id, self.device_id, chunks, self.path_on_server, max_versions)
+
+    def _version_contents(self):
+        contents = []
+        for _, digest, _, _ in catalog_utils.get_file_versions(self.path_on_server):
+            with open(blob_store_utils.get_blob_path(digest), 'rb') as f:
+                contents.append(f.read())
+
+        return contents
+
+    def test_commit_waits_for_missing_chunks(self):
+        """Test that a recipe naming chunks the store does not have is not committed"""
+        chunks = self._store(b'a' * 100)
+        absent = hashlib.sha256(b'absent').hexdigest()
+
+        file_size, missing = self._commit(chunks + [(absent, 6)])
+
+        self.assertIsNone(file_size)
+        self.assertEqual(missing, [absent])
+        self.assertFalse(os.path.exists(self.path_on_server))
+
+    def test_versions_are_kept_in_catalog(self):
+        """Test that every committed version of a chunked file can be listed and read back"""
+        first = [b'a' * 1000, b'b' * 1000]
+        second = [b'a' * 1000, b'c' * 1000]
+
+        self.assertEqual(self._commit(self._store(*first)), (2000, None))
+        self.assertEqual(self._commit(self._store(*second)), (2000, None))
+
+        with open(self.path_on_server, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(second))
+
+        self.assertEqual(self._version_contents(), [b''.join(second), b''.join(first)])
+
+        # Only the current recipe is kept, for the next upload
+        history = chunk_store_utils.get_recipe_history(self.path_on_server)
+        self.assertEqual(len(history), 1)
+        self.assertEqual(chunk_store_utils.parse_chunk_list(history[0]['chunks']), self._store(*second))
+
+    def test_commit_is_idempotent(self):
+        """Test that committing the same recipe again (a re-run job) adds no version"""
+        chunks = self._store(b'x' * 500)
+
+        self._commit(chunks)
+        self._commit(chunks)
+
+        self.assertEqual(len(catalog_utils.get_file_versions(self.path_on_server)), 1)
+
+    def test_old_recipe_history_is_added_to_catalog(self):
+        """Test that older versions kept only as recipes are added to the catalog on the next commit"""
+        versions = [b'1' * 300, b'2' * 300, b'3' * 300]
+        recipes = [self._store(content) for content in versions[:2]]
+
+        os.makedirs(os.path.dirname(self.path_on_server))
+        with open(self.path_on_server, 'wb') as f:
+            f.write(versions[1])
+
+        history_path = chunk_store_utils.get_recipe_history_path(self.path_on_server)
+        os.makedirs(os.path.dirname(history_path))
+        with open(history_path, 'w') as f:
+            json.dump([{'created': 0, 'file_size': 300, 'chunks': ",".join("%s:%d" % c for c in recipe)}
+                       for recipe in recipes], f)
+
+        self._commit(self._store(versions[2]))
+
+        self.assertEqual(self._version_contents(), list(reversed(versions)))
+
+class TestBlobPins(StorageTestCase):
+    """Test suite for keeping blobs from garbage collection while their version is recorded"""
+
+    def _unreferenced_blob(self):
+        """A blob whose only version was pruned away; returns its digest"""
+        digests = []
+        for content in (b'old', b'new'):
+            source_path = os.path.join(self.test_dir, 'upload')
+            with open(source_path, 'wb') as f:
+                f.write(content)
+
+            digest, size, pin_id = blob_store_utils.add_blob(source_path)
+            catalog_utils.add_file_version(1, 1, '/device/file', digest, size)
+            catalog_utils.unpin_blob(pin_id)
+            digests.append(digest)
+
+        self.assertEqual(catalog_utils.prune_versions('/device/file', 1), [digests[0]])
+        return digests[0]
+
+    def test_pinned_blob_is_not_collected(self):
+        """Test that garbage collection leaves a pinned blob alone until it is unpinned"""
+        digest = self._unreferenced_blob()
+        pin_id = catalog_utils.pin_blob(digest)
+
+        self.assertEqual(catalog_utils.get_unreferenced_blobs(), [])
+        self.assertEqual(blob_store_utils.collect_garbage([digest]), 0)
+        self.assertTrue(os.path.exists(blob_store_utils.get_blob_path(digest)))
+
+        catalog_utils.unpin_blob(pin_id)
+        catalog_utils.unpin_blob(pin_id)
+
+        self.assertEqual(blob_store_utils.collect_garbage(), 1)
+        self.assertFalse(os.path.exists(blob_store_utils.get_blob_path(digest)))
+
+class TestWorkQueue(unittest.TestCase):
+    """Test suite for the durable work queue, run one batch at a time without the worker thread"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        patch('work_queue_utils.WORK_QUEUE_PATH', os.path.join(self.test_dir, 'work_queue.db')).start()
+        patch('work_queue_utils.start_worker').start()
+        patch.dict(work_queue_utils._handlers, clear=True).start()
+        patch('work_queue_utils._batch_hooks', []).start()
+
+        self.calls = []
+        self.failures = {}   # name -> number of times its job still has to fail
+
+        work_queue_utils.register_handler('test', self._handle)
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def _handle(self, payload):
+        self.calls.append(payload['name'])
+        if self.failures.get(payload['name'], 0):
+            self.failures[payload['name']] -= 1
+            raise RuntimeError("%s failed" % payload['name'])
+
+    def _enqueue(self, key, name):
+        work_queue_utils.enqueue('test', key, {'name': name})
+
+    def _jobs(self):
+        return work_queue_utils.get_connection().execute(
+            '''SELECT json_extract(payload, '$.name'), attempts, available_at, failed FROM jobs ORDER BY id''').fetchall()
+
+    def _make_retries_due(self):
+        with work_queue_utils.get_connection() as conn:
+            conn.execute('''UPDATE jobs SET available_at = 0''')
+
+    def test_same_key_jobs_run_in_order_across_retries(self):
+        """Test that a job waits for an earlier job on its key, even while that one backs off"""
+        self.failures['first'] = 1
+        self._enqueue('/a', 'first')
+        self._enqueue('/a', 'second')
+        self._enqueue('/b', 'other')
+
+        self.assertEqual(work_queue_utils.process_batch(), 2)
+        self.assertEqual(self.calls, ['first', 'other'])
+
+        # first is backing off, and second must not overtake it
+        self.assertEqual(work_queue_utils.process_batch(), 0)
+
+        self._make_retries_due()
+        work_queue_utils.process_batch()
+        work_queue_utils.process_batch()
+
+        self.assertEqual(self.calls, ['first', 'other', 'first', 'second'])
+        self.assertEqual(self._jobs(), [])
+
+    def test_failing_job_backs_off_then_is_marked_failed(self):
+        """Test that each failure pushes the retry further out, and MAX_ATTEMPTS failures mark the job failed"""
+        self.failures['bad'] = work_queue_utils.MAX_ATTEMPTS
+        self._enqueue('/a', 'bad')
+
+        for attempt in range(1, work_queue_utils.MAX_ATTEMPTS + 1):
+            before = time.time()
+            self.assertEqual(work_queue_utils.process_batch(), 1)
+
+            _, attempts, available_at, failed = self._jobs()[0]
+            self.assertEqual(attempts, attempt)
+            self.assertGreaterEqual(available_at, before + work_queue_utils.RETRY_SECONDS * attempt)
+            self.assertEqual(failed, 1 if attempt == work_queue_utils.MAX_ATTEMPTS else 0)
+
+            self._make_retries_due()
+
+        # A failed job is kept for inspection but no longer retried or holding up its key
+        self._enqueue('/a', 'next')
+        self.assertEqual(work_queue_utils.process_batch(), 1)
+        self.assertEqual(self.calls[-1], 'next')
+        self.assertEqual([row[0] for row in self._jobs()], ['bad'])
+        self.assertEqual(work_queue_utils.get_queue_metrics()['failed'], 1)
+
+    def test_batch_is_not_acknowledged_when_hook_fails(self):
+        """Test that a raising batch hook leaves the batch queued, while failed jobs still back off"""
+        hook_failures = [RuntimeError("flush failed")]
+
+        def hook():
+            if hook_failures:
+                raise hook_failures.pop()
+
+        work_queue_utils.register_batch_hook(hook)
+        self.failures['bad'] = 1
+        self._enqueue('/a', 'good')
+        self._enqueue('/b', 'bad')
+
+        with self.assertRaises(RuntimeError):
+            work_queue_utils.process_batch()
+
+        self.assertEqual([(name, attempts) for name, attempts, _, _ in self._jobs()], [('good', 0), ('bad', 1)])
+
+        # The whole batch runs again; this time it is acknowledged
+        self._make_retries_due()
+        self.assertEqual(work_queue_utils.process_batch(), 2)
+        self.assertEqual(self.calls, ['good', 'bad', 'good', 'bad'])
+        self.assertEqual(self._jobs(), [])
+
+class _FakeConnection:
+    """Stands in for a mysql.connector connection"""
+
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.in_transaction = False
+        self.closed = False
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if not self.healthy:
+            raise OSError("connection lost")
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool(unittest.TestCase):
+    """Test suite for the MySQL connection pool, using fake connections"""
+
+    def setUp(self):
+        self.connections = []
+
+    def _connect(self):
+        cnx = _FakeConnection()
+        self.connections.append(cnx)
+        return cnx
+
+    def _pool(self, size=1, timeout=5, health_check_seconds=30):
+        return db_pool_utils.ConnectionPool(size, timeout, health_check_seconds, connect=self._connect)
+
+    def test_connections_are_reused(self):
+        """Test that a released connection is handed out again instead of opening another"""
+        pool = self._pool(size=2)
+
+        cnx = pool.acquire()
+        cnx.in_transaction = True
+        pool.release(cnx)
+
+        self.assertIs(pool.acquire(), cnx)
+        self.assertFalse(cnx.in_transaction)
+        self.assertEqual(pool.get_metrics()['connections_created'], 1)
+
+    def test_exhausted_pool_waits_for_release(self):
+        """Test that a caller finding the pool exhausted gets the next connection released"""
+        pool = self._pool(size=1)
+        cnx = pool.acquire()
+
+        releaser = threading.Timer(0.1, pool.release, (cnx,))
+        releaser.start()
+
+        self.assertIs(pool.acquire(), cnx)
+        releaser.join()
+
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['waits'], 1)
+        self.assertGreaterEqual(metrics['max_wait_ms'], 50)
+        self.assertEqual(metrics['connections_created'], 1)
+
+    def test_exhausted_pool_times_out(self):
+        """Test that PoolTimeout is raised when no connection is released in time"""
+        pool = self._pool(size=1, timeout=0.1)
+        pool.acquire()
+
+        with self.assertRaises(db_pool_utils.PoolTimeout):
+            pool.acquire()
+
+        self.assertEqual(pool.get_metrics()['timeouts'], 1)
+
+    def test_discard_frees_place(self):
+        """Test that discarding a broken connection lets another be opened"""
+        pool = self._pool(size=1, timeout=0.1)
+        cnx = pool.acquire()
+        pool.discard(cnx)
+
+        self.assertTrue(cnx.closed)
+        self.assertIsNot(pool.acquire(), cnx)
+
+    def test_unhealthy_idle_connection_is_replaced(self):
+        """Test that a connection idle past the health check interval is pinged and replaced if dead"""
+        pool = self._pool(size=1, health_check_seconds=0)
+        cnx = pool.acquire()
+        pool.release(cnx)
+        cnx.healthy = False
+
+        replacement = pool.acquire()
+
+        self.assertIsNot(replacement, cnx)
+        self.assertTrue(cnx.closed)
+        self.assertEqual(pool.get_metrics()['health_check_failures'], 1)
+
+class _Clock:
+    """Stands in for the time module auth_cache_utils reads"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class TestAuthCache(unittest.TestCase):
+    """Test suite for the authentication lookup cache"""
+
+    def setUp(self):
+        self.clock = _Clock()
+        patch('auth_cache_utils.time', self.clock).start()
+
+        self.cache = auth_cache_utils.TTLCache('test', max_entries=2, ttl=60, negative_ttl=10)
+        self.results = {}
+        self.lookups = []
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _lookup(self, key):
+        self.lookups.append(key)
+        result = self.results.get(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _cached_lookup(self):
+        return auth_cache_utils.cached(self.cache, is_negative=lambda value: value is None,
+                                       is_cacheable=lambda value: value != 'error')(self._lookup)
+
+    def test_found_values_live_for_ttl(self):
+        """Test that a found value is served from the cache until the TTL passes"""
+        self.results['key'] = 'value'
+        lookup = self._cached_lookup()
+
+        self.assertEqual(lookup('key'), 'value')
+        self.clock.now += 59
+        self.assertEqual(lookup('key'), 'value')
+        self.assertEqual(self.lookups, ['key'])
+
+        self.clock.now += 2
+        lookup('key')
+        self.assertEqual(self.lookups, ['key', 'key'])
+
+    def test_negative_results_live_for_negative_ttl(self):
+        """Test that a lookup that found nothing is cached, but only for the shorter TTL"""
+        lookup = self._cached_lookup()
+
+        self.assertIsNone(lookup('unknown'))
+        self.assertIsNone(lookup('unknown'))
+        self.assertEqual(self.lookups, ['unknown'])
+        self.assertEqual(self.cache.get_stats()['negative_hits'], 1)
+
+        self.clock.now += 11
+        lookup('unknown')
+        self.assertEqual(self.lookups, ['unknown', 'unknown'])
+
+    def test_uncacheable_results_are_not_cached(self):
+        """Test that a failed lookup is looked up again next time"""
+        self.results['key'] = 'error'
+        lookup = self._cached_lookup()
+
+        lookup('key')
+        lookup('key')
+
+        self.assertEqual(self.lookups, ['key', 'key'])
+        self.assertEqual(self.cache.get_stats()['entries'], 0)
+
+    def test_invalidation_during_lookup_is_not_undone(self):
+        """Test that a lookup running when its key is invalidated does not cache the old value"""
+        self.results['key'] = 'old'
+        cache = self.cache
+
+        def lookup_then_invalidate(key):
+            value = self._lookup(key)
+            cache.invalidate(key)
+            return value
+
+        lookup = auth_cache_utils.cached(cache, is_negative=lambda value: value is None)(lookup_then_invalidate)
+
+        self.assertEqual(lookup('key'), 'old')
+        self.assertEqual(cache.get('key'), (False, None))
+
+        # A lookup that starts after the invalidation is cached as usual
+        self.results['key'] = 'new'
+        self.assertEqual(self._cached_lookup()('key'), 'new')
+        self.assertEqual(cache.get('key'), (True, 'new'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Test that a full cache evicts the entry used longest ago"""
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+
+        self.assertEqual(self.cache.get('b'), (False, None))
+        self.assertEqual(self.cache.get('a'), (True, 1))
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+class _Stream:
+    """The request stream store_chunk reads a chunk from"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        data, self.data = self.data, b''
+        return data
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import time
+
+import logging_utils
+
+# Each session lives in its own directory next to the customer's device storage,
+# so the committed file can be moved into place with a rename on the same disk:
+#
+#   session.json   what is being uploaded (device, path, size, chunk size)
+#   data           the file, with each chunk written at its own offset
+#   chunks.log     "<index> <sha256>" per chunk, appended after the chunk is on disk
+UPLOAD_SESSION_ROOT = "/storage/%s/upload_sessions/"
+
+DEFAULT_CHUNK_SIZE = 8*1024*1024
+MAX_CHUNK_SIZE     = 64*1024*1024
+
+# Sessions that have not been touched in this long are removed
+SESSION_EXPIRY_SECONDS = 7*24*60*60
+
+def __logger__():
+    return logging_utils.logger
+
+def get_session_directory(customer_id, session_id):
+    return UPLOAD_SESSION_ROOT % customer_id + session_id + "/"
+
+def create_session(customer_id, device_id, path_on_device, file_size, chunk_size):
+    remove_expired_sessions(customer_id)
+
+    session_id = secrets.token_hex(16)
+    session_directory = get_session_directory(customer_id, session_id)
+    os.makedirs(session_directory)
+
+    session = {
+        'session_id': session_id,
+        'device_id': device_id,
+        'path_on_device': path_on_device,
+        'file_size': file_size,
+        'chunk_size': chunk_size,
+        'total_chunks': max(1, -(-file_size // chunk_size)),
+        'created': time.time()
+    }
+
+    with open(session_directory + "session.json", 'w') as f:
+        json.dump(session, f)
+
+    # Preallocate (sparse) so chunks can arrive in any order
+    with open(session_directory + "data", 'wb') as f:
+        f.truncate(file_size)
+
+    __logger__().info("Created upload session %s for %s (%d bytes, %d chunks)" % (
+        session_id, path_on_device, file_size, session['total_chunks']))
+
+    return session
+
+def load_session(customer_id, device_id, session_id):
+    """Returns the session dict, or None if it does not exist or belongs to another device"""
+    if not session_id or not all(c in "0123456789abcdef" for c in session_id):
+        return None
+
+    session_file = get_session_directory(customer_id, session_id) + "session.json"
+    if not os.path.exists(session_file):
+        return None
+
+    with open(session_file, 'r') as f:
+        session = json.load(f)
+
+    if session['device_id'] != device_id:
+        return None
+
+    return session
+
+def expected_chunk_length(session, index):
+    if index == session['total_chunks'] - 1:
+        return session['file_size'] - index * session['chunk_size']
+    return session['chunk_size']
+
+def write_chunk(customer_id, session, index, chunk_stream, expected_sha256):
+    """
+    Write one chunk at its offset and record it once it is on disk.
+    Returns None on success or an error string.
+    """
+    if index < 0 or index >= session['total_chunks']:
+        return "Chunk index out of range."
+
+    expected_length = expected_chunk_length(session, index)
+    session_directory = get_session_directory(customer_id, session['session_id'])
+
+    # Read the whole chunk and check it before touching the data file, so a
+    # corrupt or truncated chunk never overwrites a good one.
+    chunk = chunk_stream.read(expected_length + 1)
+    if len(chunk) != expected_length:
+        return "Chunk %d has %d bytes, expected %d." % (index, len(chunk), expected_length)
+
+    digest = hashlib.sha256(chunk).hexdigest()
+    if digest != expected_sha256:
+        return "Chunk %d digest mismatch." % index
+
+    fd = os.open(session_directory + "data", os.O_WRONLY)
+    try:
+        os.pwrite(fd, chunk, index * session['chunk_size'])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    with open(session_directory + "chunks.log", 'a') as f:
+        f.write("%d %s\n" % (index, digest))
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Keeps an active session from being expired
+    os.utime(session_directory)
+
+    return None
+
+def get_received_chunks(customer_id, session):
+    log_path = get_session_directory(customer_id, session['session_id']) + "chunks.log"
+    received = set()
+
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                # A line cut short by a crash is ignored; that chunk is simply sent again
+                if len(parts) == 2 and len(parts[1]) == 64:
+                    received.add(int(parts[0]))
+
+    return received
+
+def commit_session(customer_id, session, store_file):
+    """
+        Hand the completed upload to store_file(data_path), which moves it
+        into place, then remove the session.
+        Returns None on success or an error string.
+    """
+    missing = set(range(session['total_chunks'])) - get_received_chunks(customer_id, session)
+    if missing:
+        return "Upload is missing %d chunks." % len(missing)
+
+    session_directory = get_session_directory(customer_id, session['session_id'])
+    data_path = session_directory + "data"
+
+    if os.path.getsize(data_path) != session['file_size']:
+        return "Uploaded data does not match the session's file size."
+
+    store_file(data_path)
+
+    shutil.rmtree(session_directory, ignore_errors=True)
+    __logger__().info("Committed upload session %s" % session['session_id'])
+
+    return None
+
+def remove_expired_sessions(customer_id):
+    root = UPLOAD_SESSION_ROOT % customer_id
+    if not os.path.isdir(root):
+        return
+
+    cutoff = time.time() - SESSION_EXPIRY_SECONDS
+    for entry in os.scandir(root):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            __logger__().info("Removing expired upload session %s" % entry.name)
+            shutil.rmtree(entry.path, ignore_errors=True)
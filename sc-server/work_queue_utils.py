@@ -0,0 +1,222 @@
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import logging_utils
+
+# Durable queue of work that follows an upload but need not hold up its
+# response: making the stored blob the file's current version, rebuilding
+# chunked files, and the MySQL metadata write. A handler acknowledges the
+# client once the bytes are on disk and the job row is committed (SQLite,
+# synchronous=FULL, so the row survives a crash); a background worker does
+# the rest.
+#
+#   jobs   id, kind, key, payload (JSON), enqueued, attempts, available_at, failed
+#
+# Jobs run in id order. A job waits while an earlier job with the same key
+# (the path on the server) is unfinished, so versions of one file are never
+# applied out of order, even across retries. Failed jobs are retried with
+# backoff and, after MAX_ATTEMPTS, kept with failed = 1 for inspection.
+#
+# Every server process runs a worker thread, but only the one holding the
+# lock file processes jobs; if that process dies another takes over.
+WORK_QUEUE_PATH = "/storage/work_queue.db"
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 30
+
+# How often an idle worker looks for jobs enqueued by other processes
+POLL_SECONDS = 2
+
+_handlers = {}   # kind -> handler(payload)
+_batch_hooks = []
+_local = threading.local()
+
+_worker_lock = threading.Lock()
+_worker_thread = None
+_wakeup = threading.Event()
+
+_metrics_lock = threading.Lock()
+_processed = 0
+_failures = 0
+_total_lag_seconds = 0.0
+_max_lag_seconds = 0.0
+_last_batch_seconds = 0.0
+
+def __logger__():
+    return logging_utils.logger
+
+def get_connection():
+    """One connection per thread, created (with the schema) on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != WORK_QUEUE_PATH:
+        conn = sqlite3.connect(WORK_QUEUE_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        _create_tables(conn)
+        _local.conn = conn
+        _local.path = WORK_QUEUE_PATH
+
+    return conn
+
+def _create_tables(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                enqueued REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )''')
+
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (failed, id)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs (key, id)''')
+
+def register_handler(kind, handler):
+    """handler(payload) does the work of one job of this kind; raising makes the job retry"""
+    _handlers[kind] = handler
+
+def register_batch_hook(hook):
+    """
+        hook() runs after each batch of jobs and before they are acknowledged,
+        to finish work the handlers buffered; if it raises, no job of the batch
+        is acknowledged and the whole batch runs again, so handlers must be
+        safe to run twice (store_version, for one, is a no-op the second time)
+    """
+    _batch_hooks.append(hook)
+
+def enqueue(kind, key, payload):
+    """Durably add a job; once this returns the work will be done even if the server crashes"""
+    conn = get_connection()
+    now = time.time()
+
+    with conn:
+        conn.execute('''INSERT INTO jobs (kind, key, payload, enqueued, available_at) VALUES (?,?,?,?,?)''',
+                     (kind, key, json.dumps(payload), now, now))
+
+    start_worker()
+    _wakeup.set()
+
+def start_worker():
+    """Start this process's worker thread, if it is not running"""
+    global _worker_thread
+
+    with _worker_lock:
+        if _worker_thread is None or not _worker_thread.is_alive():
+            _worker_thread = threading.Thread(target=_worker_loop, name="sc-work-queue", daemon=True)
+            _worker_thread.start()
+
+def _worker_loop():
+    os.makedirs(os.path.dirname(WORK_QUEUE_PATH), exist_ok=True)
+
+    with open(WORK_QUEUE_PATH + ".lock", 'w') as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                # Another process is the worker
+                time.sleep(POLL_SECONDS * 5)
+
+        __logger__().info("Work queue worker started in process %d" % os.getpid())
+
+        while True:
+            try:
+                if process_batch():
+                    continue
+            except Exception as e:
+                __logger__().error("Work queue batch failed: %s" % e)
+
+            _wakeup.wait(POLL_SECONDS)
+            _wakeup.clear()
+
+def process_batch():
+    """Run up to BATCH_SIZE ready jobs. Returns the number of jobs attempted."""
+    global _processed, _failures, _total_lag_seconds, _max_lag_seconds, _last_batch_seconds
+
+    conn = get_connection()
+    started = time.time()
+
+    jobs = conn.execute('''
+        SELECT id, kind, key, payload, enqueued, attempts FROM jobs j
+        WHERE failed = 0 AND available_at <= ?
+          AND NOT EXISTS (SELECT 1 FROM jobs e WHERE e.key = j.key AND e.id < j.id AND e.failed = 0)
+        ORDER BY id LIMIT ?''', (started, BATCH_SIZE)).fetchall()
+
+    if not jobs:
+        return 0
+
+    done = []
+    retries = []
+    lags = []
+    failed_keys = set()
+
+    for job_id, kind, key, payload, enqueued, attempts in jobs:
+        # Later jobs for a key that failed in this batch must wait for it
+        if key in failed_keys:
+            continue
+
+        try:
+            _handlers[kind](json.loads(payload))
+            done.append(job_id)
+            lags.append(time.time() - enqueued)
+
+        except Exception as e:
+            attempts += 1
+            __logger__().error("Job %d (%s %s) failed, attempt %d: %s" % (job_id, kind, key, attempts, e))
+            retries.append((attempts, time.time() + RETRY_SECONDS * attempts, 1 if attempts >= MAX_ATTEMPTS else 0, str(e), job_id))
+            failed_keys.add(key)
+
+    try:
+        for hook in _batch_hooks:
+            hook()
+    except Exception:
+        # Nothing is acknowledged, but the jobs that failed still back off
+        with conn:
+            conn.executemany('''UPDATE jobs SET attempts = ?, available_at = ?, failed = ?, last_error = ? WHERE id = ?''', retries)
+        raise
+
+    # One transaction acknowledges the whole batch
+    with conn:
+        conn.executemany('''DELETE FROM jobs WHERE id = ?''', [(job_id,) for job_id in done])
+        conn.executemany('''UPDATE jobs SET attempts = ?, available_at = ?, failed = ?, last_error = ? WHERE id = ?''', retries)
+
+    with _metrics_lock:
+        _processed += len(done)
+        _failures += len(retries)
+        _total_lag_seconds += sum(lags)
+        _max_lag_seconds = max([_max_lag_seconds] + lags)
+        _last_batch_seconds = time.time() - started
+
+    return len(done) + len(retries)
+
+def get_payloads(kind):
+    """Returns the payloads of every unfinished (or failed) job of this kind"""
+    return [json.loads(row[0]) for row in get_connection().execute(
+        '''SELECT payload FROM jobs WHERE kind = ?''', (kind,))]
+
+def get_queue_metrics():
+    row = get_connection().execute('''
+        SELECT SUM(failed = 0), SUM(failed = 1), MIN(CASE WHEN failed = 0 THEN enqueued END) FROM jobs''').fetchone()
+    depth, failed, oldest = row[0] or 0, row[1] or 0, row[2]
+
+    with _metrics_lock:
+        return {
+            'depth': depth,
+            'failed': failed,
+            'oldest_pending_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+            'processed': _processed,
+            'failures': _failures,
+            'average_lag_seconds': round(_total_lag_seconds / _processed, 3) if _processed else 0.0,
+            'max_lag_seconds': round(_max_lag_seconds, 3),
+            'last_batch_seconds': round(_last_batch_seconds, 3)
+        }